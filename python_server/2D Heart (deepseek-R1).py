@@ -18,21 +18,50 @@ def create_heart_shape(room_id: str = "heart-room", base_color: str = "#ff0000")
         (0, 0)  # 中心点
     ]
     
-    # 添加积木
-    for x, z in heart_coords:
-        try:
-            result = client.add_brick(
-                room_id=room_id,
-                x=float(x),
-                y=0.0,          # 假设y轴高度固定为0（平面心形）
-                z=float(z),
-                dimensions_x=1, # 积木长宽为1单位
-                dimensions_z=1,
-                color=base_color
-            )
-            print(f"添加积木 ({x}, {z}) 成功: {result}")
-        except Exception as e:
-            print(f"添加积木 ({x}, {z}) 失败: {str(e)}")
+    # 一次请求批量添加积木（心形坐标中有重复点，使用非原子模式跳过碰撞的积木）
+    bricks = [
+        {
+            "x": float(x),
+            "y": 0.0,          # 假设y轴高度固定为0（平面心形）
+            "z": float(z),
+            "dimensions_x": 1, # 积木长宽为1单位
+            "dimensions_z": 1,
+            "color": base_color
+        }
+        for x, z in heart_coords
+    ]
+    try:
+        result = client.add_bricks(room_id=room_id, bricks=bricks, atomic=False)
+        print(f"成功添加 {result['total_added']} 个积木")
+        for failure in result["failed"]:
+            x, z = heart_coords[failure["index"]]
+            print(f"添加积木 ({x}, {z}) 失败: 与 {failure['collision_with']} 发生碰撞")
+    except Exception as e:
+        print(f"批量添加积木失败: {str(e)}")
+
+def create_filled_heart(room_id: str = "heart-room", base_color: str = "#ff0000"):
+    """
+    另一种画法：由服务器生成实心心形，相邻的同色单元自动合并为较大的积木
+    """
+    client = LegoBuilder()  # 默认连接到localhost:8000
+    
+    # 以 (0, 0, 0) 为中心、宽 11 个单元的平面心形（y固定为0，高度为1层），上半部分的两个半圆朝向 z 负方向
+    heart = {
+        "type": "heart",
+        "x": 0,
+        "y": 0,
+        "z": 0,
+        "size": 11,
+        "height": 1
+    }
+    try:
+        # 非原子模式：跳过已被其他积木占据的位置
+        result = client.add_shape(room_id=room_id, shapes=[heart], color=base_color, atomic=False)
+        print(f"心形共 {result['voxels']} 个单元，使用 {result['total_added']} 个积木")
+        if result["skipped_voxels"]:
+            print(f"{result['skipped_voxels']} 个单元已被其他积木占据，已跳过")
+    except Exception as e:
+        print(f"添加心形失败: {str(e)}")
 
 if __name__ == "__main__":
     create_heart_shape(base_color="#FF69B4")  # 使用粉色心形
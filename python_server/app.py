@@ -1,11 +1,68 @@
+import asyncio
 import json
+import os
+import time
 import uuid
-from typing import Dict, List, Set
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set, Tuple, Union
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+import numpy as np
+from spatial_index import MAX_CELLS, SpatialGrid, brick_bounds
+from attribute_index import AttributeIndex, intersect
+from undo import Change, UndoHistory, inverse_changes
+from history import DeltaHistory, delta_size
+from brick_store import BrickStore, validate_brick
+from collision import EPSILON, LAYER_HEIGHT, MAX_BRICK_DIMENSION, brick_footprint, collides, describe, footprint_bounds, stack
+from connection import ClientConnection, OVERFLOW_DROP_OLDEST, OVERFLOW_RESYNC
+from cursors import CursorAggregator
+from rate_limit import InboundLimiter
+from heartbeat import RoomHeartbeat
+from persistence import create_persistence
+from lifecycle import ROOM_IDLE_SECONDS, RoomLifecycle, create_hibernation
+from broker import create_bus
+from wire import ENCODING_JSON, ENCODINGS, Frame, decode_message
+from shapes import SHAPE_MAX_BRICKS, blocked_cells, check_boxes, compose, merge_runs, rasterize, shape_box
+import metrics
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动持久化后台写入任务、房间总线和房间休眠检查，关闭时休眠内存中的房间并写出剩余的操作
+    await persistence.start()
+    bus.bind(
+        load=load_room,
+        install=create_room,
+        export=export_room,
+        apply=manager.apply_op,
+        # 其他进程转发的广播只有光标等可丢弃的瞬时消息
+        deliver=lambda room_id, message, exclude_user_id: manager.deliver(
+            room_id, message, exclude_user_id, droppable=True
+        )
+    )
+    await bus.start()
+    lifecycle.bind(
+        pinned=lambda room_id: room_id in manager.active_rooms,
+        memory=room_memory,
+        evict=hibernate_room
+    )
+    await lifecycle.start()
+    yield
+    await lifecycle.stop()
+    for room_id in list(rooms):
+        if bus.is_owner(room_id):
+            # 仍有连接的房间在关闭过程中可能继续被修改，休眠独立的副本
+            hibernation.save(room_id, {**room_snapshot(room_id), "bricks": room_stores[room_id].copy()})
+            if persistence.should_snapshot(room_id, force=True):
+                snapshot_room(room_id)
+    await bus.stop()
+    await hibernation.stop()
+    await persistence.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # 添加 CORS 中间件以允许前端访问
 app.add_middleware(
@@ -20,74 +77,487 @@ app.add_middleware(
 rooms: Dict[str, Dict] = {}
 # 储存每个房间的连接
 room_connections: Dict[str, Dict[str, WebSocket]] = {}
+# 储存每个房间的积木（列式存储，只在 API 边界渲染为 JSON 结构）
+room_stores: Dict[str, BrickStore] = {}
+# 储存每个房间的空间网格索引，用于快速碰撞检测
+room_indexes: Dict[str, SpatialGrid] = {}
+# 储存每个房间的属性索引（所在层 / 颜色 / 尺寸），用于查询接口和统计
+room_attributes: Dict[str, AttributeIndex] = {}
+# 储存每个房间的撤销历史（每个用户的撤销 / 重做栈）
+room_undo: Dict[str, UndoHistory] = {}
+# 通过 REST 接口进行的变更在撤销历史中的用户
+REST_AUTHOR = "api"
+# 储存每个房间内积木最近一次修改的 (版本号, 修改者)，用于检测基于旧版本的客户端变更是否冲突
+# （只记录房间加载后被修改过的积木，没有记录的积木视为未被修改）
+room_revisions: Dict[str, Dict[str, Tuple[int, str]]] = {}
+# 储存每个房间最近的增量消息（按版本号连续），用于重连客户端的增量同步
+room_histories: Dict[str, DeltaHistory] = {}
+# 分块发送房间状态时每块的积木数上限（客户端通过 chunk_size 查询参数请求分块）
+STATE_CHUNK_MAX = int(os.getenv("LEGO_STATE_CHUNK_MAX", "5000"))
+# 分块发送时发送队列中最多积压的消息数，超过后等待客户端接收
+STATE_CHUNK_BACKLOG = 2
+# 房间持久化后端（操作日志 + 压缩快照）
+persistence = create_persistence()
+# 房间总线：单进程模式下直接应用变更，多进程模式下通过 broker 保证各进程按相同顺序应用
+bus = create_bus()
+# 空闲房间的休眠存储（紧凑的二进制文件）
+hibernation = create_hibernation()
+# 内存中房间的生命周期管理（按最近活动时间淘汰空闲房间）
+lifecycle = RoomLifecycle()
+# 估算房间内存时每块积木在列数组之外的开销（uID 列表、索引字典和属性索引）、
+# 空间索引每个网格单元的开销、每条历史增量的开销（字节，tracemalloc 实测的近似值）
+BRICK_OVERHEAD_BYTES = 230
+INDEX_CELL_BYTES = 430
+HISTORY_ENTRY_BYTES = 1024
+# 历史增量中每块积木数据的开销（字节）
+HISTORY_BRICK_BYTES = 1500
+# 撤销历史中每块积木数据的开销（字节）
+UNDO_BRICK_BYTES = 1500
+# 每条积木修改记录的开销（字节）
+REVISION_BYTES = 200
 
 # 添加新的数据模型
 class BrickCoordinates(BaseModel):
     x: float
     y: float
     z: float
-    dimensions_x: int = 1
-    dimensions_z: int = 1
+    dimensions_x: int = Field(1, ge=1, le=MAX_BRICK_DIMENSION)
+    dimensions_z: int = Field(1, ge=1, le=MAX_BRICK_DIMENSION)
     color: str = "#ff0000"
     rotation: float = 0
     translation_x: float = 0
     translation_z: float = 0
 
+class BrickBatch(BaseModel):
+    bricks: List[BrickCoordinates]
+    # True: 任意积木碰撞则整批不提交；False: 逐个提交，跳过发生碰撞的积木
+    atomic: bool = True
+
+class ShapeSpec(BaseModel):
+    # 形状类型：box / sphere / polygon / heart / extrude / voxels（见 shapes.py）
+    type: str
+    # 位置（网格坐标，与 BrickCoordinates 相同）：box / extrude / voxels 为最小角，sphere / heart 为中心，polygon 只使用 y
+    x: float = 0
+    y: int = 0
+    z: float = 0
+    # box 的尺寸
+    size_x: int = 1
+    size_y: int = 1
+    size_z: int = 1
+    # sphere 的半径（单元），radius_y 为竖直方向的半径（层），默认按层高换算使球看起来是圆的
+    radius: float = 1
+    radius_y: Optional[float] = None
+    # polygon 的顶点 [[x, z], ...]
+    points: List[List[float]] = []
+    # heart 的宽度（单元）
+    size: float = 8
+    # 二维形状（polygon / heart / extrude）拉伸的层数
+    height: int = 1
+    # extrude 的二维位图 [z][x]、voxels 的三维体素数组 [y][z][x]，非 0 为实心
+    mask: List[List[int]] = []
+    voxels: List[List[List[int]]] = []
+    # 只保留外壳
+    hollow: bool = False
+    # 从之前的形状中挖去该形状
+    subtract: bool = False
+    # 颜色，默认使用 ShapeRequest.color
+    color: Optional[str] = None
+
+class ShapeRequest(BaseModel):
+    shapes: List[ShapeSpec]
+    color: str = "#ff0000"
+    # 合并后积木的最大尺寸（默认与前端积木库中最大的 4x2 积木一致）
+    max_dimensions_x: int = 4
+    max_dimensions_z: int = 2
+    # True: 任意体素被房间内已有积木占据则整个形状不添加；False: 跳过被占据的体素，添加其余部分
+    atomic: bool = False
+
+def create_room(room_id: str, stored: Optional[Dict] = None):
+    """
+    在内存中创建房间，stored 为从休眠文件或持久化存储加载、或从其他进程同步的状态
+    （stored["bricks"] 为积木列表或 BrickStore）
+    """
+    rooms[room_id] = {
+        "cursorColors": dict(stored.get("cursorColors", {})) if stored else {},
+        # 房间版本号，每次积木变更递增
+        "version": stored["version"] if stored else 0,
+        # 房间在内存中的实例标识，房间重新加载后历史记录不再连续，客户端需要重新获取完整状态
+        # （从其他进程同步时沿用对方的标识）
+        "epoch": (stored or {}).get("epoch") or uuid.uuid4().hex[:8]
+    }
+    room_histories[room_id] = DeltaHistory()
+    bricks = stored["bricks"] if stored else []
+    room_stores[room_id] = bricks if isinstance(bricks, BrickStore) else BrickStore.from_bricks(bricks)
+    room_indexes[room_id] = SpatialGrid()
+    room_indexes[room_id].rebuild(room_stores[room_id])
+    room_attributes[room_id] = AttributeIndex()
+    room_attributes[room_id].rebuild(room_stores[room_id])
+    room_undo[room_id] = UndoHistory()
+    room_revisions[room_id] = {
+        brick_id: tuple(revision) for brick_id, revision in (stored or {}).get("revisions", {}).items()
+    }
+    lifecycle.touch(room_id)
+
+
+def export_room(room_id: str) -> Dict:
+    """
+    导出房间的完整状态（同步给其他进程）
+    积木修改记录也需要同步，各进程应用变更时的冲突检测结果才能一致
+    """
+    room = rooms[room_id]
+    return {
+        "bricks": room_stores[room_id].to_list(),
+        "cursorColors": room["cursorColors"],
+        "version": room["version"],
+        "epoch": room["epoch"],
+        "revisions": room_revisions[room_id]
+    }
+
+
+def room_state_frame(room_id: str) -> Frame:
+    """
+    发送给单个连接的 ROOM_STATE 消息
+    积木直接引用房间的 BrickStore，入队时才按连接的编码序列化（二进制编码直接读取列数组），
+    因此帧必须在创建后立即入队，不能跨越 await 持有
+    """
+    room = rooms[room_id]
+    return Frame({"type": "ROOM_STATE", "data": {
+        "bricks": room_stores[room_id],
+        "cursorColors": room["cursorColors"],
+        "version": room["version"],
+        "epoch": room["epoch"]
+    }})
+
+
+def missed_deltas(room_id: str, since: int, epoch: Optional[str]) -> Optional[List[Dict]]:
+    """
+    返回版本号 since 之后的所有增量消息；历史记录无法覆盖（房间已重新加载或落后太多）、
+    或这些增量携带的积木比完整的房间状态还多时返回 None（改为发送完整的房间状态）
+    """
+    room = rooms[room_id]
+    if epoch != room["epoch"] or since > room["version"]:
+        return None
+    if since == room["version"]:
+        return []
+    deltas = room_histories[room_id].since(since)
+    if deltas is None or sum(delta_size(delta) for delta in deltas) > len(room_stores[room_id]):
+        return None
+    return deltas
+
+
+def snapshot_room(room_id: str):
+    """
+    写入房间的压缩快照，积木列在写入线程中才渲染为 JSON
+    """
+    persistence.snapshot(room_id, {"bricks": room_stores[room_id].copy(), "version": rooms[room_id]["version"]})
+
+
+def room_snapshot(room_id: str) -> Dict:
+    """
+    房间的休眠状态，积木直接引用房间的 BrickStore（房间随即从内存中移除，之后不会再被修改）
+    """
+    room = rooms[room_id]
+    return {"bricks": room_stores[room_id], "version": room["version"], "epoch": room["epoch"]}
+
+
+async def load_room(room_id: str) -> Optional[Dict]:
+    """
+    加载不在内存中的房间：优先从休眠文件恢复（保留房间实例标识），否则从持久化存储恢复（快照 + 日志尾部回放）
+    """
+    state = await hibernation.load(room_id)
+    if state is not None:
+        metrics.room_rehydrations.inc("hibernation")
+        return state
+    state = await persistence.load_room(room_id)
+    if state is not None:
+        metrics.room_rehydrations.inc("persistence")
+    return state
+
+
+async def ensure_room(room_id: str) -> Dict:
+    """
+    返回内存中的房间，不存在时通过房间总线加入：
+    从其他进程同步，或从休眠文件 / 持久化存储中恢复，或新建
+    """
+    if room_id not in rooms:
+        await bus.join(room_id)
+    lifecycle.touch(room_id)
+    return rooms[room_id]
+
+
+async def find_room(room_id: str) -> bool:
+    """
+    REST 接口使用：房间在本进程中存在、在其他进程中处于活跃状态，或已休眠 / 已持久化时返回 True
+    不在内存中的房间会被恢复
+    """
+    if room_id in rooms:
+        lifecycle.touch(room_id)
+        return True
+    if ((bus.distributed and await bus.lookup(room_id))
+            or hibernation.exists(room_id) or persistence.has_room(room_id)):
+        await ensure_room(room_id)
+        return True
+    return False
+
+
+def room_memory(room_id: str) -> int:
+    """
+    估算房间占用的内存（字节）：积木列数组、uID 索引、属性索引、空间索引、历史增量、撤销历史和积木修改记录
+    """
+    store = room_stores.get(room_id)
+    if store is None:
+        return 0
+    return (store.nbytes + len(store) * BRICK_OVERHEAD_BYTES
+            + len(room_indexes[room_id].cells) * INDEX_CELL_BYTES
+            + len(room_histories[room_id]) * HISTORY_ENTRY_BYTES + room_histories[room_id].size * HISTORY_BRICK_BYTES
+            + room_undo[room_id].size * UNDO_BRICK_BYTES
+            + len(room_revisions[room_id]) * REVISION_BYTES)
+
+
+async def hibernate_room(room_id: str):
+    """
+    休眠没有连接的房间：保存为休眠文件（由本进程负责持久化时）并从内存中移除
+    """
+    if room_id not in rooms or room_id in manager.active_rooms:
+        return
+    if bus.is_owner(room_id):
+        hibernation.save(room_id, room_snapshot(room_id))
+    metrics.room_hibernations.inc()
+    await unload_room(room_id)
+    print(f"房间 {room_id} 已休眠")
+
+
+async def unload_room(room_id: str):
+    """
+    从内存中移除房间，移除前写入压缩快照并离开房间总线
+    """
+    if room_id not in rooms:
+        return
+    if bus.is_owner(room_id) and persistence.should_snapshot(room_id, force=True):
+        snapshot_room(room_id)
+    lifecycle.forget(room_id)
+    del rooms[room_id]
+    room_stores.pop(room_id, None)
+    room_histories.pop(room_id, None)
+    room_indexes.pop(room_id, None)
+    room_attributes.pop(room_id, None)
+    room_undo.pop(room_id, None)
+    room_revisions.pop(room_id, None)
+    await bus.leave(room_id)
+
+
+def persist_deltas(room_id: str, deltas: List[Dict]):
+    """
+    将已应用的增量写入操作日志（异步批量落盘），累计足够多的操作后写一次压缩快照
+    多进程模式下只有负责该房间的进程写入
+    """
+    if not bus.is_owner(room_id):
+        return
+    for delta in deltas:
+        persistence.record(room_id, delta)
+    if deltas and persistence.should_snapshot(room_id):
+        snapshot_room(room_id)
+
+
+def next_version(room_id: str) -> int:
+    """
+    递增并返回房间版本号
+    """
+    rooms[room_id]["version"] += 1
+    return rooms[room_id]["version"]
+
+
+def diff_bricks(store: BrickStore, new_bricks: List[Dict]):
+    """
+    比较房间内的积木与一份完整的砖块列表，返回 (新增的积木, 删除的积木ID, 修改过的积木)
+    """
+    new_ids = {brick["uID"] for brick in new_bricks}
+    
+    added = [brick for brick in new_bricks if brick["uID"] not in store]
+    removed = [brick_id for brick_id in store.ids if brick_id not in new_ids]
+    updated = [
+        brick for brick in new_bricks
+        if brick["uID"] in store and store.get(brick["uID"]) != brick
+    ]
+    return added, removed, updated
+
+
+def apply_brick_changes(room_id: str, added: List[Dict] = None, removed: List[str] = None,
+                        updated: List[Dict] = None, author: str = REST_AUTHOR) -> Tuple[List[Dict], Change]:
+    """
+    将增量变更应用到房间状态、空间索引和属性索引，每条增量消息分配一个递增的房间版本号
+    被修改和新增的积木记录修改时的版本号和修改者（author）
+    返回 (需要广播的增量消息列表（BRICK_REMOVED / BRICK_UPDATED / BRICK_ADDED）, 撤销历史记录（见 undo.py）)
+    """
+    store = room_stores[room_id]
+    index = room_indexes[room_id]
+    attributes = room_attributes[room_id]
+    revisions = room_revisions[room_id]
+    deltas = []
+    change = {"added": [], "updated": [], "removed": []}
+    
+    # 删除积木（忽略不存在的ID，保持请求中的顺序并去重）
+    removed_ids = [brick_id for brick_id in dict.fromkeys(removed or []) if brick_id in store]
+    if removed_ids:
+        for brick_id in removed_ids:
+            index.remove(brick_id, store.bounds(brick_id))
+            attributes.remove(brick_id, store.attributes(brick_id))
+            change["removed"].append(store.remove(brick_id))
+            revisions.pop(brick_id, None)
+        deltas.append({"type": "BRICK_REMOVED", "data": {"version": next_version(room_id), "ids": removed_ids}})
+    
+    # 修改积木（只修改已存在的积木）
+    changed = {brick["uID"]: brick for brick in (updated or []) if brick["uID"] in store}
+    if changed:
+        for brick_id, brick in changed.items():
+            index.remove(brick_id, store.bounds(brick_id))
+            attributes.remove(brick_id, store.attributes(brick_id))
+            change["updated"].append((store.get(brick_id), brick))
+            store.update(brick)
+            index.insert(brick_id, store.bounds(brick_id))
+            attributes.insert(brick_id, store.attributes(brick_id))
+        deltas.append({"type": "BRICK_UPDATED", "data": {"version": next_version(room_id), "bricks": list(changed.values())}})
+        for brick_id in changed:
+            revisions[brick_id] = (rooms[room_id]["version"], author)
+    
+    # 新增积木（忽略已存在的ID，避免重复添加）
+    new_bricks = list({brick["uID"]: brick for brick in (added or []) if brick["uID"] not in store}.values())
+    if new_bricks:
+        for brick in new_bricks:
+            store.add(brick)
+            index.insert(brick["uID"], store.bounds(brick["uID"]))
+            attributes.insert(brick["uID"], store.attributes(brick["uID"]))
+        deltas.append({"type": "BRICK_ADDED", "data": {"version": next_version(room_id), "bricks": new_bricks}})
+        for brick in new_bricks:
+            revisions[brick["uID"]] = (rooms[room_id]["version"], author)
+        change["added"] = new_bricks
+    change["version"] = rooms[room_id]["version"]
+    
+    room_histories[room_id].extend(deltas)
+    persist_deltas(room_id, deltas)
+    return deltas, change
+
+
+def clear_bricks(room_id: str) -> Tuple[Dict, Change]:
+    """
+    清空房间内的所有积木，返回 (需要广播的 BRICKS_CLEARED 增量消息, 撤销历史记录)
+    """
+    # 撤销清空时需要恢复所有积木，记录中保存清空前的列式存储副本
+    change = {"added": [], "updated": [], "removed": room_stores[room_id].copy()}
+    room_stores[room_id].clear()
+    room_indexes[room_id].clear()
+    room_attributes[room_id].clear()
+    room_revisions[room_id].clear()
+    delta = {"type": "BRICKS_CLEARED", "data": {"version": next_version(room_id)}}
+    change["version"] = delta["data"]["version"]
+    room_histories[room_id].append(delta)
+    persist_deltas(room_id, [delta])
+    return delta, change
+
+
 class WebSocketManager:
     def __init__(self):
         # 保存活跃的房间
-        self.active_rooms: Dict[str, Dict[str, WebSocket]] = {}
+        self.active_rooms: Dict[str, Dict[str, ClientConnection]] = {}
         # 用户ID到房间ID的映射，方便快速查找
         self.user_room_map: Dict[str, str] = {}
+        # 每个房间的光标合并器
+        self.cursor_aggregators: Dict[str, CursorAggregator] = {}
+        # 每个房间的心跳任务（负责清理死亡和空闲连接）
+        self.heartbeats: Dict[str, RoomHeartbeat] = {}
+        # (房间ID, 客户端持久化用户ID) -> 当前会话的用户ID，重连时直接接管旧会话
+        self.sessions: Dict[Tuple[str, str], str] = {}
+        # 在后台断开慢速客户端的任务
+        self._drops: Set[asyncio.Task] = set()
 
-    async def connect(self, websocket: WebSocket, room_id: str, user_id: str, user_data: Dict):
+    async def connect(self, websocket: WebSocket, room_id: str, user_id: str, user_data: Dict,
+                      since: Optional[int] = None, epoch: Optional[str] = None,
+                      encoding: str = ENCODING_JSON, chunk_size: Optional[int] = None,
+                      viewpoint: Optional[Tuple[float, float, float]] = None):
         # 接受 WebSocket 连接
         await websocket.accept()
         
-        # 检查用户是否已在房间中（可能是重连）
-        existing_user_id = None
-        for uid, conn in self.active_rooms.get(room_id, {}).items():
-            try:
-                # 尝试发送心跳检测消息
-                await conn.send_text(json.dumps({"type": "PING"}))
-            except Exception:
-                # 如果发送失败，标记为需要替换的旧连接
-                existing_user_id = uid
-                break
+        # 创建房间（如果不存在则从其他进程同步或从持久化存储中恢复）
+        # 死亡连接由房间的心跳任务清理，重连的旧会话在收到 JOIN 时接管，加入房间无需遍历已有连接
+        await ensure_room(room_id)
+        self.active_rooms.setdefault(room_id, {})
+        if room_id not in self.cursor_aggregators:
+            self.cursor_aggregators[room_id] = CursorAggregator(room_id, self.broadcast)
+        if room_id not in self.heartbeats:
+            self.heartbeats[room_id] = RoomHeartbeat(
+                room_id, lambda: self.active_rooms.get(room_id, {}), self.evict
+            )
         
-        # 如果找到同一房间的相同或死亡连接，先移除
-        if existing_user_id:
-            print(f"替换房间 {room_id} 中的旧连接: {existing_user_id}")
-            await self.disconnect(existing_user_id)
+        # 更新房间中的光标颜色，并通知房间内其他用户有新用户加入
+        await self.commit(room_id, {
+            "type": "cursor_color",
+            "user_id": user_id,
+            "color": user_data.get("color", "#ff0000")
+        }, origin_user_id=user_id)
         
-        # 创建房间（如果不存在）
-        if room_id not in self.active_rooms:
-            self.active_rooms[room_id] = {}
-            rooms[room_id] = {
-                "bricks": [],
-                "cursorColors": {}
-            }
-        
-        # 保存用户连接
-        self.active_rooms[room_id][user_id] = websocket
+        # 保存用户连接（每个连接拥有独立的发送队列和写任务）
+        connection = ClientConnection(websocket, user_id, room_id, on_closed=self._on_connection_closed,
+                                      encoding=encoding)
+        self.active_rooms[room_id][user_id] = connection
         self.user_room_map[user_id] = room_id
         
-        # 更新房间中的光标颜色
-        if user_data and "color" in user_data:
-            rooms[room_id]["cursorColors"][user_id] = user_data.get("color")
-        
-        # 发送当前房间状态给新用户
-        await self.send_personal_message(
-            json.dumps({"type": "ROOM_STATE", "data": rooms[room_id]}),
-            websocket
+        # 重连的客户端携带上次同步的版本号：历史记录能覆盖时只发送错过的增量，否则发送完整的房间状态
+        deltas = missed_deltas(room_id, since, epoch) if since is not None else None
+        if deltas is not None:
+            room = rooms[room_id]
+            frame = Frame({"type": "ROOM_DELTAS", "data": {
+                "deltas": deltas,
+                "cursorColors": room["cursorColors"],
+                "version": room["version"],
+                "epoch": room["epoch"]
+            }})
+        elif chunk_size and len(room_stores[room_id]) > chunk_size:
+            # 大房间按客户端视点由近到远（或由下到上）分块发送，客户端可以边接收边渲染
+            await self.start_state_transfer(connection, min(chunk_size, STATE_CHUNK_MAX), viewpoint)
+            return
+        else:
+            frame = room_state_frame(room_id)
+        await self.send_personal_message(frame, connection)
+
+    async def start_state_transfer(self, connection: ClientConnection, chunk_size: int,
+                                   viewpoint: Optional[Tuple[float, float, float]]):
+        """
+        分块发送房间状态：ROOM_STATE_BEGIN、若干 ROOM_STATE_CHUNK、ROOM_STATE_END
+        积木快照和 BEGIN 消息在同一时刻（中间没有 await）生成并入队，之后的变更以增量消息排在 BEGIN 之后，
+        客户端在收到 END 之前缓存这些增量，收到 END 后再按顺序应用，因此传输过程中的变更不会丢失或重复
+        """
+        room_id = connection.room_id
+        room = rooms[room_id]
+        snapshot = room_stores[room_id].copy()
+        order = snapshot.spatial_order(viewpoint)
+        chunks = [order[start:start + chunk_size] for start in range(0, len(order), chunk_size)]
+        await self.send_personal_message(json.dumps({"type": "ROOM_STATE_BEGIN", "data": {
+            "total": len(snapshot),
+            "chunks": len(chunks),
+            "cursorColors": room["cursorColors"],
+            "version": room["version"],
+            "epoch": room["epoch"]
+        }}), connection)
+        connection.cancel_transfer()
+        connection.transfer = asyncio.create_task(
+            self._send_state_chunks(connection, snapshot, chunks, room["version"])
         )
-        
-        # 通知房间内其他用户有新用户加入
-        await self.broadcast(
-            room_id,
-            json.dumps({"type": "USER_JOINED", "data": {"id": user_id, "color": user_data.get("color", "#ff0000")}}),
-            exclude_user_id=user_id
+
+    async def _send_state_chunks(self, connection: ClientConnection, snapshot: BrickStore,
+                                 chunks: List, version: int):
+        for index, ordinals in enumerate(chunks):
+            # 等待客户端接收已入队的分块，并在每块之间让出事件循环
+            await connection.wait_drained(STATE_CHUNK_BACKLOG)
+            if connection.closed:
+                return
+            await self.send_personal_message(Frame({"type": "ROOM_STATE_CHUNK", "data": {
+                "index": index, "bricks": snapshot.take(ordinals)
+            }}), connection)
+            await asyncio.sleep(0)
+        await self.send_personal_message(
+            json.dumps({"type": "ROOM_STATE_END", "data": {"version": version}}), connection
         )
+        connection.transfer = None
 
     async def disconnect(self, user_id: str):
         room_id = self.user_room_map.get(user_id)
@@ -96,147 +566,482 @@ class WebSocketManager:
         
         # 从房间中移除用户连接
         if room_id in self.active_rooms and user_id in self.active_rooms[room_id]:
-            del self.active_rooms[room_id][user_id]
+            connection = self.active_rooms[room_id].pop(user_id)
+            await connection.close()
+            if connection.client_id and self.sessions.get((room_id, connection.client_id)) == user_id:
+                del self.sessions[(room_id, connection.client_id)]
             print(f"用户 {user_id} 已从房间 {room_id} 中断开连接")
         
         # 从用户-房间映射中移除
         if user_id in self.user_room_map:
             del self.user_room_map[user_id]
         
-        # 从房间状态中移除用户光标颜色
-        if (room_id in rooms and 
-            "cursorColors" in rooms[room_id] and 
-            user_id in rooms[room_id]["cursorColors"]):
-            del rooms[room_id]["cursorColors"][user_id]
-            
-            # 通知房间内其他用户该用户已离开
-            await self.broadcast(
-                room_id,
-                json.dumps({"type": "USER_LEFT", "data": {"id": user_id}}),
-            )
+        if room_id in self.cursor_aggregators:
+            self.cursor_aggregators[room_id].remove_user(user_id)
+        
+        # 从房间状态中移除用户光标颜色，并通知房间内其他用户该用户已离开
+        if room_id in rooms and user_id in rooms[room_id]["cursorColors"]:
+            await self.commit(room_id, {"type": "cursor_left", "user_id": user_id})
         
-        # 如果房间为空，清理房间
+        # 如果房间为空，停止房间的后台任务；房间保留在内存中，空闲超时或超出内存预算时再休眠
         if room_id in self.active_rooms and not self.active_rooms[room_id]:
             del self.active_rooms[room_id]
+            aggregator = self.cursor_aggregators.pop(room_id, None)
+            if aggregator:
+                await aggregator.close()
+            heartbeat = self.heartbeats.pop(room_id, None)
+            if heartbeat:
+                await heartbeat.close()
             if room_id in rooms:
-                del rooms[room_id]
-                print(f"房间 {room_id} 已清理（无用户）")
+                lifecycle.touch(room_id)
+                if not ROOM_IDLE_SECONDS:
+                    await hibernate_room(room_id)
+
+    async def commit(self, room_id: str, op: Dict, origin_user_id: str = None) -> List[Dict]:
+        """
+        提交一条房间状态变更，返回应用后产生的消息
+        变更经由房间总线排序后在每个进程中应用，并投递给各进程内除发起者外的用户
+        """
+        return await bus.submit(room_id, {**op, "origin": origin_user_id})
+
+    async def apply_op(self, room_id: str, op: Dict) -> List[Dict]:
+        """
+        应用一条已排序的房间状态变更（由房间总线调用），并投递给本进程内除发起者外的用户
+        房间总线为每个房间的变更排定唯一的顺序，所有写入（WebSocket 和 REST）在这里逐条串行应用：
+        op["validate"] 为真的积木变更在应用时才变基到房间的当前状态（基于 op["base_version"]，见 rebase_brick_changes）
+        并检测碰撞，校验与应用之间不会插入其他变更，各进程的校验结果也相同；
+        op["atomic"] 为真时任意积木被拒绝则整个变更不应用；
+        op["ack"] 为确认消息类型时，由发起者所在的进程向发起者发送确认消息和撤销被拒绝的本地变更的增量
+        积木变更同时记录到变更者（op["author"]，REST 接口为 REST_AUTHOR）的撤销历史中，
+        撤销 / 重做（op["undo"] 为 "undo" / "redo"，op["target"] 为被回退记录的版本号）时移除被回退的记录，
+        实际回退的变更放入对应的重做 / 撤销栈
+        """
+        if room_id not in rooms:
+            return []
+        
+        op_type = op["type"]
+        room = rooms[room_id]
+        author = op.get("author") or REST_AUTHOR
+        lifecycle.touch(room_id)
+        messages = []
+        if op_type == "changes":
+            added, removed, updated = op.get("added") or [], op.get("removed") or [], op.get("updated") or []
+            rejected, conflicts = [], []
+            if op.get("validate"):
+                added, removed, updated, conflicts = rebase_brick_changes(
+                    room_id, added, removed, updated, op.get("base_version"), author
+                )
+                with metrics.collision_check_seconds.time("apply"):
+                    added, updated, rejected = validate_brick_changes(room_id, added, updated, removed)
+                # 提交前已被拒绝的不合法积木（见 submit_brick_changes）
+                rejected = (op.get("invalid") or []) + rejected
+                if op.get("atomic") and (rejected or conflicts):
+                    added, removed, updated = [], [], []
+            messages, change = apply_brick_changes(room_id, added, removed, updated, author)
+            if op.get("ack"):
+                await self.acknowledge(room_id, op.get("origin"), op["ack"], rejected, conflicts)
+            if op.get("undo"):
+                room_undo[room_id].settle(author, op["target"], change, redo=op["undo"] == "redo")
+            else:
+                room_undo[room_id].record(author, change)
+        elif op_type == "clear":
+            delta, change = clear_bricks(room_id)
+            room_undo[room_id].record(author, change)
+            messages = [delta]
+        elif op_type == "cursor_color":
+            room["cursorColors"][op["user_id"]] = op["color"]
+            messages = [{"type": "USER_JOINED", "data": {"id": op["user_id"], "color": op["color"]}}]
+        elif op_type == "cursor_left":
+            if room["cursorColors"].pop(op["user_id"], None) is not None:
+                messages = [{"type": "USER_LEFT", "data": {"id": op["user_id"]}}]
+        elif op_type == "cursor_colors":
+            room["cursorColors"].update(op["colors"])
+            messages = [{"type": "UPDATE_CURSORS", "data": op["colors"]}]
+        
+        for message in messages:
+            await self.deliver(room_id, Frame(message), exclude_user_id=op.get("origin"))
+        return messages
 
     async def broadcast(self, room_id: str, message: str, exclude_user_id: str = None):
+        # 投递给本进程内的用户，并通过房间总线转发给其他进程中的用户（只用于光标等可丢弃的瞬时消息）
+        await self.deliver(room_id, message, exclude_user_id=exclude_user_id, droppable=True)
+        await bus.relay(room_id, message, exclude_user_id=exclude_user_id)
+
+    async def deliver(self, room_id: str, message: Union[str, Frame], exclude_user_id: str = None,
+                      droppable: bool = False):
         if room_id not in self.active_rooms:
             return
         
-        # 给房间内所有用户发送消息，除了可能被排除的用户
-        print(f"active_rooms: {self.active_rooms}")
+        # 消息按每种编码只序列化一次，同一份数据放入房间内每个连接的发送队列，除了可能被排除的用户
+        started = time.perf_counter()
+        frame = message if isinstance(message, Frame) else Frame(text=message)
+        overflowed = []
+        recipients = 0
         for uid, connection in self.active_rooms[room_id].items():
             if exclude_user_id and uid == exclude_user_id:
                 continue
-            await self.send_personal_message(message, connection)
+            recipients += 1
+            if not connection.enqueue(frame.payload(connection.encoding), droppable):
+                overflowed.append(connection)
+        metrics.broadcast_seconds.observe(time.perf_counter() - started)
+        metrics.broadcast_recipients.inc(amount=recipients)
+        
+        # 发送队列溢出的慢速客户端按策略重新同步或断开
+        for connection in overflowed:
+            await self.handle_overflow(connection)
+
+    async def send_personal_message(self, message: Union[str, Frame], connection: ClientConnection):
+        if isinstance(message, Frame):
+            message = message.payload(connection.encoding)
+        if not connection.enqueue(message):
+            await self.handle_overflow(connection)
+
+    async def handle_overflow(self, connection: ClientConnection):
+        room_id = connection.room_id
+        metrics.queue_overflows.inc(connection.overflow_policy)
+        if connection.overflow_policy in (OVERFLOW_RESYNC, OVERFLOW_DROP_OLDEST) and room_id in rooms:
+            # 丢弃积压的消息，合并为一份最新的房间状态（drop_oldest 策略下不可丢弃的积木增量溢出时也是如此）
+            print(f"用户 {connection.user_id} 发送队列已满，重新同步房间 {room_id} 状态")
+            connection.cancel_transfer()
+            connection.reset(room_state_frame(room_id).payload(connection.encoding))
+            return
+        
+        print(f"用户 {connection.user_id} 发送队列已满，断开连接")
+        # 溢出可能发生在房间总线应用变更的过程中（apply_op -> deliver），断开连接需要提交 cursor_left，
+        # 多进程模式下在 apply 中等待提交会使总线死锁，因此在独立的任务中断开；之后的消息不再进入队列
+        connection.closed = True
+        task = asyncio.create_task(self._drop(connection))
+        self._drops.add(task)
+        task.add_done_callback(self._drops.discard)
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        # 检查 websocket 是否还处于活跃状态
+    async def _drop(self, connection: ClientConnection):
+        await self.disconnect(connection.user_id)
         try:
-            await websocket.send_text(message)
-        except RuntimeError as e:
-            print(f"无法发送消息: {e}")
-            # 查找并移除此连接
-            user_to_remove = None
-            room_to_check = None
-            
-            for room_id, connections in list(self.active_rooms.items()):
-                for uid, conn in connections.items():
-                    if conn == websocket:
-                        user_to_remove = uid
-                        room_to_check = room_id
-                        break
-                if user_to_remove:
-                    break
-            
-            if user_to_remove and room_to_check:
-                print(f"移除失效连接: {user_to_remove} 从房间 {room_to_check}")
-                await self.disconnect(user_to_remove)
+            await connection.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def evict(self, connection: ClientConnection, reason: str, code: int = 1001):
+        """
+        主动移除连接并关闭 WebSocket（心跳超时、空闲或被同一用户的新会话接管）
+        """
+        if self.active_rooms.get(connection.room_id, {}).get(connection.user_id) is not connection:
+            return
+        print(f"移除连接 {connection.user_id}（{reason}）从房间 {connection.room_id}")
+        await self.disconnect(connection.user_id)
+        try:
+            await connection.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    async def reject_message(self, user_id: str, limiter: InboundLimiter, reason: str, size: int) -> bool:
+        """
+        处理超出入站限制而被丢弃的消息：计入指标，一轮连续违规中的第一条消息向客户端回复 ERROR，
+        累计违规过多时断开连接（关闭码 1008），返回连接是否仍然保留
+        """
+        metrics.ws_limited_messages.inc(reason)
+        room_id = self.user_room_map.get(user_id)
+        connection = self.active_rooms.get(room_id, {}).get(user_id)
+        if connection is None:
+            return True
+        if not limiter.violate():
+            metrics.ws_limit_disconnects.inc()
+            await self.evict(connection, "消息速率或大小多次超出限制", code=1008)
+            return False
+        if not limiter.notified:
+            limiter.notified = True
+            await self.send_personal_message(
+                json.dumps({"type": "ERROR", "data": limiter.describe(reason, size)}), connection
+            )
+        return True
+
+    async def claim_session(self, room_id: str, user_id: str, client_id: str):
+        """
+        将连接绑定到客户端的持久化用户ID；该用户在房间内已有旧会话时直接移除旧会话（O(1)）
+        """
+        connection = self.active_rooms.get(room_id, {}).get(user_id)
+        if connection is None:
+            return
+        key = (room_id, client_id)
+        previous_user_id = self.sessions.get(key)
+        if previous_user_id and previous_user_id != user_id:
+            previous = self.active_rooms.get(room_id, {}).get(previous_user_id)
+            if previous is not None:
+                # 4000: 会话已被接管，客户端收到后不应自动重连
+                await self.evict(previous, "会话已被新连接接管", code=4000)
+        connection.client_id = client_id
+        self.sessions[key] = user_id
 
-    async def handle_message(self, message_text: str, user_id: str):
+    async def submit_brick_changes(self, room_id: str, user_id: str, ack_type: str,
+                                   added: List[Dict] = None, removed: List[str] = None,
+                                   updated: List[Dict] = None, base_version: Optional[int] = None):
+        """
+        提交客户端发送的积木变更（base_version 为客户端做出变更时所见的房间版本），只向其他用户广播增量
+        变更在应用时变基并检测碰撞（见 apply_op）：与其他用户在 base_version 之后的修改冲突、
+        或与其他积木碰撞的积木被拒绝，确认消息中列出这些积木，并向发送者发送撤销对应本地变更的增量
+        """
+        # 格式错误的变更在提交前抛出异常（由 handle_message 处理），不会进入房间总线
+        for brick in (added or []) + (updated or []):
+            if not isinstance(brick, dict) or not isinstance(brick.get("uID"), str):
+                raise ValueError(f"积木缺少 uID: {brick}")
+        if not all(isinstance(brick_id, str) for brick_id in removed or []):
+            raise ValueError("删除的积木ID必须为字符串")
+        if not isinstance(base_version, int):
+            base_version = None
+        # 字段类型或尺寸不合法、无法写入房间的积木在提交前拒绝，与碰撞的积木一样在确认消息中列出并撤销
+        invalid = []
+        
+        def acceptable(brick: Dict) -> bool:
+            try:
+                validate_brick(brick)
+                brick_footprint(brick)
+                return True
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"拒绝不合法的积木: {e}")
+                invalid.append(brick["uID"])
+                return False
+        
+        added = [brick for brick in added or [] if acceptable(brick)]
+        updated = [brick for brick in updated or [] if acceptable(brick)]
+        if invalid and not (added or removed or updated):
+            # 没有需要提交的变更，直接确认并撤销客户端的本地变更
+            await self.acknowledge(room_id, user_id, ack_type, invalid, [])
+            return
+        if not (added or removed or updated):
+            connection = self.active_rooms.get(room_id, {}).get(user_id)
+            if connection is not None:
+                await self.send_personal_message(json.dumps({
+                    "type": ack_type, "data": {"status": "success", "version": rooms[room_id]["version"]}
+                }), connection)
+            return
+        await self.commit(room_id, {
+            "type": "changes", "added": added or [], "removed": removed or [], "updated": updated or [],
+            "author": self.author_of(room_id, user_id), "base_version": base_version,
+            "validate": True, "ack": ack_type, "invalid": invalid
+        }, origin_user_id=user_id)
+
+    async def acknowledge(self, room_id: str, user_id: Optional[str], ack_type: str,
+                          rejected: List[str], conflicts: List[str]):
+        """
+        在积木变更应用后向发起者（在本进程中时）发送确认消息（携带最新版本号和被拒绝的积木），
+        并按房间的当前状态恢复被拒绝的积木：已不存在的积木发送删除，仍存在的积木发送其当前状态
+        （以 BRICK_ADDED 发送，被拒绝的删除也能在客户端恢复）
+        """
+        connection = self.active_rooms.get(room_id, {}).get(user_id)
+        if connection is None:
+            return
+        version = rooms[room_id]["version"]
+        ack = {"status": "partial" if rejected or conflicts else "success", "version": version}
+        if rejected:
+            ack["rejected"] = rejected
+        if conflicts:
+            ack["conflicts"] = conflicts
+        await self.send_personal_message(json.dumps({"type": ack_type, "data": ack}), connection)
+        
+        store = room_stores[room_id]
+        reverted = list(dict.fromkeys(rejected + conflicts))
+        reverted_ids = [brick_id for brick_id in reverted if brick_id not in store]
+        reverted_bricks = [store.get(brick_id) for brick_id in reverted if brick_id in store]
+        if reverted_ids:
+            await self.send_personal_message(json.dumps(
+                {"type": "BRICK_REMOVED", "data": {"ids": reverted_ids, "version": version}}
+            ), connection)
+        if reverted_bricks:
+            await self.send_personal_message(Frame(
+                {"type": "BRICK_ADDED", "data": {"bricks": reverted_bricks, "version": version}}
+            ), connection)
+
+    async def submit_undo(self, room_id: str, author: str, redo: bool = False) -> Tuple[List[Dict], Dict]:
+        """
+        撤销（或重做）用户最近的一次变更，返回 (广播的增量消息列表, 结果)
+        在发起者所在的进程中根据撤销历史计算回退需要的变更：只回退仍保持该次变更结果、
+        且恢复后不与其他积木碰撞的积木，其余积木列入结果的 skipped；之后与普通变更一样经房间总线提交，
+        各进程应用时从撤销历史中移除该记录
+        """
+        change = room_undo[room_id].peek(author, redo=redo)
+        if change is None:
+            return [], {"status": "empty", "version": rooms[room_id]["version"], "skipped": []}
+        
+        inverse = inverse_changes(change, room_stores[room_id])
+        added, updated, rejected = validate_brick_changes(room_id, inverse["added"], inverse["updated"], inverse["removed"])
+        # 即使没有可以回退的积木也需要提交，以便各进程从撤销历史中移除该记录
+        # 发起者本地没有这些变更，不排除发起者，增量投递给房间内的所有用户
+        # 多进程模式下其他进程的变更可能排在前面，应用时再次检测碰撞
+        messages = await self.commit(room_id, {
+            "type": "changes", "added": added, "removed": inverse["removed"], "updated": updated,
+            "author": author, "undo": "redo" if redo else "undo", "target": change["version"],
+            "validate": bus.distributed
+        })
+        
+        skipped = inverse["skipped"] + rejected
+        return messages, {
+            "status": "partial" if skipped and messages else ("conflict" if skipped else "success"),
+            "version": rooms[room_id]["version"] if room_id in rooms else 0,
+            "skipped": skipped
+        }
+
+    def author_of(self, room_id: str, user_id: str) -> str:
+        """
+        撤销历史中的用户：优先使用客户端的持久化用户ID，重连后仍然可以撤销之前的操作
+        """
+        connection = self.active_rooms.get(room_id, {}).get(user_id)
+        return (connection.client_id if connection is not None else None) or user_id
+
+    async def _on_connection_closed(self, connection: ClientConnection):
+        # 写任务发送失败，移除此连接（只移除仍在房间中的同一连接）
+        if self.active_rooms.get(connection.room_id, {}).get(connection.user_id) is connection:
+            print(f"移除失效连接: {connection.user_id} 从房间 {connection.room_id}")
+            await self.disconnect(connection.user_id)
+
+    async def handle_message(self, message_text: Union[str, bytes], user_id: str):
+        started = time.perf_counter()
+        # 指标的消息类型标签只使用已知类型，避免客户端发送任意类型导致标签无限增长
+        label = "invalid"
         try:
-            message = json.loads(message_text)
+            # 使用二进制编码的连接也可以发送二进制消息（格式见 wire.py）
+            if isinstance(message_text, bytes):
+                message = decode_message(message_text)
+            else:
+                message = json.loads(message_text)
+            message_type = message.get("type")
+            data = message.get("data")
+            label = message_type if message_type in MESSAGE_TYPES else "other"
             room_id = self.user_room_map.get(user_id)
             
             if not room_id or room_id not in rooms:
                 return
             
-            message_type = message.get("type")
-            data = message.get("data")
+            connection = self.active_rooms.get(room_id, {}).get(user_id)
+            if connection is not None:
+                # 记录最近收到消息的时间，供心跳任务判断连接是否存活或空闲
+                connection.touch(active=message_type != "PONG")
             
-            if message_type == "UPDATE_BRICKS":
-                # 更新砖块数据
-                rooms[room_id]["bricks"] = data
-                # 向发送者发送确认消息
-                await self.send_personal_message(
-                    json.dumps({"type": "BRICK_ADDED", "data": {"status": "success"}}),
-                    self.active_rooms[room_id][user_id]
-                )
-                # 广播给其他用户
-                await self.broadcast(
-                    room_id,
-                    json.dumps({"type": "UPDATE_BRICKS", "data": data}),
-                    exclude_user_id=user_id
-                )
+            if message_type == "PONG":
+                # 心跳回复，只需更新时间
+                return
+            elif message_type == "JOIN":
+                # 客户端携带持久化的用户ID加入，接管该用户之前的会话
+                client_id = (data or {}).get("id")
+                if client_id:
+                    await self.claim_session(room_id, user_id, client_id)
+            elif message_type == "UPDATE_BRICKS":
+                # 兼容旧客户端：将完整的砖块数组与当前状态比较，转换为增量变更
+                # （携带 base_version 时，数组中缺少的、其他用户在该版本之后添加的积木不会被删除）
+                added, removed, updated = diff_bricks(room_stores[room_id], data or [])
+                await self.submit_brick_changes(room_id, user_id, "BRICK_ADDED", added, removed, updated,
+                                                base_version=message.get("base_version"))
+            elif message_type in ("BRICK_ADDED", "BRICK_REMOVED", "BRICK_UPDATED"):
+                # 客户端直接发送的增量变更，base_version 为客户端做出变更时所见的房间版本
+                base_version = message.get("base_version")
+                if message_type == "BRICK_ADDED":
+                    await self.submit_brick_changes(room_id, user_id, message_type, added=data.get("bricks", []),
+                                                    base_version=base_version)
+                elif message_type == "BRICK_REMOVED":
+                    await self.submit_brick_changes(room_id, user_id, message_type, removed=data.get("ids", []),
+                                                    base_version=base_version)
+                else:
+                    await self.submit_brick_changes(room_id, user_id, message_type, updated=data.get("bricks", []),
+                                                    base_version=base_version)
             elif message_type == "CLEAR_BRICKS":
-                # 清空砖块数据
-                rooms[room_id]["bricks"] = []
+                # 清空砖块数据，广播给其他用户
+                messages = await self.commit(room_id, {
+                    "type": "clear", "author": self.author_of(room_id, user_id)
+                }, origin_user_id=user_id)
                 # 向发送者发送确认消息
                 await self.send_personal_message(
-                    json.dumps({"type": "BRICKS_CLEARED", "data": {"status": "success"}}),
+                    json.dumps({"type": "BRICKS_CLEARED", "data": {"status": "success", "version": messages[0]["data"]["version"]}}),
                     self.active_rooms[room_id][user_id]
                 )
-                # 广播给其他用户
-                await self.broadcast(
-                    room_id,
-                    json.dumps({"type": "UPDATE_BRICKS", "data": []}),
-                    exclude_user_id=user_id
-                )
+            elif message_type in ("UNDO", "REDO"):
+                # 撤销 / 重做自己最近的变更，房间内所有用户（包括发送者）只收到回退产生的增量
+                _, result = await self.submit_undo(room_id, self.author_of(room_id, user_id), redo=message_type == "REDO")
+                # 向发送者发送结果（status / version / 被跳过的积木）
+                connection = self.active_rooms.get(room_id, {}).get(user_id)
+                if connection is not None:
+                    await self.send_personal_message(json.dumps({"type": message_type, "data": result}), connection)
             elif message_type == "UPDATE_SELF":
                 # 更新用户信息
                 user_color = data.get("color")
                 if user_color:
-                    rooms[room_id]["cursorColors"][user_id] = user_color
-                    await self.broadcast(
-                        room_id,
-                        json.dumps({"type": "USER_JOINED", "data": {"id": user_id, "color": user_color}}),
-                        exclude_user_id=user_id
-                    )
+                    await self.commit(room_id, {
+                        "type": "cursor_color", "user_id": user_id, "color": user_color
+                    }, origin_user_id=user_id)
             elif message_type == "UPDATE_CURSORS":
                 # 更新光标颜色
-                rooms[room_id]["cursorColors"].update(data)
-                await self.broadcast(
-                    room_id,
-                    json.dumps({"type": "UPDATE_CURSORS", "data": data}),
-                    exclude_user_id=user_id
-                )
+                await self.commit(room_id, {"type": "cursor_colors", "colors": data}, origin_user_id=user_id)
             elif message_type == "USER_CURSOR":
-                # 转发光标位置信息
-                await self.broadcast(
-                    room_id,
-                    json.dumps({"type": "USER_CURSOR", "data": data}),
-                    exclude_user_id=user_id
-                )
+                # 只记录最新的光标位置，由光标合并器按固定频率合并广播（超出限流的消息被丢弃）
+                self.cursor_aggregators[room_id].update(user_id, data)
                 
         except json.JSONDecodeError:
+            metrics.ws_message_errors.inc("invalid_json")
             print(f"Invalid JSON message: {message_text}")
         except Exception as e:
+            metrics.ws_message_errors.inc("exception")
             print(f"Error handling message: {str(e)}")
+        finally:
+            metrics.ws_messages.inc(label)
+            metrics.ws_message_seconds.observe(time.perf_counter() - started, label)
 
 
 # 创建 WebSocket 管理器实例
 manager = WebSocketManager()
 
+# 客户端可能发送的消息类型（指标标签）
+MESSAGE_TYPES = {
+    "PONG", "JOIN", "UPDATE_BRICKS", "BRICK_ADDED", "BRICK_REMOVED", "BRICK_UPDATED",
+    "CLEAR_BRICKS", "UNDO", "REDO", "UPDATE_SELF", "UPDATE_CURSORS", "USER_CURSOR"
+}
+
+
+def send_queue_depths() -> List[int]:
+    return [connection.queue_depth for room in manager.active_rooms.values() for connection in room.values()]
+
+
+# 状态类指标在抓取时计算，不增加热路径的开销
+metrics.Gauge("lego_rooms", "内存中的房间数", collect=lambda: len(rooms))
+metrics.Gauge("lego_active_rooms", "有连接的房间数", collect=lambda: len(manager.active_rooms))
+metrics.Gauge("lego_connections", "WebSocket 连接数",
+              collect=lambda: sum(len(room) for room in manager.active_rooms.values()))
+metrics.Gauge("lego_room_memory_bytes", "内存中所有房间的估算内存（字节）",
+              collect=lambda: sum(room_memory(room_id) for room_id in rooms))
+metrics.Gauge("lego_room_bricks", "房间内的积木数", ("room",),
+              collect=lambda: {(room_id,): len(store) for room_id, store in room_stores.items()})
+metrics.Gauge("lego_send_queue_depth_total", "所有连接发送队列中的消息总数",
+              collect=lambda: sum(send_queue_depths()))
+metrics.Gauge("lego_send_queue_depth_max", "单个连接发送队列中的最大消息数",
+              collect=lambda: max(send_queue_depths(), default=0))
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus 文本格式的运行指标
+    """
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/")
 async def get():
     return {"message": "Lego Builder WebSocket Server"}
 
 
+def parse_viewpoint(view: Optional[str]) -> Optional[Tuple[float, float, float]]:
+    """
+    解析 view 查询参数（x,y,z），格式不正确时返回 None
+    """
+    if not view:
+        return None
+    try:
+        x, y, z = (float(value) for value in view.split(","))
+    except ValueError:
+        return None
+    return x, y, z
+
+
 @app.websocket("/ws/{room_id}")
-async def websocket_endpoint(websocket: WebSocket, room_id: str):
+async def websocket_endpoint(websocket: WebSocket, room_id: str, since: Optional[int] = None,
+                             epoch: Optional[str] = None, encoding: str = ENCODING_JSON,
+                             chunk_size: Optional[int] = None, view: Optional[str] = None):
     # 生成唯一用户ID
     user_id = str(uuid.uuid4())
     
@@ -244,13 +1049,34 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str):
     user_data = {"color": "#" + "%06x" % (hash(user_id) % 0xFFFFFF)}
     
     # 连接
-    await manager.connect(websocket, room_id, user_id, user_data)
+    # 重连时客户端通过 since / epoch 查询参数携带上次同步到的房间版本
+    # 客户端通过 encoding 查询参数选择消息编码（json / binary），未知的编码按 json 处理
+    if encoding not in ENCODINGS:
+        encoding = ENCODING_JSON
+    # 大房间可通过 chunk_size 请求分块发送房间状态，view=x,y,z 为客户端视点（省略时由下到上发送）
+    viewpoint = parse_viewpoint(view)
+    await manager.connect(websocket, room_id, user_id, user_data, since=since, epoch=epoch, encoding=encoding,
+                          chunk_size=chunk_size if chunk_size and chunk_size > 0 else None, viewpoint=viewpoint)
+    # 入站限制（单条消息大小、每秒消息数、每秒字节数），超出的消息在解析前丢弃，
+    # 单个客户端无法用大量或过大的消息长时间占用事件循环
+    limiter = InboundLimiter()
     
     try:
         while True:
-            # 等待接收消息
-            message = await websocket.receive_text()
-            await manager.handle_message(message, user_id)
+            # 等待接收消息（文本或二进制）
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            text = message.get("text")
+            payload = text if text is not None else message.get("bytes") or b""
+            # 按 UTF-8 编码后的字节数计，多字节字符不会绕过大小和流量限制
+            size = len(text.encode("utf-8")) if text is not None else len(payload)
+            reason = limiter.check(size)
+            if reason is not None:
+                if not await manager.reject_message(user_id, limiter, reason, size):
+                    return
+                continue
+            await manager.handle_message(payload, user_id)
     except WebSocketDisconnect:
         # 处理断开连接
         await manager.disconnect(user_id)
@@ -259,23 +1085,19 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str):
         await manager.disconnect(user_id)
 
 
-@app.post("/api/bricks/add")
-async def add_brick(room_id: str, brick: BrickCoordinates):
+def build_brick_data(brick: BrickCoordinates) -> Dict:
     """
-    通过坐标添加积木到指定房间
+    将坐标请求转换为前端使用的积木数据结构
     """
-    if room_id not in rooms:
-        raise HTTPException(status_code=404, detail="Room not found")
-    
-    # 创建积木数据
-    brick_data = {
+    return {
         "intersect": {
             "point": {  
                 #针对坐标系进行初步标准化，将坐标定位在网格上。
                 #例如：想在前端网格(0,0,0)位置添加积木，则brick.x=0,brick.y=0,brick.z=0，
-                #此时对应网格实际坐标为(12.5,0,12.5)
+                #此时对应网格实际坐标为(12.5,LAYER_HEIGHT/2,12.5)
+                #y 取第 brick.y 层的中间高度（层高与前端渲染和碰撞检测相同），所在层即为 brick.y
                 "x": -(12.5+(-brick.x-1)*25),
-                "y": brick.y*35,
+                "y": (brick.y+0.5)*LAYER_HEIGHT,
                 "z": -(12.5+(brick.z-1)*25)
             },
             "face": {
@@ -298,82 +1120,519 @@ async def add_brick(room_id: str, brick: BrickCoordinates):
             "z": brick.translation_z
         }
     }
+
+
+@app.post("/api/bricks/add")
+async def add_brick(room_id: str, brick: BrickCoordinates, debug: bool = False):
+    """
+    通过坐标添加积木到指定房间
+    debug 为 true 时，发生碰撞的响应中附带这一对积木的碰撞检测调试信息
+    """
+    if not await find_room(room_id):
+        raise HTTPException(status_code=404, detail="Room not found")
     
-    # 检查与现有积木的碰撞
-    collision_detected = False
-    collision_with = None
-    debug_info = []
-    
-    for existing_brick in rooms[room_id]["bricks"]:
-        collision_result = check_collision(brick_data, existing_brick)
-        debug_info.append(collision_result["debug_info"])  # 收集所有碰撞检测的调试信息
-        if collision_result["collision"]:
-            collision_detected = True
-            collision_with = existing_brick["uID"]
-            break
+    # 创建积木数据
+    brick_data = build_brick_data(brick)
     
-    if collision_detected:
-        # 如果发生碰撞，返回错误信息和调试信息
-        return {
+    # 检查与现有积木的碰撞（只检查空间索引中占据相同网格单元的积木）
+    store = room_stores[room_id]
+    with metrics.collision_check_seconds.time("add"):
+        collision_with = find_collision(brick_data, store, room_indexes[room_id])
+    
+    if collision_with is None:
+        # 如果没有碰撞，更新房间中的积木数据，只向房间内所有用户广播新增的积木
+        # 多进程模式下房间总线中排在前面的其他变更可能已经占据了该位置，应用时再次检测
+        # （单进程模式下检测与应用之间没有 await，无需再次检测）
+        messages = await manager.commit(room_id, {"type": "changes", "added": [brick_data], "validate": bus.distributed})
+        if messages:
+            return {
+                "status": "success",
+                "data": brick_data
+            }
+        store = room_stores[room_id]
+        collision_with = find_collision(brick_data, store, room_indexes[room_id])
+    
+    if collision_with is not None:
+        # 如果发生碰撞，返回错误信息
+        result = {
             "status": "error", 
             "message": f"碰撞检测失败: 新积木与ID为 {collision_with} 的积木发生碰撞",
-            "collision_with": collision_with,
-            "debug_info": debug_info
+            "collision_with": collision_with
         }
+        if debug:
+            result["debug_info"] = check_collision(brick_data, store.get(collision_with))["debug_info"]
+        return result
+    return {
+        "status": "error",
+        "message": "碰撞检测失败: 新积木与其他同时提交的积木发生碰撞",
+        "collision_with": None
+    }
+
+
+def find_collision(brick_data: Dict, store: BrickStore, index: SpatialGrid,
+                   ignore: Set[str] = frozenset()) -> Optional[str]:
+    """
+    查找与给定积木碰撞的第一个积木，返回其 uID，未碰撞时返回 None
+    先用空间索引找出候选积木，再读取存储中缓存的候选积木占位并一次性比较（见 collision.py）
+    ignore 中的积木不参与检测（例如同一批变更中被删除或被替换的积木）
+    """
+    footprint = brick_footprint(brick_data)
+    candidates = [
+        brick_id for brick_id in index.query(footprint_bounds(footprint))
+        if brick_id not in ignore and brick_id != brick_data["uID"]
+    ]
+    if not candidates:
+        return None
+    hits = collides(footprint, store.footprints(candidates))
+    first = int(hits.argmax())
+    return candidates[first] if hits[first] else None
+
+
+def validate_brick_changes(room_id: str, added: List[Dict], updated: List[Dict],
+                           removed: List[str]) -> Tuple[List[Dict], List[Dict], List[str]]:
+    """
+    检查客户端提交的新增 / 修改积木是否与房间内其他积木或同一批中的积木碰撞
+    返回 (可以提交的新增积木, 可以提交的修改积木, 被拒绝的积木 uID)
+    """
+    store = room_stores[room_id]
+    index = room_indexes[room_id]
+    # 同一批中被删除、被替换的积木不再占据原来的位置
+    ignore = set(removed) | {brick["uID"] for brick in updated} | {brick["uID"] for brick in added}
+    batch_store = BrickStore()
+    batch_index = SpatialGrid()
+    accepted = {"added": [], "updated": []}
+    rejected = []
+    for kind, bricks in (("updated", updated), ("added", added)):
+        for brick in bricks:
+            if (find_collision(brick, store, index, ignore) is not None
+                    or find_collision(brick, batch_store, batch_index) is not None):
+                rejected.append(brick["uID"])
+                continue
+            batch_store.add(brick)
+            batch_index.insert(brick["uID"], brick_bounds(brick))
+            accepted[kind].append(brick)
+    return accepted["added"], accepted["updated"], rejected
+
+
+def rebase_brick_changes(room_id: str, added: List[Dict], removed: List[str], updated: List[Dict],
+                         base_version: Optional[int], author: str):
+    """
+    将用户基于房间 base_version 版本做出的变更变基到房间的当前状态
+    返回 (可以提交的新增积木, 可以提交的删除积木ID, 可以提交的修改积木, 冲突的积木 uID)
+    base_version 之后被其他用户修改或新增的积木以房间的当前状态为准，对它们的删除和修改视为冲突；
+    修改已被删除的积木、新增与已有积木ID相同但内容不同的积木也视为冲突（未给出 base_version 时只检查这两种情况）
+    """
+    store = room_stores[room_id]
+    revisions = room_revisions[room_id]
     
-    # 如果没有碰撞，更新房间中的积木数据
-    rooms[room_id]["bricks"].append(brick_data)
+    def stale(brick_id: str) -> bool:
+        revision = revisions.get(brick_id)
+        return (base_version is not None and revision is not None
+                and revision[0] > base_version and revision[1] != author)
     
-    # 广播给房间内所有用户
-    await manager.broadcast(
-        room_id,
-        json.dumps({"type": "UPDATE_BRICKS", "data": rooms[room_id]["bricks"]})
-    )
+    accepted = {"added": [], "removed": [], "updated": []}
+    conflicts = []
+    for brick_id in dict.fromkeys(removed):
+        if brick_id in store:
+            (conflicts if stale(brick_id) else accepted["removed"]).append(brick_id)
+    for brick in updated:
+        if brick["uID"] not in store or stale(brick["uID"]):
+            conflicts.append(brick["uID"])
+        else:
+            accepted["updated"].append(brick)
+    for brick in added:
+        if brick["uID"] not in store:
+            accepted["added"].append(brick)
+        elif store.get(brick["uID"]) != brick:
+            conflicts.append(brick["uID"])
+    return accepted["added"], accepted["removed"], accepted["updated"], conflicts
+
+
+@app.post("/api/bricks/add_batch")
+async def add_bricks(room_id: str, batch: BrickBatch, debug: bool = False):
+    """
+    批量添加积木到指定房间，整批检测碰撞（包括与房间内积木以及批次内积木之间），只广播一次
+    debug 为 true 时，每个碰撞失败的积木附带它与碰撞积木的调试信息
+    """
+    if not await find_room(room_id):
+        raise HTTPException(status_code=404, detail="Room not found")
+    
+    # 批次内部的临时存储和索引，用于检测同一批次积木之间的碰撞
+    batch_store = BrickStore()
+    batch_index = SpatialGrid()
+    added = []
+    indices = []
+    failed = []
+    
+    for i, brick in enumerate(batch.bricks):
+        brick_data = build_brick_data(brick)
+        with metrics.collision_check_seconds.time("add_batch"):
+            collided = (find_collision(brick_data, room_stores[room_id], room_indexes[room_id])
+                        or find_collision(brick_data, batch_store, batch_index))
+        if collided is not None:
+            failure = {"index": i, "collision_with": collided}
+            if debug:
+                existing = room_stores[room_id].get(collided) or batch_store.get(collided)
+                failure["debug_info"] = check_collision(brick_data, existing)["debug_info"]
+            failed.append(failure)
+            if batch.atomic:
+                # 原子模式下任意碰撞都会导致整批失败
+                return {
+                    "status": "error",
+                    "message": f"碰撞检测失败: 第 {i + 1} 个积木与ID为 {collided} 的积木发生碰撞",
+                    "added": [],
+                    "failed": failed
+                }
+            continue
+        batch_store.add(brick_data)
+        batch_index.insert(brick_data["uID"], brick_bounds(brick_data))
+        added.append(brick_data)
+        indices.append(i)
+    
+    # 提交所有未发生碰撞的积木
+    if added:
+        # 整批只广播一条增量消息；多进程模式下应用时再次检测碰撞（原子模式下任意积木被拒绝则整批不添加）
+        messages = await manager.commit(room_id, {
+            "type": "changes", "added": added, "validate": bus.distributed, "atomic": batch.atomic
+        })
+        applied = {brick["uID"] for message in messages for brick in message["data"]["bricks"]}
+        # 多进程模式下，房间总线中排在前面的其他变更可能已经占据了部分积木的位置
+        for i, brick_data in zip(indices, added):
+            if brick_data["uID"] not in applied:
+                failed.append({
+                    "index": i,
+                    "collision_with": find_collision(brick_data, room_stores[room_id], room_indexes[room_id])
+                })
+        failed.sort(key=lambda failure: failure["index"])
+        added = [brick_data for brick_data in added if brick_data["uID"] in applied]
+    
+    return {
+        "status": "success" if not failed else ("partial" if added else "error"),
+        "total_added": len(added),
+        "added": added,
+        "failed": failed
+    }
+
+
+def build_shape(request: ShapeRequest) -> Tuple[Tuple[int, int, int], np.ndarray, List[str]]:
+    """
+    按顺序光栅化请求中的所有形状，返回 (网格最小角, 网格, 颜色列表)，网格中的值为颜色序号加 1
+    光栅化之前先由参数计算各形状的包围盒，过大的请求不分配任何数组
+    """
+    check_boxes([shape_box(spec) for spec in request.shapes])
+    colors: List[str] = []
+    rasters = []
+    for spec in request.shapes:
+        color = spec.color or request.color
+        if color not in colors:
+            colors.append(color)
+        rasters.append((rasterize(spec), 0 if spec.subtract else colors.index(color) + 1))
+    origin, grid = compose(rasters)
+    return origin, grid, colors
+
+
+@app.post("/api/bricks/shape")
+async def add_shape(room_id: str, request: ShapeRequest):
+    """
+    在服务器端生成形状并添加到指定房间
+    形状光栅化为体素网格后，跳过被房间内已有积木占据的体素（整个网格一次批量检测），
+    再将颜色相同的相邻体素贪心合并为不超过 max_dimensions_x x max_dimensions_z 的积木，整体只提交和广播一次
+    """
+    if not (1 <= request.max_dimensions_x <= 16 and 1 <= request.max_dimensions_z <= 16):
+        raise HTTPException(status_code=400, detail="max_dimensions_x / max_dimensions_z must be between 1 and 16")
+    try:
+        # 光栅化不涉及房间状态，在线程池中执行，不阻塞事件循环
+        origin, grid, colors = await asyncio.to_thread(build_shape, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not await find_room(room_id):
+        raise HTTPException(status_code=404, detail="Room not found")
+    
+    store = room_stores[room_id]
+    voxels = int(np.count_nonzero(grid))
+    with metrics.collision_check_seconds.time("shape"):
+        # 网格每一层对应的碰撞层（与 1x1 积木在该高度的实际占位一致）
+        layers = np.array([
+            brick_footprint(build_brick_data(BrickCoordinates(x=0, y=origin[1] + j, z=0)))["layer"]
+            for j in range(grid.shape[1])
+        ])
+        blocked = blocked_cells(origin, grid.shape, layers, store.footprint_columns()) & (grid != 0)
+    skipped = int(np.count_nonzero(blocked))
+    if skipped and request.atomic:
+        return {
+            "status": "error",
+            "message": f"碰撞检测失败: {skipped} 个体素被房间内已有积木占据",
+            "voxels": voxels,
+            "skipped_voxels": skipped,
+            "total_added": 0,
+            "brick_ids": []
+        }
+    grid[blocked] = 0
+    
+    runs = merge_runs(grid, request.max_dimensions_x, request.max_dimensions_z)
+    if len(runs["x"]) > SHAPE_MAX_BRICKS:
+        raise HTTPException(status_code=400, detail=f"Shape needs {len(runs['x'])} bricks, limit is {SHAPE_MAX_BRICKS}")
+    added = []
+    taken = set()
+    for x0, y, z0, w, d, color in zip(*(runs[key].tolist() for key in ("x", "y", "z", "w", "d", "color"))):
+        # 积木的锚点单元：奇数尺寸居中，偶数尺寸 x 方向偏左、z 方向偏右（与 build_brick_data 的对齐方式一致）
+        brick_data = build_brick_data(BrickCoordinates(
+            x=origin[0] + x0 + (w - 1) // 2, y=origin[1] + y, z=origin[2] + z0 + d // 2,
+            dimensions_x=w, dimensions_z=d, color=colors[color - 1]
+        ))
+        while brick_data["uID"] in store or brick_data["uID"] in taken:
+            brick_data["uID"] = str(uuid.uuid4())[:8]
+        taken.add(brick_data["uID"])
+        added.append(brick_data)
+    
+    if added:
+        # 整个形状只广播一条增量消息；多进程模式下应用时再次检测碰撞，其他进程同时提交的积木占据的部分不添加
+        messages = await manager.commit(room_id, {
+            "type": "changes", "added": added, "validate": bus.distributed, "atomic": request.atomic
+        })
+        applied = {brick["uID"] for message in messages for brick in message["data"]["bricks"]}
+        rejected = len(added) - len(applied)
+        added = [brick_data for brick_data in added if brick_data["uID"] in applied]
+    else:
+        rejected = 0
     
     return {
-        "status": "success", 
-        "data": brick_data,
-        "debug_info": debug_info  # 即使没有碰撞也返回调试信息
+        "status": "success" if added and not (skipped or rejected) else ("partial" if added else "error"),
+        "voxels": voxels,
+        "skipped_voxels": skipped,
+        "total_added": len(added),
+        "brick_ids": [brick["uID"] for brick in added]
     }
 
 
+# 积木信息中可以选择返回的字段
+BRICK_INFO_FIELDS = ("index", "id", "position", "dimensions", "color", "rotation", "translation", "raw_data")
+# 流式导出时每次从列式存储渲染的积木数
+EXPORT_CHUNK_SIZE = 500
+
+
+def build_brick_info(index: int, brick: Dict, fields: Optional[Set[str]] = None) -> Dict:
+    """
+    将积木数据转换为 REST 接口返回的积木信息，fields 为需要返回的字段（None 表示全部）
+    """
+    brick_info = {
+        "index": index,  # 从1开始的序号
+        "id": brick["uID"],
+        "position": {
+            "x": brick["intersect"]["point"]["x"],
+            "y": brick["intersect"]["point"]["y"],
+            "z": brick["intersect"]["point"]["z"]
+        },
+        "dimensions": {
+            "x": brick["dimensions"]["x"],
+            "z": brick["dimensions"]["z"]
+        },
+        # WebSocket 客户端提交的积木可能缺少这些字段（原样保存，见 brick_store.py）
+        "color": brick.get("color"),
+        "rotation": brick.get("rotation"),
+        "translation": brick.get("translation"),
+        "raw_data": brick  # 包含完整的原始数据结构
+    }
+    if fields is not None:
+        brick_info = {key: value for key, value in brick_info.items() if key in fields}
+    return brick_info
+
+
+def parse_fields(fields: Optional[str]) -> Optional[Set[str]]:
+    """
+    解析以逗号分隔的字段列表，未指定时返回 None（全部字段）
+    """
+    if not fields:
+        return None
+    selected = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = selected - set(BRICK_INFO_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return selected
+
+
+async def stream_bricks(store: BrickStore, cursor: int, limit: Optional[int], fields: Optional[Set[str]]):
+    """
+    以 NDJSON 格式逐块导出游标之后的积木，每块之间让出事件循环
+    块与块之间通过插入序号游标定位，导出过程中房间被修改也不会重复或错位
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        offset = store.offset_after(cursor)
+        count = EXPORT_CHUNK_SIZE if remaining is None else min(EXPORT_CHUNK_SIZE, remaining)
+        bricks = store.to_list(offset, offset + count)
+        if not bricks:
+            break
+        yield "".join(
+            json.dumps(build_brick_info(offset + i + 1, brick, fields)) + "\n"
+            for i, brick in enumerate(bricks)
+        )
+        cursor = store.cursor_at(offset + len(bricks) - 1)
+        if remaining is not None:
+            remaining -= len(bricks)
+        await asyncio.sleep(0)
+
+
 @app.get("/api/bricks/{room_id}")
-async def get_all_bricks(room_id: str):
+async def get_all_bricks(room_id: str, cursor: Optional[int] = None, limit: Optional[int] = None,
+                         fields: Optional[str] = None, format: str = "json"):
     """
     获取指定房间内所有积木的详细信息
+
+    - cursor: 上一页返回的 next_cursor，从该位置之后继续获取
+    - limit: 每页最多返回的积木数（默认返回全部）
+    - fields: 以逗号分隔的返回字段，例如 "id,position,color"（默认全部字段，包括 raw_data）
+    - format: json（默认）或 ndjson（逐行流式返回积木信息）
     """
-    if room_id not in rooms:
+    if not await find_room(room_id):
         raise HTTPException(status_code=404, detail="Room not found")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
     
-    bricks = rooms[room_id]["bricks"]
-    
-    # 为每个积木添加序号
-    bricks_with_index = []
-    for i, brick in enumerate(bricks):
-        brick_info = {
-            "index": i + 1,  # 从1开始的序号
-            "id": brick["uID"],
-            "position": {
-                "x": brick["intersect"]["point"]["x"],
-                "y": brick["intersect"]["point"]["y"],
-                "z": brick["intersect"]["point"]["z"]
-            },
-            "dimensions": {
-                "x": brick["dimensions"]["x"],
-                "z": brick["dimensions"]["z"]
-            },
-            "color": brick["color"],
-            "rotation": brick["rotation"],
-            "translation": brick["translation"],
-            "raw_data": brick  # 包含完整的原始数据结构
-        }
-        bricks_with_index.append(brick_info)
+    selected = parse_fields(fields)
+    store = room_stores[room_id]
+    
+    if format == "ndjson":
+        return StreamingResponse(
+            stream_bricks(store, cursor or 0, limit, selected),
+            media_type="application/x-ndjson",
+            headers={"X-Total-Bricks": str(len(store))}
+        )
+    
+    # 只渲染当前页的积木
+    start = store.offset_after(cursor) if cursor is not None else 0
+    stop = len(store) if limit is None else start + limit
+    bricks = store.to_list(start, stop)
+    next_cursor = None
+    if bricks and start + len(bricks) < len(store):
+        next_cursor = store.cursor_at(start + len(bricks) - 1)
+    
+    return {
+        "status": "success",
+        "room_id": room_id,
+        "total_bricks": len(store),
+        "bricks": [build_brick_info(start + i + 1, brick, selected) for i, brick in enumerate(bricks)],
+        "next_cursor": next_cursor
+    }
+
+
+def query_bricks(room_id: str, region: Tuple[float, float, float, float],
+                 layer_min: Optional[int] = None, layer_max: Optional[int] = None, color: Optional[str] = None,
+                 dimensions_x: Optional[int] = None, dimensions_z: Optional[int] = None) -> List[str]:
+    """
+    返回满足所有条件的积木ID（无序）
+    颜色、尺寸和所在层直接从属性索引取出候选集合并求交集；
+    区域 (x_min, x_max, z_min, z_max) 覆盖的网格单元较少时从空间索引取候选积木，最后按占位列精确筛选包围盒与区域相交的积木
+    """
+    store = room_stores[room_id]
+    attributes = room_attributes[room_id]
+    groups = []
+    if color is not None:
+        # 颜色不区分大小写，可以省略开头的 #
+        wanted = color.lower() if color.startswith("#") else "#" + color.lower()
+        # WebSocket 客户端提交的积木颜色可能不是字符串（例如 null），这些积木不匹配任何颜色
+        groups.append(set().union(*(
+            members for key, members in attributes.colors.items() if isinstance(key, str) and key.lower() == wanted
+        )))
+    if dimensions_x is not None or dimensions_z is not None:
+        groups.append(set().union(*(
+            members for (dx, dz), members in attributes.dimensions.items()
+            if dimensions_x in (None, dx) and dimensions_z in (None, dz)
+        )))
+    if layer_min is not None or layer_max is not None:
+        groups.append(attributes.in_layers(layer_min, layer_max))
+    candidates = intersect(groups)
+    
+    x_min, x_max, z_min, z_max = region
+    if x_min is None and x_max is None and z_min is None and z_max is None:
+        return store.ids if candidates is None else list(candidates)
+    x_min = -np.inf if x_min is None else x_min
+    x_max = np.inf if x_max is None else x_max
+    z_min = -np.inf if z_min is None else z_min
+    z_max = np.inf if z_max is None else z_max
+    if candidates is None:
+        candidates = store.ids
+        if attributes.layers and np.isfinite([x_min, x_max, z_min, z_max]).all():
+            lowest = min(attributes.layers) if layer_min is None else layer_min
+            highest = max(attributes.layers) if layer_max is None else layer_max
+            index = room_indexes[room_id]
+            cells = (np.ceil(x_max / index.cell_size) - np.floor(x_min / index.cell_size)) \
+                * (np.ceil(z_max / index.cell_size) - np.floor(z_min / index.cell_size)) * max(0, highest - lowest + 1)
+            if cells <= min(len(index.cells), MAX_CELLS):
+                candidates = index.query((x_min, x_max, lowest * LAYER_HEIGHT, (highest + 1) * LAYER_HEIGHT, z_min, z_max))
+    candidates = list(candidates)
+    if not candidates:
+        return []
+    fp = store.footprints(candidates)
+    inside = ((fp["cx"] + fp["ex"] > x_min + EPSILON) & (fp["cx"] - fp["ex"] < x_max - EPSILON)
+              & (fp["cz"] + fp["ez"] > z_min + EPSILON) & (fp["cz"] - fp["ez"] < z_max - EPSILON))
+    if layer_min is not None:
+        inside &= fp["layer"] >= layer_min
+    if layer_max is not None:
+        inside &= fp["layer"] <= layer_max
+    return [brick_id for brick_id, keep in zip(candidates, inside.tolist()) if keep]
+
+
+# 以下两个接口需要在 /api/bricks/{room_id}/{brick_id} 之前声明，否则 query / stats 会被当作积木ID
+@app.get("/api/bricks/{room_id}/query")
+async def query_room_bricks(room_id: str,
+                            x_min: Optional[float] = None, x_max: Optional[float] = None,
+                            z_min: Optional[float] = None, z_max: Optional[float] = None,
+                            layer_min: Optional[int] = None, layer_max: Optional[int] = None,
+                            color: Optional[str] = None,
+                            dimensions_x: Optional[int] = None, dimensions_z: Optional[int] = None,
+                            cursor: Optional[int] = None, limit: Optional[int] = None,
+                            fields: Optional[str] = None):
+    """
+    按条件查询指定房间内的积木（所有条件同时满足），结果按房间内的顺序排列
+
+    - x_min / x_max / z_min / z_max: 场景坐标（与返回的 position 相同）中的区域，返回实际占位的包围盒与区域相交的积木
+    - layer_min / layer_max: 所在层的范围，与添加积木时的 y 相同（第 n 层的高度为 [n, n + 1) * 33.33，与碰撞检测使用的层相同）
+    - color: 颜色（不区分大小写，可以省略开头的 #）
+    - dimensions_x / dimensions_z: 积木尺寸
+    - cursor / limit / fields: 与获取所有积木的接口相同
+    """
+    if not await find_room(room_id):
+        raise HTTPException(status_code=404, detail="Room not found")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    
+    selected = parse_fields(fields)
+    store = room_stores[room_id]
+    matched = store.in_order(
+        query_bricks(room_id, (x_min, x_max, z_min, z_max), layer_min, layer_max, color, dimensions_x, dimensions_z),
+        cursor
+    )
+    page = matched if limit is None else matched[:limit]
+    next_cursor = None
+    if len(page) < len(matched):
+        next_cursor = store.cursor_at(store.position(page[-1]) - 1)
     
     return {
         "status": "success",
         "room_id": room_id,
-        "total_bricks": len(bricks),
-        "bricks": bricks_with_index
+        # 游标之后满足条件的积木数
+        "total_matches": len(matched),
+        "bricks": [build_brick_info(store.position(brick_id), store.get(brick_id), selected) for brick_id in page],
+        "next_cursor": next_cursor
+    }
+
+
+@app.get("/api/bricks/{room_id}/stats")
+async def get_brick_stats(room_id: str):
+    """
+    获取指定房间内每个层 / 颜色 / 尺寸的积木数，直接读取属性索引中各集合的大小，不遍历积木
+    """
+    if not await find_room(room_id):
+        raise HTTPException(status_code=404, detail="Room not found")
+    
+    return {
+        "status": "success",
+        "room_id": room_id,
+        "total_bricks": len(room_stores[room_id]),
+        **room_attributes[room_id].counts()
     }
 
 
@@ -382,39 +1641,22 @@ async def get_brick_by_id(room_id: str, brick_id: str):
     """
     通过积木ID获取特定积木的详细信息
     """
-    if room_id not in rooms:
+    if not await find_room(room_id):
         raise HTTPException(status_code=404, detail="Room not found")
     
-    bricks = rooms[room_id]["bricks"]
-    
-    # 查找指定ID的积木
-    for i, brick in enumerate(bricks):
-        if brick["uID"] == brick_id:
-            brick_info = {
-                "index": i + 1,  # 从1开始的序号
-                "id": brick["uID"],
-                "position": {
-                    "x": brick["intersect"]["point"]["x"],
-                    "y": brick["intersect"]["point"]["y"],
-                    "z": brick["intersect"]["point"]["z"]
-                },
-                "dimensions": {
-                    "x": brick["dimensions"]["x"],
-                    "z": brick["dimensions"]["z"]
-                },
-                "color": brick["color"],
-                "rotation": brick["rotation"],
-                "translation": brick["translation"],
-                "raw_data": brick  # 包含完整的原始数据结构
-            }
-            return {
-                "status": "success",
-                "room_id": room_id,
-                "brick": brick_info
-            }
+    store = room_stores[room_id]
     
-    # 如果未找到指定ID的积木
-    raise HTTPException(status_code=404, detail="Brick not found")
+    # 通过 uID -> 行号 索引直接查找指定ID的积木
+    brick = store.get(brick_id)
+    if brick is None:
+        # 如果未找到指定ID的积木
+        raise HTTPException(status_code=404, detail="Brick not found")
+    
+    return {
+        "status": "success",
+        "room_id": room_id,
+        "brick": build_brick_info(store.position(brick_id), brick)
+    }
 
 
 @app.delete("/api/bricks/{room_id}/{brick_id}")
@@ -422,90 +1664,83 @@ async def delete_brick(room_id: str, brick_id: str):
     """
     通过积木ID删除特定积木
     """
-    if room_id not in rooms:
+    if not await find_room(room_id):
         raise HTTPException(status_code=404, detail="Room not found")
     
-    bricks = rooms[room_id]["bricks"]
+    # 保存积木信息用于返回
+    deleted_brick = room_stores[room_id].get(brick_id)
+    if deleted_brick is None:
+        # 如果未找到指定ID的积木
+        raise HTTPException(status_code=404, detail="Brick not found")
     
-    # 查找并删除指定ID的积木
-    for i, brick in enumerate(bricks):
-        if brick["uID"] == brick_id:
-            # 保存积木信息用于返回
-            deleted_brick = brick
-            
-            # 从列表中删除积木
-            rooms[room_id]["bricks"].pop(i)
-            
-            # 广播给房间内所有用户
-            await manager.broadcast(
-                room_id,
-                json.dumps({"type": "UPDATE_BRICKS", "data": rooms[room_id]["bricks"]})
-            )
-            
-            return {
-                "status": "success",
-                "message": f"Brick {brick_id} deleted successfully",
-                "deleted_brick": deleted_brick
-            }
+    # 从房间中删除积木，只向房间内所有用户广播被删除的积木ID
+    messages = await manager.commit(room_id, {"type": "changes", "removed": [brick_id]})
+    if not messages:
+        # 积木已被同时提交的其他变更删除
+        raise HTTPException(status_code=404, detail="Brick not found")
     
-    # 如果未找到指定ID的积木
-    raise HTTPException(status_code=404, detail="Brick not found")
+    return {
+        "status": "success",
+        "message": f"Brick {brick_id} deleted successfully",
+        "deleted_brick": deleted_brick
+    }
 
 
-def check_collision(brick1, brick2):
+async def undo_or_redo(room_id: str, user_id: Optional[str], redo: bool) -> Dict:
     """
-    检查两个积木是否发生碰撞，考虑实际尺寸和高度
+    撤销 / 重做用户最近的一次变更，返回结果和被回退的积木ID
     """
-    # 获取积木1的位置
-    x1 = brick1["intersect"]["point"]["x"]
-    y1 = brick1["intersect"]["point"]["y"]
-    z1 = brick1["intersect"]["point"]["z"]
-    
-    # 获取积木1的尺寸（考虑实际尺寸）
-    width1 = brick1["dimensions"]["x"] * 25  # base = 25
-    height1 = 35  # height = 35
-    depth1 = brick1["dimensions"]["z"] * 25  # base = 25
-    
-    # 获取积木2的位置
-    x2 = brick2["intersect"]["point"]["x"]
-    y2 = brick2["intersect"]["point"]["y"]
-    z2 = brick2["intersect"]["point"]["z"]
-    
-    # 获取积木2的尺寸（考虑实际尺寸）
-    width2 = brick2["dimensions"]["x"] * 25  # base = 25
-    height2 = 35  # height = 35
-    depth2 = brick2["dimensions"]["z"] * 25  # base = 25
-    
-    # 检查x轴方向
-    x_overlap = abs(x1 - x2) < (width1 + width2) / 2
-    
-    # 检查z轴方向
-    z_overlap = abs(z1 - z2) < (depth1 + depth2) / 2
+    if not await find_room(room_id):
+        raise HTTPException(status_code=404, detail="Room not found")
     
-    # 检查y轴方向（高度）- 考虑y坐标的缩放因子
-    # 由于y坐标被乘以了35，我们需要相应地调整高度
-    y_overlap = abs(y1 - y2) < 35  # 使用<而不是<=，允许积木正好堆叠
+    deltas, result = await manager.submit_undo(room_id, user_id or REST_AUTHOR, redo=redo)
+    # 只返回被回退的积木ID，积木数据已通过增量广播给房间内的用户
+    changed = {"added": [], "removed": [], "updated": []}
+    for delta in deltas:
+        if delta["type"] == "BRICK_REMOVED":
+            changed["removed"].extend(delta["data"]["ids"])
+        else:
+            kind = "added" if delta["type"] == "BRICK_ADDED" else "updated"
+            changed[kind].extend(brick["uID"] for brick in delta["data"]["bricks"])
+    return {**result, "room_id": room_id, **changed}
+
+
+@app.post("/api/bricks/undo")
+async def undo(room_id: str, user_id: Optional[str] = None):
+    """
+    撤销用户最近的一次积木变更，房间内的用户只收到回退产生的增量
+    user_id 为 WebSocket 客户端的持久化用户ID，默认为通过 REST 接口进行的变更
+    """
+    return await undo_or_redo(room_id, user_id, redo=False)
+
+
+@app.post("/api/bricks/redo")
+async def redo(room_id: str, user_id: Optional[str] = None):
+    """
+    重做用户最近撤销的一次积木变更，参数与撤销接口相同
+    """
+    return await undo_or_redo(room_id, user_id, redo=True)
+
+
+def check_collision(brick1, brick2):
+    """
+    检查两个积木是否发生碰撞（考虑旋转和平移后的实际占位，规则见 collision.py），并返回调试信息
+    """
+    footprint1 = brick_footprint(brick1)
+    footprint2 = brick_footprint(brick2)
+    collision = bool(collides(footprint1, stack([footprint2]))[0])
     
     # 生成调试信息
     debug_info = {
-        "brick1": {
-            "position": {"x": x1, "y": y1, "z": z1},
-            "dimensions": {"width": width1, "height": height1, "depth": depth1}
-        },
-        "brick2": {
-            "position": {"x": x2, "y": y2, "z": z2},
-            "dimensions": {"width": width2, "height": height2, "depth": depth2}
-        },
+        "brick1": describe(footprint1),
+        "brick2": describe(footprint2),
         "overlap": {
-            "x": x_overlap,
-            "y": y_overlap,
-            "z": z_overlap
+            "layer": footprint1["layer"] == footprint2["layer"],
+            # 不考虑所在层时底面是否重叠
+            "footprint": bool(collides(footprint1, stack([{**footprint2, "layer": footprint1["layer"]}]))[0])
         }
     }
     
-    # 只有在x和z轴都有重叠，且y轴也有重叠时，才认为发生碰撞
-    collision = x_overlap and z_overlap and y_overlap
-    
     return {
         "collision": collision,
         "debug_info": debug_info
@@ -514,6 +1749,26 @@ def check_collision(brick1, brick2):
 
 if __name__ == "__main__":
     print("start")
+    import multiprocessing
+    import os
+    import tempfile
+    import time
     import uvicorn
+    from broker import run_broker
+    
+    # LEGO_WORKERS > 1 时先启动 broker 进程，再以多进程方式运行服务器
+    workers = int(os.getenv("LEGO_WORKERS", "1"))
+    if workers > 1:
+        socket_path = os.environ.setdefault(
+            "LEGO_BROKER_SOCKET", os.path.join(tempfile.gettempdir(), "lego_builder_broker.sock")
+        )
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        broker_process = multiprocessing.Process(target=run_broker, args=(socket_path,), daemon=True)
+        broker_process.start()
+        # 等待 broker 开始监听
+        while not os.path.exists(socket_path):
+            time.sleep(0.05)
+    
     # 启动服务器
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=False)
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=False, workers=workers)
@@ -0,0 +1,85 @@
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+# 积木的可索引属性 (所在层, 颜色, 尺寸 x, 尺寸 z)，所在层与碰撞检测使用的层相同（见 collision.py）
+Attributes = Tuple[int, str, int, int]
+
+
+class AttributeIndex:
+    """
+    房间内积木的属性索引：所在层 / 颜色 / 尺寸 -> 积木ID集合
+    与 SpatialGrid 一样在每次变更时维护，按属性查询时直接取出候选积木，
+    每种属性值的积木数即集合的大小，统计时无需遍历积木
+    """
+
+    def __init__(self):
+        self.layers: Dict[int, Set[str]] = {}
+        self.colors: Dict[str, Set[str]] = {}
+        self.dimensions: Dict[Tuple[int, int], Set[str]] = {}
+
+    def insert(self, brick_id: str, attributes: Attributes):
+        """
+        将积木加入索引（修改积木时需先用旧的属性调用 remove）
+        """
+        layer, color, dx, dz = attributes
+        self.layers.setdefault(layer, set()).add(brick_id)
+        self.colors.setdefault(color, set()).add(brick_id)
+        self.dimensions.setdefault((dx, dz), set()).add(brick_id)
+
+    def remove(self, brick_id: str, attributes: Attributes):
+        """
+        从索引中移除积木，attributes 为积木加入索引时的属性
+        """
+        layer, color, dx, dz = attributes
+        for groups, key in ((self.layers, layer), (self.colors, color), (self.dimensions, (dx, dz))):
+            members = groups.get(key)
+            if members is None:
+                continue
+            members.discard(brick_id)
+            if not members:
+                del groups[key]
+
+    def clear(self):
+        self.layers.clear()
+        self.colors.clear()
+        self.dimensions.clear()
+
+    def rebuild(self, store):
+        """
+        根据房间的 BrickStore 重建索引
+        """
+        self.clear()
+        for brick_id, attributes in zip(store.ids, store.all_attributes()):
+            self.insert(brick_id, attributes)
+
+    def in_layers(self, lowest: Optional[int] = None, highest: Optional[int] = None) -> Set[str]:
+        """
+        返回所在层位于 [lowest, highest] 的积木ID（未给出的一端不限制）
+        """
+        matched: Set[str] = set()
+        for layer, members in self.layers.items():
+            if (lowest is None or layer >= lowest) and (highest is None or layer <= highest):
+                matched |= members
+        return matched
+
+    def counts(self) -> Dict[str, Dict]:
+        """
+        每个层 / 颜色 / 尺寸的积木数
+        """
+        return {
+            "layers": {layer: len(members) for layer, members in sorted(self.layers.items())},
+            "colors": {color: len(members) for color, members in self.colors.items()},
+            "dimensions": {f"{dx}x{dz}": len(members) for (dx, dz), members in sorted(self.dimensions.items())},
+        }
+
+
+def intersect(groups: Iterable[Set[str]]) -> Optional[Set[str]]:
+    """
+    多个候选集合的交集（从最小的集合开始），没有任何集合时返回 None（不限制）
+    """
+    groups = sorted(groups, key=len)
+    if not groups:
+        return None
+    matched = set(groups[0])
+    for members in groups[1:]:
+        matched &= members
+    return matched
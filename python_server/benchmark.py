@@ -0,0 +1,424 @@
+"""
+Lego Builder 服务器压测工具
+
+模拟 N 个房间 × M 个 WebSocket 客户端按设定频率发送 USER_CURSOR 和 UPDATE_BRICKS，
+同时以 add_brick 的方式施加 REST 负载，输出 JSON 格式的结果：
+广播延迟 p50/p99、消息吞吐量、REST 延迟以及每个房间的内存占用。
+
+默认在进程内启动服务器（后台线程中的 uvicorn），也可以通过 --url 压测已运行的服务器。
+使用 --baseline 与之前保存的结果比较，延迟或吞吐量退化超过阈值时以非零状态退出。
+
+示例:
+    python benchmark.py --rooms 4 --clients 8 --duration 10 --output result.json
+    python benchmark.py --baseline result.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import aiohttp
+import websockets
+
+# 单层积木高度（与服务器 collision.py 和前端相同），积木放在第 y 层的中间高度
+LAYER_HEIGHT = 25 * 2 / 1.5
+
+
+def percentile(samples: List[float], p: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    k = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def latency_summary(samples: List[float]) -> Dict:
+    """
+    延迟样本（秒）汇总为毫秒的 p50/p99/max
+    """
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+    return {
+        "samples": len(samples),
+        "p50_ms": ms(percentile(samples, 50)),
+        "p99_ms": ms(percentile(samples, 99)),
+        "max_ms": ms(max(samples) if samples else None)
+    }
+
+
+def deep_size(obj, seen=None) -> int:
+    """
+    粗略计算 Python 对象及其包含的容器占用的字节数
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def process_rss() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class Stats:
+    def __init__(self):
+        self.cursor_latency: List[float] = []
+        self.brick_latency: List[float] = []
+        self.rest_latency: List[float] = []
+        self.sent = 0
+        self.received = 0
+        self.rest_status: Dict[str, int] = {}
+        self.errors: List[str] = []
+        # 积木 uID -> 发送时间，用于计算 UPDATE_BRICKS 的广播延迟
+        self.brick_sent_at: Dict[str, float] = {}
+
+
+def make_brick(x: int, y: int, z: int, color: str = "#ff0000") -> Dict:
+    """
+    构造与前端结构一致的积木数据
+    """
+    return {
+        "intersect": {
+            "point": {"x": x * 25 + 12.5, "y": (y + 0.5) * LAYER_HEIGHT, "z": z * 25 + 12.5},
+            "face": {"a": 0, "b": 2, "c": 1, "normal": {"x": 0, "y": 0, "z": 1}, "materialIndex": 0}
+        },
+        "uID": str(uuid.uuid4())[:8],
+        "dimensions": {"x": 1, "z": 1},
+        "rotation": 0,
+        "color": color,
+        "translation": {"x": 0, "z": 0}
+    }
+
+
+async def paced(rate: float, stop: asyncio.Event):
+    """
+    按固定频率产生节拍，直到 stop 被设置
+    """
+    interval = 1 / rate
+    next_tick = time.perf_counter()
+    while not stop.is_set():
+        yield
+        next_tick += interval
+        await asyncio.sleep(max(0.0, next_tick - time.perf_counter()))
+
+
+async def run_client(ws_url: str, room_id: str, args, stats: Stats, ready: asyncio.Event,
+                     connected: List[int], stop: asyncio.Event):
+    client_id = str(uuid.uuid4())
+    bricks: Dict[str, Dict] = {}
+    # 已经收到过的积木，只统计第一次收到的延迟
+    # （UPDATE_BRICKS 是整体替换，并发时积木可能被删除后又由其他客户端重新添加）
+    seen = set()
+
+    async with websockets.connect(f"{ws_url}/ws/{room_id}", max_size=None) as ws:
+        async def receive():
+            async for raw in ws:
+                message = json.loads(raw)
+                now = time.perf_counter()
+                message_type = message.get("type")
+                data = message.get("data")
+                if ready.is_set() and not stop.is_set():
+                    stats.received += 1
+                if message_type == "PING":
+                    await ws.send(json.dumps({"type": "PONG"}))
+                elif message_type == "ROOM_STATE":
+                    bricks.clear()
+                    bricks.update({brick["uID"]: brick for brick in data["bricks"]})
+                elif message_type == "USER_CURSORS":
+                    for cursor in data:
+                        if cursor.get("id") != client_id and "ts" in cursor and ready.is_set():
+                            stats.cursor_latency.append(now - cursor["ts"])
+                elif message_type in ("BRICK_ADDED", "BRICK_UPDATED") and "bricks" in data:
+                    for brick in data["bricks"]:
+                        bricks[brick["uID"]] = brick
+                        sent_at = stats.brick_sent_at.get(brick["uID"])
+                        if sent_at is not None and message_type == "BRICK_ADDED" and brick["uID"] not in seen:
+                            stats.brick_latency.append(now - sent_at)
+                        seen.add(brick["uID"])
+                elif message_type == "BRICK_REMOVED" and "ids" in data:
+                    for brick_id in data["ids"]:
+                        bricks.pop(brick_id, None)
+                elif message_type == "BRICKS_CLEARED" and "status" not in data:
+                    bricks.clear()
+
+        async def send_cursors():
+            async for _ in paced(args.cursor_rate, stop):
+                await ws.send(json.dumps({"type": "USER_CURSOR", "data": {
+                    "id": client_id,
+                    "position": {"x": random.uniform(-500, 500), "y": 0, "z": random.uniform(-500, 500)},
+                    "ts": time.perf_counter()
+                }}))
+                stats.sent += 1
+
+        async def send_bricks():
+            async for _ in paced(args.brick_rate, stop):
+                # 旧协议：发送完整的积木数组，由服务器转换为增量
+                brick = make_brick(random.randint(-200, 200), random.randint(0, 20), random.randint(-200, 200))
+                stats.brick_sent_at[brick["uID"]] = time.perf_counter()
+                bricks[brick["uID"]] = brick
+                seen.add(brick["uID"])
+                await ws.send(json.dumps({"type": "UPDATE_BRICKS", "data": list(bricks.values())}))
+                stats.sent += 1
+
+        receiver = asyncio.create_task(receive())
+        connected[0] += 1
+        await ready.wait()
+        senders = []
+        if args.cursor_rate > 0:
+            senders.append(asyncio.create_task(send_cursors()))
+        if args.brick_rate > 0:
+            senders.append(asyncio.create_task(send_bricks()))
+        await stop.wait()
+        for task in senders:
+            task.cancel()
+        # 留出时间接收最后的广播
+        await asyncio.sleep(0.2)
+        receiver.cancel()
+        await asyncio.gather(receiver, *senders, return_exceptions=True)
+
+
+async def run_rest_worker(session: aiohttp.ClientSession, base_url: str, room_ids: List[str], rate: float,
+                          stats: Stats, stop: asyncio.Event):
+    async for _ in paced(rate, stop):
+        payload = {
+            "x": random.randint(-300, 300), "y": random.randint(0, 30), "z": random.randint(-300, 300),
+            "dimensions_x": random.choice([1, 2]), "dimensions_z": random.choice([1, 2, 4])
+        }
+        started = time.perf_counter()
+        try:
+            async with session.post(f"{base_url}/api/bricks/add", params={"room_id": random.choice(room_ids)},
+                                    json=payload) as response:
+                body = await response.json()
+            stats.rest_latency.append(time.perf_counter() - started)
+            status = body.get("status", str(response.status)) if isinstance(body, dict) else str(response.status)
+        except Exception as e:
+            status = "exception"
+            if len(stats.errors) < 10:
+                stats.errors.append(repr(e))
+        stats.rest_status[status] = stats.rest_status.get(status, 0) + 1
+
+
+def start_server(port: int):
+    """
+    在后台线程中启动进程内的服务器，返回 (uvicorn.Server, app 模块)
+    """
+    import uvicorn
+    import app as app_module
+
+    config = uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, app_module
+
+
+def room_memory(app_module, room_ids: List[str]) -> Dict:
+    """
+    估算进程内服务器中每个房间的内存占用（积木列式存储 + 空间索引 + 房间状态）
+    """
+    per_room = []
+    for room_id in room_ids:
+        store = app_module.room_stores.get(room_id)
+        if store is None:
+            continue
+        size = store.nbytes + deep_size(store._ids) + deep_size(store._rows) + deep_size(store._extras)
+        size += deep_size(app_module.room_indexes[room_id].cells)
+        size += deep_size(app_module.rooms[room_id])
+        per_room.append({"room_id": room_id, "bricks": len(store), "bytes": size})
+    total = sum(room["bytes"] for room in per_room)
+    return {
+        "rooms": per_room,
+        "avg_bytes_per_room": total // len(per_room) if per_room else None
+    }
+
+
+async def run_benchmark(args) -> Dict:
+    server = app_module = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        port = args.port or free_port()
+        server, app_module = start_server(port)
+        base_url = f"http://127.0.0.1:{port}"
+    ws_url = base_url.replace("http://", "ws://").replace("https://", "wss://")
+
+    gc.collect()
+    rss_before = process_rss()
+    stats = Stats()
+    ready = asyncio.Event()
+    stop = asyncio.Event()
+    connected = [0]
+    room_ids = [f"bench-{i}" for i in range(args.rooms)]
+
+    clients = [
+        asyncio.create_task(run_client(ws_url, room_id, args, stats, ready, connected, stop))
+        for room_id in room_ids
+        for _ in range(args.clients)
+    ]
+    # 等待所有客户端连接完成后再开始计时
+    while connected[0] < len(clients):
+        failed = [task for task in clients if task.done() and task.exception()]
+        if failed:
+            raise RuntimeError(f"客户端连接失败: {failed[0].exception()!r}")
+        await asyncio.sleep(0.05)
+
+    connector = aiohttp.TCPConnector(limit=max(1, args.rest_concurrency))
+    async with aiohttp.ClientSession(connector=connector) as session:
+        rest_workers = []
+        if args.rest_rate > 0 and args.rest_concurrency > 0:
+            worker_rate = args.rest_rate / args.rest_concurrency
+            rest_workers = [
+                asyncio.create_task(run_rest_worker(session, base_url, room_ids, worker_rate, stats, stop))
+                for _ in range(args.rest_concurrency)
+            ]
+        started = time.perf_counter()
+        ready.set()
+        await asyncio.sleep(args.duration)
+        stop.set()
+        elapsed = time.perf_counter() - started
+
+        memory = None
+        if app_module is not None:
+            gc.collect()
+            rss_after = process_rss()
+            memory = room_memory(app_module, room_ids)
+            memory["process_rss_delta_bytes"] = (
+                rss_after - rss_before if rss_before is not None and rss_after is not None else None
+            )
+        await asyncio.gather(*rest_workers, return_exceptions=True)
+    await asyncio.gather(*clients, return_exceptions=True)
+
+    if server is not None:
+        server.should_exit = True
+
+    return {
+        "config": {
+            "url": args.url or "in-process",
+            "rooms": args.rooms,
+            "clients_per_room": args.clients,
+            "duration_s": args.duration,
+            "cursor_rate_hz": args.cursor_rate,
+            "brick_rate_hz": args.brick_rate,
+            "rest_rate_hz": args.rest_rate,
+            "rest_concurrency": args.rest_concurrency
+        },
+        "elapsed_s": round(elapsed, 3),
+        "websocket": {
+            "messages_sent": stats.sent,
+            "messages_received": stats.received,
+            "sent_per_sec": round(stats.sent / elapsed, 1),
+            "received_per_sec": round(stats.received / elapsed, 1),
+            "cursor_broadcast_latency": latency_summary(stats.cursor_latency),
+            "brick_broadcast_latency": latency_summary(stats.brick_latency)
+        },
+        "rest": {
+            "requests": len(stats.rest_latency),
+            "requests_per_sec": round(len(stats.rest_latency) / elapsed, 1),
+            "status": stats.rest_status,
+            "latency": latency_summary(stats.rest_latency),
+            "errors": stats.errors
+        },
+        "memory": memory
+    }
+
+
+# 与基准结果比较的指标：(路径, 越大越好)
+REGRESSION_METRICS = [
+    (("websocket", "cursor_broadcast_latency", "p99_ms"), False),
+    (("websocket", "brick_broadcast_latency", "p99_ms"), False),
+    (("rest", "latency", "p99_ms"), False),
+    (("websocket", "received_per_sec"), True),
+    (("rest", "requests_per_sec"), True),
+    (("memory", "avg_bytes_per_room"), False),
+]
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    与基准结果比较，返回退化超过阈值的指标说明
+    """
+    regressions = []
+    for path, higher_is_better in REGRESSION_METRICS:
+        current, previous = result, baseline
+        for key in path:
+            current = current.get(key) if isinstance(current, dict) else None
+            previous = previous.get(key) if isinstance(previous, dict) else None
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f"{'.'.join(path)}: {previous} -> {current} ({change:+.0%})")
+    return regressions
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lego Builder WebSocket / REST 压测")
+    parser.add_argument("--url", help="压测已运行的服务器，例如 http://localhost:8000（默认在进程内启动）")
+    parser.add_argument("--port", type=int, default=0, help="进程内服务器端口（默认随机）")
+    parser.add_argument("--rooms", type=int, default=4, help="房间数")
+    parser.add_argument("--clients", type=int, default=8, help="每个房间的 WebSocket 客户端数")
+    parser.add_argument("--duration", type=float, default=10, help="压测时长（秒）")
+    parser.add_argument("--cursor-rate", type=float, default=20, help="每个客户端每秒发送的 USER_CURSOR 数")
+    parser.add_argument("--brick-rate", type=float, default=0.5, help="每个客户端每秒发送的 UPDATE_BRICKS 数")
+    parser.add_argument("--rest-rate", type=float, default=50, help="每秒 REST 添加积木请求数（所有并发合计）")
+    parser.add_argument("--rest-concurrency", type=int, default=4, help="REST 并发数")
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果比较")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例（默认 0.2 即 20%%）")
+    args = parser.parse_args()
+
+    # 进程内压测默认不写入磁盘，避免持久化影响结果
+    os.environ.setdefault("LEGO_PERSISTENCE", "none")
+
+    # 服务器日志输出到 stderr，stdout 只输出 JSON 结果
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        sys.stdout = stdout
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        result["regressions"] = regressions
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline and result["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,565 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from collision import FOOTPRINT_COLUMNS, FOOTPRINT_FIELDS, Footprints, footprint, footprint_bounds, footprints
+
+# 积木数据中由列存储直接保存的顶层字段，其余字段原样保存在 extras 中
+KNOWN_KEYS = {"intersect", "uID", "dimensions", "rotation", "color", "translation"}
+
+# 列名 -> dtype
+COLUMNS = {
+    # intersect.point
+    "px": np.float64, "py": np.float64, "pz": np.float64,
+    # intersect.face.normal
+    "nx": np.float64, "ny": np.float64, "nz": np.float64,
+    # intersect.face.a/b/c/materialIndex
+    "fa": np.int32, "fb": np.int32, "fc": np.int32, "mat": np.int32,
+    # dimensions
+    "dx": np.int32, "dz": np.int32,
+    "rot": np.float64,
+    # translation
+    "tx": np.float64, "tz": np.float64,
+    # 颜色在调色板中的序号
+    "color": np.int32,
+}
+
+
+class FenwickTree:
+    """
+    树状数组：维护每行是否存活，O(log n) 计算某行之前的存活积木数（即积木序号）
+    """
+
+    def __init__(self, flags: List[int]):
+        # 由 0/1 标记在 O(n) 内建树，下标从 1 开始
+        self.size = len(flags)
+        self.tree = [0] + list(flags)
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def add(self, row: int, delta: int):
+        i = row + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, row: int) -> int:
+        """
+        返回第 0..row 行中存活的行数
+        """
+        total = 0
+        i = row + 1
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, k: int) -> int:
+        """
+        返回第 k 个（从 1 开始）存活行的行号，调用方保证 1 <= k <= 存活行数
+        """
+        row = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = row + step
+            if nxt <= self.size and self.tree[nxt] < k:
+                row = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return row
+
+
+def _has_standard_intersect(brick: Dict) -> bool:
+    intersect = brick.get("intersect")
+    if not isinstance(intersect, dict) or set(intersect) != {"point", "face"}:
+        return False
+    face = intersect["face"]
+    return (isinstance(face, dict)
+            and set(face) == {"a", "b", "c", "normal", "materialIndex"}
+            and set(intersect["point"]) == {"x", "y", "z"}
+            and set(face["normal"]) == {"x", "y", "z"})
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _number(value, default=0):
+    return value if _is_number(value) else default
+
+
+def _has_standard_pair(value, kind=(int, float)) -> bool:
+    """
+    value 是否恰好为 {"x": ..., "z": ...} 且两个值都是 kind 类型的数（dimensions / translation）
+    """
+    return (isinstance(value, dict) and set(value) == {"x", "z"}
+            and all(isinstance(value[key], kind) and not isinstance(value[key], bool) for key in ("x", "z")))
+
+
+def _is_int32(value) -> bool:
+    return isinstance(value, int) and -2 ** 31 <= value < 2 ** 31
+
+
+def validate_brick(brick: Dict):
+    """
+    检查积木能否写入列存储（见 BrickStore._write_row），不能写入时抛出 ValueError
+    列中保存的字段必须是对应类型的数，结构不标准但能读出位置的字段原样保存在 extras 中
+    """
+    if not isinstance(brick, dict) or not isinstance(brick.get("uID"), str):
+        raise ValueError("积木缺少 uID")
+    intersect = brick.get("intersect")
+    point = intersect.get("point") if isinstance(intersect, dict) else None
+    if not isinstance(point, dict) or not all(_is_number(point.get(key)) for key in ("x", "y", "z")):
+        raise ValueError(f"积木 {brick['uID']} 的 intersect.point 必须包含数值 x / y / z")
+    face = intersect.get("face")
+    normal = face.get("normal") if isinstance(face, dict) else None
+    if (face is not None and not isinstance(face, dict)) or (normal is not None and not (
+            isinstance(normal, dict) and all(_is_number(normal.get(key, 0)) for key in ("x", "y", "z")))):
+        raise ValueError(f"积木 {brick['uID']} 的 intersect.face.normal 必须包含数值 x / y / z")
+    if _has_standard_intersect(brick) and not all(
+            _is_int32(face[key]) for key in ("a", "b", "c", "materialIndex")):
+        raise ValueError(f"积木 {brick['uID']} 的 intersect.face 中 a / b / c / materialIndex 必须为整数")
+    dimensions = brick.get("dimensions")
+    if not isinstance(dimensions, dict) or not all(_is_number(dimensions.get(key)) for key in ("x", "z")):
+        raise ValueError(f"积木 {brick['uID']} 的 dimensions 必须包含数值 x / z")
+    rotation = brick.get("rotation")
+    if rotation is not None and not _is_number(rotation):
+        raise ValueError(f"积木 {brick['uID']} 的 rotation 必须为数值")
+    translation = brick.get("translation")
+    if translation is not None and not (
+            isinstance(translation, dict) and all(_is_number(translation.get(key, 0)) for key in ("x", "z"))):
+        raise ValueError(f"积木 {brick['uID']} 的 translation 必须包含数值 x / z")
+    color = brick.get("color")
+    if color is not None and not isinstance(color, str):
+        raise ValueError(f"积木 {brick['uID']} 的 color 必须为字符串")
+
+
+class BrickStore:
+    """
+    房间内积木的列式存储
+    每个字段保存在一列 NumPy 数组中，通过 uID -> 行号 的索引定位积木，
+    只有在 API 边界（JSON 响应 / WebSocket 消息）才渲染为前端使用的嵌套字典结构
+
+    删除积木时只将该行标记为已删除（墓碑），其余行不移动，积木保持添加顺序；
+    已删除的行多于存活的行时整体压缩一次（均摊 O(1)），积木序号由树状数组维护
+    """
+
+    def __init__(self, capacity: int = 64):
+        # 已使用的行数（包括已删除的行）
+        self._size = 0
+        # 存活的积木数
+        self._count = 0
+        self._columns: Dict[str, np.ndarray] = {
+            name: np.zeros(capacity, dtype=dtype) for name, dtype in COLUMNS.items()
+        }
+        # 每行的插入序号（单调递增，用作分页游标，删除和压缩后依然有效）
+        self._columns["seq"] = np.zeros(capacity, dtype=np.int64)
+        self._next_seq = 1
+        # 每块积木的实际占位（见 collision.py），写入积木时计算，碰撞检测时直接读取
+        for name, dtype in FOOTPRINT_FIELDS.items():
+            self._columns[name] = np.zeros(capacity, dtype=dtype)
+        # 每行是否存活
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._order = FenwickTree([0] * capacity)
+        # 行号 -> uID（已删除的行为 None）
+        self._ids: List[Optional[str]] = []
+        # uID -> 行号
+        self._rows: Dict[str, int] = {}
+        # 颜色调色板（房间内的颜色种类通常很少）
+        self._palette: List[str] = []
+        self._palette_index: Dict[str, int] = {}
+        # uID -> 非标准字段（未知的顶层字段，或结构不标准、无法用列保存的已知字段）
+        self._extras: Dict[str, Dict] = {}
+        # uID -> 原积木中没有的已知字段（rotation / translation / color），渲染时不补出这些字段
+        self._absent: Dict[str, Tuple[str, ...]] = {}
+
+    @classmethod
+    def from_bricks(cls, bricks: Iterable[Dict]) -> "BrickStore":
+        bricks = list(bricks)
+        store = cls(capacity=max(64, len(bricks)))
+        for brick in bricks:
+            store.add(brick)
+        return store
+
+    @classmethod
+    def from_columns(cls, ids: List[str], columns: Dict[str, np.ndarray], palette: List[str],
+                     extras: Optional[Dict[str, Dict]] = None) -> "BrickStore":
+        """
+        由列数据直接构建存储（例如从二进制消息解码），columns 需包含 COLUMNS 中的所有列
+        """
+        count = len(ids)
+        store = cls(capacity=max(64, count))
+        for name in COLUMNS:
+            store._columns[name][:count] = columns[name]
+        for name, values in footprints(columns).items():
+            store._columns[name][:count] = values
+        store._columns["seq"][:count] = np.arange(1, count + 1)
+        store._next_seq = count + 1
+        store._alive[:count] = True
+        store._order = FenwickTree(store._alive.astype(np.int8).tolist())
+        store._ids = list(ids)
+        store._rows = {brick_id: row for row, brick_id in enumerate(store._ids)}
+        store._size = store._count = count
+        store._palette = list(palette)
+        store._palette_index = {color: code for code, color in enumerate(store._palette)}
+        store._extras = {brick_id: value for brick_id, value in (extras or {}).items() if brick_id in store._rows}
+        return store
+
+    @property
+    def palette(self) -> List[str]:
+        return self._palette
+
+    @property
+    def extras(self) -> Dict[str, Dict]:
+        """
+        uID -> 无法用列保存的字段（未知的顶层字段，或结构不标准的已知字段）
+        """
+        return self._extras
+
+    @property
+    def absent(self) -> Dict[str, Tuple[str, ...]]:
+        """
+        uID -> 原积木中没有、渲染时也不应补出的已知字段
+        """
+        return self._absent
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, brick_id: str) -> bool:
+        return brick_id in self._rows
+
+    def __iter__(self) -> Iterator[Dict]:
+        return iter(self.to_list())
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        返回某一列中存活积木的值（按积木顺序）
+        """
+        return self._columns[name][:self._size][self._alive[:self._size]]
+
+    @property
+    def ids(self) -> List[str]:
+        """
+        按顺序返回所有存活积木的 uID
+        """
+        return [brick_id for brick_id in self._ids if brick_id is not None]
+
+    def position(self, brick_id: str) -> Optional[int]:
+        """
+        返回积木在房间中的序号（从 1 开始），O(log n)
+        """
+        row = self._rows.get(brick_id)
+        if row is None:
+            return None
+        return self._order.prefix_sum(row)
+
+    def offset_after(self, cursor: int) -> int:
+        """
+        返回插入序号不大于 cursor 的存活积木数，即游标之后第一个积木的位置（从 0 开始）
+        """
+        row = int(np.searchsorted(self._columns["seq"][:self._size], cursor, side="right"))
+        return self._order.prefix_sum(row - 1) if row > 0 else 0
+
+    def cursor_at(self, offset: int) -> int:
+        """
+        返回第 offset 个（从 0 开始）存活积木的插入序号，作为下一页的游标
+        """
+        return int(self._columns["seq"][self._order.find(offset + 1)])
+
+    @property
+    def nbytes(self) -> int:
+        """
+        列数组占用的字节数（估算房间内存用量）
+        """
+        return sum(column.nbytes for column in self._columns.values()) + self._alive.nbytes
+
+    def _color_code(self, color: str) -> int:
+        code = self._palette_index.get(color)
+        if code is None:
+            code = self._palette_index[color] = len(self._palette)
+            self._palette.append(color)
+        return code
+
+    def _resize(self, capacity: int, rows: Optional[np.ndarray] = None):
+        """
+        重新分配列数组；rows 不为空时只保留这些行（压缩已删除的行）
+        """
+        for name, column in self._columns.items():
+            resized = np.zeros(capacity, dtype=column.dtype)
+            kept = column[:self._size] if rows is None else column[rows]
+            resized[:len(kept)] = kept
+            self._columns[name] = resized
+
+        if rows is not None:
+            self._ids = [self._ids[row] for row in rows.tolist()]
+            self._rows = {brick_id: row for row, brick_id in enumerate(self._ids)}
+            self._size = len(self._ids)
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._size] = self._alive[:self._size] if rows is None else True
+        self._alive = alive
+        self._order = FenwickTree(alive.astype(np.int8).tolist())
+
+    def _compact(self):
+        self._resize(max(64, self._count * 2), np.flatnonzero(self._alive[:self._size]))
+
+    def _write_row(self, row: int, brick: Dict):
+        c = self._columns
+        brick_id = brick["uID"]
+        extras = {key: value for key, value in brick.items() if key not in KNOWN_KEYS}
+
+        if _has_standard_intersect(brick):
+            point = brick["intersect"]["point"]
+            face = brick["intersect"]["face"]
+            c["px"][row], c["py"][row], c["pz"][row] = point["x"], point["y"], point["z"]
+            normal = face["normal"]
+            c["nx"][row], c["ny"][row], c["nz"][row] = normal["x"], normal["y"], normal["z"]
+            c["fa"][row], c["fb"][row], c["fc"][row] = face["a"], face["b"], face["c"]
+            c["mat"][row] = face["materialIndex"]
+        else:
+            # 结构不标准时原样保存 intersect，列中只保留碰撞检测所需的位置和法线
+            point = brick["intersect"]["point"]
+            c["px"][row], c["py"][row], c["pz"][row] = point["x"], point["y"], point["z"]
+            normal = (brick["intersect"].get("face") or {}).get("normal") or {}
+            c["nx"][row], c["ny"][row], c["nz"][row] = normal.get("x", 0), normal.get("y", 0), normal.get("z", 0)
+            extras["intersect"] = brick["intersect"]
+
+        # 结构或类型不标准的字段（如非整数尺寸、多出的嵌套字段）原样保存，列中只保留碰撞检测所需的近似值
+        dimensions = brick["dimensions"]
+        if not _has_standard_pair(dimensions, int):
+            extras["dimensions"] = dimensions
+            dimensions = dimensions if isinstance(dimensions, dict) else {}
+        c["dx"][row] = _number(dimensions.get("x"))
+        c["dz"][row] = _number(dimensions.get("z"))
+
+        absent = tuple(key for key in ("rotation", "translation", "color") if key not in brick)
+        rotation = brick.get("rotation", 0)
+        if not _is_number(rotation):
+            extras["rotation"] = rotation
+        c["rot"][row] = _number(rotation)
+        translation = brick.get("translation", {"x": 0, "z": 0})
+        if not _has_standard_pair(translation):
+            extras["translation"] = translation
+        translation = translation if isinstance(translation, dict) else {}
+        c["tx"][row], c["tz"][row] = _number(translation.get("x")), _number(translation.get("z"))
+        c["color"][row] = self._color_code(brick.get("color", "#ff0000"))
+        for name, value in footprint(*(float(c[name][row]) for name in FOOTPRINT_COLUMNS)).items():
+            c[name][row] = value
+
+        if extras:
+            self._extras[brick_id] = extras
+        else:
+            self._extras.pop(brick_id, None)
+        if absent:
+            self._absent[brick_id] = absent
+        else:
+            self._absent.pop(brick_id, None)
+
+    def add(self, brick: Dict) -> int:
+        """
+        追加一块积木，返回行号；相同 uID 的积木已存在时改为更新
+        """
+        brick_id = brick["uID"]
+        if brick_id in self._rows:
+            self.update(brick)
+            return self._rows[brick_id]
+        if self._size == len(self._columns["px"]):
+            if self._size - self._count > self._count:
+                self._compact()
+            else:
+                self._resize(max(64, len(self._columns["px"]) * 2))
+        row = self._size
+        self._write_row(row, brick)
+        self._columns["seq"][row] = self._next_seq
+        self._next_seq += 1
+        self._ids.append(brick_id)
+        self._rows[brick_id] = row
+        self._alive[row] = True
+        self._order.add(row, 1)
+        self._size += 1
+        self._count += 1
+        return row
+
+    def update(self, brick: Dict) -> bool:
+        row = self._rows.get(brick["uID"])
+        if row is None:
+            return False
+        self._write_row(row, brick)
+        return True
+
+    def remove(self, brick_id: str) -> Optional[Dict]:
+        """
+        删除积木并返回删除前的数据；只将该行标记为已删除，其他积木的顺序不变
+        """
+        row = self._rows.pop(brick_id, None)
+        if row is None:
+            return None
+        removed = self._render_row(row, brick_id)
+
+        self._ids[row] = None
+        self._alive[row] = False
+        self._order.add(row, -1)
+        self._extras.pop(brick_id, None)
+        self._absent.pop(brick_id, None)
+        self._count -= 1
+        if self._size - self._count > max(64, self._count):
+            self._compact()
+        return removed
+
+    def clear(self):
+        self._size = 0
+        self._count = 0
+        self._alive[:] = False
+        self._order = FenwickTree([0] * len(self._alive))
+        self._ids = []
+        self._rows = {}
+        self._extras = {}
+        self._absent = {}
+
+    def copy(self) -> "BrickStore":
+        """
+        复制一份独立的存储（只包含存活的积木，用于在其他线程中序列化快照）
+        """
+        rows = np.flatnonzero(self._alive[:self._size])
+        clone = BrickStore.__new__(BrickStore)
+        clone._size = clone._count = len(rows)
+        clone._next_seq = self._next_seq
+        clone._columns = {name: column[rows] for name, column in self._columns.items()}
+        clone._alive = np.ones(len(rows), dtype=bool)
+        clone._order = FenwickTree([1] * len(rows))
+        clone._ids = [self._ids[row] for row in rows.tolist()]
+        clone._rows = {brick_id: row for row, brick_id in enumerate(clone._ids)}
+        clone._palette = list(self._palette)
+        clone._palette_index = dict(self._palette_index)
+        clone._extras = dict(self._extras)
+        clone._absent = dict(self._absent)
+        return clone
+
+    def spatial_order(self, viewpoint: Optional[Tuple[float, float, float]] = None) -> np.ndarray:
+        """
+        返回存活积木的序号（从 0 开始），按到 viewpoint 的距离由近到远排列；
+        未给出 viewpoint 时按高度由下到上排列（同一层保持原有顺序）
+        """
+        if viewpoint is None:
+            return np.argsort(self.column("py"), kind="stable")
+        x, y, z = viewpoint
+        distance = (self.column("px") - x) ** 2 + (self.column("py") - y) ** 2 + (self.column("pz") - z) ** 2
+        return np.argsort(distance, kind="stable")
+
+    def take(self, ordinals: np.ndarray) -> "BrickStore":
+        """
+        按给定的序号（从 0 开始）取出部分存活积木，构建一个独立的存储
+        """
+        rows = np.flatnonzero(self._alive[:self._size])[ordinals]
+        ids = [self._ids[row] for row in rows.tolist()]
+        extras = {brick_id: self._extras[brick_id] for brick_id in ids if brick_id in self._extras}
+        store = BrickStore.from_columns(
+            ids, {name: self._columns[name][rows] for name in COLUMNS}, self._palette, extras
+        )
+        store._absent = {brick_id: self._absent[brick_id] for brick_id in ids if brick_id in self._absent}
+        return store
+
+    def footprints(self, brick_ids: List[str]) -> Footprints:
+        """
+        按列返回给定积木的实际占位（见 collision.py），直接读取缓存的占位列，不渲染积木数据
+        """
+        rows = np.fromiter((self._rows[brick_id] for brick_id in brick_ids), dtype=np.int64, count=len(brick_ids))
+        return {name: self._columns[name][rows] for name in FOOTPRINT_FIELDS}
+
+    def footprint_columns(self) -> Footprints:
+        """
+        按列返回所有存活积木的实际占位（按积木顺序）
+        """
+        return {name: self.column(name) for name in FOOTPRINT_FIELDS}
+
+    def attributes(self, brick_id: str) -> Tuple[int, str, int, int]:
+        """
+        返回积木的可索引属性 (所在层, 颜色, 尺寸 x, 尺寸 z)，用于属性索引
+        """
+        row = self._rows[brick_id]
+        c = self._columns
+        return (int(c["layer"][row]), self._palette[c["color"][row]], int(c["dx"][row]), int(c["dz"][row]))
+
+    def all_attributes(self) -> List[Tuple[int, str, int, int]]:
+        """
+        按积木顺序返回所有存活积木的可索引属性
+        """
+        colors = [self._palette[code] for code in self.column("color").tolist()]
+        return list(zip(self.column("layer").tolist(), colors, self.column("dx").tolist(), self.column("dz").tolist()))
+
+    def in_order(self, brick_ids: Iterable[str], after: Optional[int] = None) -> List[str]:
+        """
+        将给定的积木按房间内的顺序排列，after 不为空时只保留插入序号大于 after（分页游标）的积木
+        """
+        brick_ids = list(brick_ids)
+        rows = np.fromiter((self._rows[brick_id] for brick_id in brick_ids), dtype=np.int64, count=len(brick_ids))
+        rows.sort()
+        if after is not None:
+            rows = rows[self._columns["seq"][rows] > after]
+        return [self._ids[row] for row in rows.tolist()]
+
+    def bounds(self, brick_id: str) -> Tuple[float, float, float, float, float, float]:
+        """
+        返回积木实际占位的包围盒 (x0, x1, y0, y1, z0, z1)，用于空间网格索引
+        """
+        row = self._rows[brick_id]
+        return footprint_bounds({name: self._columns[name][row].item() for name in FOOTPRINT_FIELDS})
+
+    def get(self, brick_id: str) -> Optional[Dict]:
+        row = self._rows.get(brick_id)
+        if row is None:
+            return None
+        return self._render_row(row, brick_id)
+
+    def _render_row(self, row: int, brick_id: str) -> Dict:
+        c = self._columns
+        return self._render(
+            brick_id,
+            float(c["px"][row]), float(c["py"][row]), float(c["pz"][row]),
+            float(c["nx"][row]), float(c["ny"][row]), float(c["nz"][row]),
+            int(c["fa"][row]), int(c["fb"][row]), int(c["fc"][row]), int(c["mat"][row]),
+            int(c["dx"][row]), int(c["dz"][row]), float(c["rot"][row]),
+            float(c["tx"][row]), float(c["tz"][row]), int(c["color"][row])
+        )
+
+    def _render(self, brick_id, px, py, pz, nx, ny, nz, fa, fb, fc, mat, dx, dz, rot, tx, tz, color) -> Dict:
+        brick = {
+            "intersect": {
+                "point": {"x": px, "y": py, "z": pz},
+                "face": {
+                    "a": fa,
+                    "b": fb,
+                    "c": fc,
+                    "normal": {"x": nx, "y": ny, "z": nz},
+                    "materialIndex": mat
+                }
+            },
+            "uID": brick_id,
+            "dimensions": {"x": dx, "z": dz},
+            "rotation": rot,
+            "color": self._palette[color],
+            "translation": {"x": tx, "z": tz}
+        }
+        extras = self._extras.get(brick_id)
+        if extras:
+            brick.update(extras)
+        for key in self._absent.get(brick_id, ()):
+            del brick[key]
+        return brick
+
+    def to_list(self, start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+        """
+        按顺序将第 [start, stop) 个存活积木（从 0 开始）渲染为前端使用的积木字典列表
+        """
+        stop = self._count if stop is None else min(stop, self._count)
+        if start >= stop:
+            return []
+        first_row = self._order.find(start + 1)
+        last_row = self._order.find(stop) + 1
+        alive = self._alive[first_row:last_row]
+        # 每列只转换一次为 Python 对象，避免逐个元素访问 NumPy 标量
+        columns = [self._columns[name][first_row:last_row][alive].tolist() for name in COLUMNS]
+        ids = [brick_id for brick_id in self._ids[first_row:last_row] if brick_id is not None]
+        return [self._render(brick_id, *values) for brick_id, values in zip(ids, zip(*columns))]
@@ -0,0 +1,416 @@
+import asyncio
+import itertools
+import json
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+# 多进程模式下 broker 监听的 Unix socket 路径；未设置时以单进程模式运行
+BROKER_SOCKET = os.getenv("LEGO_BROKER_SOCKET")
+# 同步请求的目标进程已离开房间时最多请求的次数，以及每次重新请求前等待的秒数（逐次递增）
+SYNC_RETRIES = 5
+SYNC_RETRY_DELAY = 0.05
+
+
+class RoomBus:
+    """
+    单进程模式的房间总线
+    所有状态变更直接在本进程中应用，广播只需发送给本进程内的连接
+
+    需要通过 bind 提供以下回调：
+        load(room_id)            -> 从持久化存储加载房间状态（可能为 None）
+        install(room_id, state)  -> 在内存中创建房间
+        export(room_id)          -> 导出房间完整状态（用于同步给其他进程）
+        apply(room_id, op)       -> 应用一条有序的状态变更并投递给本进程内的连接，返回结果
+                                    （apply 中不能等待 submit：多进程模式下提交的变更要等 apply 返回后才会被应用，
+                                    需要提交新变更时应在独立的任务中进行）
+        deliver(room_id, message, exclude_user_id) -> 将其他进程转发的广播（光标等可丢弃的瞬时消息）投递给本进程内的连接
+    """
+
+    distributed = False
+
+    def __init__(self):
+        self.load: Optional[Callable[[str], Awaitable[Optional[Dict]]]] = None
+        self.install: Optional[Callable[[str, Optional[Dict]], None]] = None
+        self.export: Optional[Callable[[str], Dict]] = None
+        self.apply: Optional[Callable[[str, Dict], Awaitable[List[Dict]]]] = None
+        self.deliver: Optional[Callable[[str, str, Optional[str]], Awaitable[None]]] = None
+        # 正在加入的房间，避免并发加入时重复加载
+        self._joining: Dict[str, asyncio.Task] = {}
+
+    def bind(self, load, install, export, apply, deliver):
+        self.load = load
+        self.install = install
+        self.export = export
+        self.apply = apply
+        self.deliver = deliver
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def join(self, room_id: str):
+        """
+        加入房间：加载房间状态并在本进程中创建房间，同一房间的并发调用只加载一次
+        """
+        task = self._joining.get(room_id)
+        if task is None:
+            task = self._joining[room_id] = asyncio.create_task(self._join(room_id))
+            task.add_done_callback(lambda _: self._joining.pop(room_id, None))
+        await asyncio.shield(task)
+
+    async def _join(self, room_id: str):
+        self.install(room_id, await self.load(room_id))
+
+    async def leave(self, room_id: str):
+        pass
+
+    def is_owner(self, room_id: str) -> bool:
+        """
+        是否由本进程负责该房间的持久化
+        """
+        return True
+
+    async def lookup(self, room_id: str) -> bool:
+        """
+        房间是否在其他进程中处于活跃状态
+        """
+        return False
+
+    async def submit(self, room_id: str, op: Dict) -> List[Dict]:
+        """
+        提交一条状态变更，返回应用后的增量消息
+        """
+        return await self.apply(room_id, op)
+
+    async def relay(self, room_id: str, message: str, exclude_user_id: Optional[str] = None):
+        """
+        将广播消息转发给其他进程中的连接（单进程模式下无需转发）
+        """
+
+
+class BrokerBus(RoomBus):
+    """
+    多进程模式的房间总线，通过 Unix socket 连接到 broker 进程
+    同一房间的状态变更由 broker 统一编号并按相同顺序发给所有订阅该房间的进程（包括提交者），
+    每个进程按顺序应用，从而保证不同进程上的用户看到一致的房间状态
+    """
+
+    distributed = True
+
+    def __init__(self, socket_path: str):
+        super().__init__()
+        self.socket_path = socket_path
+        self.worker_id = uuid.uuid4().hex[:8]
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        # broker 转发的房间消息由独立的任务依次应用，读取循环不等待 apply，
+        # 应用期间仍能收到请求的回复和同步请求
+        self._inbox: asyncio.Queue = asyncio.Queue()
+        self._dispatch_task: Optional[asyncio.Task] = None
+        self._request_ids = itertools.count(1)
+        # 请求ID -> 等待 broker 回复的 future
+        self._requests: Dict[int, asyncio.Future] = {}
+        # 本进程提交、等待 broker 排序后回传的状态变更
+        self._submits: Dict[int, asyncio.Future] = {}
+        # 正在加入的房间在就绪前收到的消息
+        self._buffers: Dict[str, List[Dict]] = {}
+        # 正在加入的房间在就绪前收到的同步请求
+        self._pending_syncs: Dict[str, List[Dict]] = {}
+        # 房间ID -> 已应用的最大序号
+        self._applied_seq: Dict[str, int] = {}
+        # 由本进程负责持久化的房间
+        self._owned: Set[str] = set()
+
+    async def start(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+        await self._send({"cmd": "hello", "worker": self.worker_id})
+        self._reader_task = asyncio.create_task(self._read_loop())
+        self._dispatch_task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self):
+        for task in (self._reader_task, self._dispatch_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self._writer:
+            self._writer.close()
+
+    async def _send(self, message: Dict):
+        self._writer.write((json.dumps(message) + "\n").encode())
+        await self._writer.drain()
+
+    async def _request(self, message: Dict) -> Dict:
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._requests[request_id] = future
+        await self._send({**message, "req": request_id})
+        return await future
+
+    async def _join(self, room_id: str):
+        # 先订阅（之后的消息先缓存），再获取订阅时刻的房间状态
+        self._buffers[room_id] = []
+        reply = await self._request({"cmd": "subscribe", "room": room_id})
+        if reply["owner"]:
+            # 没有其他进程持有该房间，由本进程从持久化存储加载并负责持久化
+            state = await self.load(room_id)
+            seq = reply["seq"]
+            self._owned.add(room_id)
+        else:
+            # 从负责该房间的进程同步完整状态
+            for attempt in range(1, SYNC_RETRIES + 1):
+                response = await self._request({"cmd": "sync_request", "room": room_id})
+                if "error" not in response:
+                    break
+                # 目标进程在请求到达前已离开房间，等它的退订到达 broker 后重新请求（broker 会选择其他进程）
+                print(f"房间 {room_id} 状态同步失败: {response['error']}")
+                await asyncio.sleep(SYNC_RETRY_DELAY * attempt)
+            else:
+                del self._buffers[room_id]
+                self._pending_syncs.pop(room_id, None)
+                await self._send({"cmd": "unsubscribe", "room": room_id})
+                raise RuntimeError(f"房间 {room_id} 状态同步失败")
+            if response.get("load"):
+                # 其他进程都已离开房间，本进程是唯一的订阅者，从持久化存储加载并负责持久化
+                state = await self.load(room_id)
+                self._owned.add(room_id)
+            else:
+                state = response["state"]
+            seq = response["seq"]
+
+        self.install(room_id, state)
+        self._applied_seq[room_id] = seq
+
+        # 按顺序应用加入期间缓存的消息（跳过同步状态中已包含的），
+        # 缓存清空前新到达的消息继续追加到同一个列表，保证顺序
+        buffer = self._buffers[room_id]
+        while buffer:
+            await self._dispatch(buffer.pop(0))
+        del self._buffers[room_id]
+        for request in self._pending_syncs.pop(room_id, []):
+            await self._answer_sync(request)
+
+    async def leave(self, room_id: str):
+        self._owned.discard(room_id)
+        self._applied_seq.pop(room_id, None)
+        await self._send({"cmd": "unsubscribe", "room": room_id})
+
+    def is_owner(self, room_id: str) -> bool:
+        return room_id in self._owned
+
+    async def lookup(self, room_id: str) -> bool:
+        reply = await self._request({"cmd": "lookup", "room": room_id})
+        return reply["live"]
+
+    async def submit(self, room_id: str, op: Dict) -> List[Dict]:
+        submit_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._submits[submit_id] = future
+        await self._send({
+            "cmd": "publish",
+            "room": room_id,
+            "echo": True,
+            "payload": {"kind": "op", "op": op, "worker": self.worker_id, "submit": submit_id}
+        })
+        return await future
+
+    async def relay(self, room_id: str, message: str, exclude_user_id: Optional[str] = None):
+        await self._send({
+            "cmd": "publish",
+            "room": room_id,
+            "echo": False,
+            "payload": {"kind": "relay", "message": message, "exclude": exclude_user_id}
+        })
+
+    async def _answer_sync(self, request: Dict):
+        room_id = request["room"]
+        response = {"cmd": "sync_response", "room": room_id, "to": request["from"], "req": request["req"]}
+        try:
+            response.update(state=self.export(room_id), seq=self._applied_seq[room_id])
+        except KeyError:
+            # 本进程已离开该房间，回复错误，请求者会重新请求
+            response["error"] = f"worker {self.worker_id} 不在房间 {room_id} 中"
+        await self._send(response)
+
+    async def _dispatch(self, message: Dict):
+        room_id = message["room"]
+        payload = message["payload"]
+        if payload["kind"] == "relay":
+            await self.deliver(room_id, payload["message"], payload.get("exclude"))
+            return
+
+        if message["seq"] <= self._applied_seq.get(room_id, -1):
+            return
+        self._applied_seq[room_id] = message["seq"]
+        future = self._submits.pop(payload["submit"], None) if payload["worker"] == self.worker_id else None
+        try:
+            result = await self.apply(room_id, payload["op"])
+        except Exception as e:
+            # 应用失败时提交者也要得到结果，否则会一直等待
+            if future and not future.done():
+                future.set_exception(e)
+            raise
+        if future and not future.done():
+            future.set_result(result)
+
+    async def _dispatch_loop(self):
+        while True:
+            message = await self._inbox.get()
+            room_id = message["room"]
+            try:
+                if room_id in self._buffers:
+                    self._buffers[room_id].append(message)
+                elif room_id in self._applied_seq:
+                    await self._dispatch(message)
+            except Exception as e:
+                print(f"应用房间 {room_id} 的消息失败: {str(e)}")
+
+    async def _read_loop(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                print("与 broker 的连接已断开")
+                return
+            message = json.loads(line)
+            cmd = message["cmd"]
+            try:
+                if cmd == "message":
+                    self._inbox.put_nowait(message)
+                elif cmd == "sync_request":
+                    if message["room"] in self._buffers:
+                        self._pending_syncs.setdefault(message["room"], []).append(message)
+                    else:
+                        await self._answer_sync(message)
+                elif cmd == "owner":
+                    # 原负责进程已离开，由本进程接管该房间的持久化
+                    self._owned.add(message["room"])
+                elif "req" in message:
+                    future = self._requests.pop(message["req"], None)
+                    if future and not future.done():
+                        future.set_result(message)
+            except Exception as e:
+                print(f"处理 broker 消息失败: {str(e)}")
+
+
+class Broker:
+    """
+    本地消息 broker，负责在多个 worker 进程之间转发房间消息
+    每个房间维护有序的订阅者列表，第一个订阅者负责该房间的持久化并响应状态同步请求
+    """
+
+    def __init__(self):
+        # worker ID -> 写入流
+        self.workers: Dict[str, asyncio.StreamWriter] = {}
+        # 房间ID -> 订阅该房间的 worker ID（第一个为负责进程）
+        self.subscribers: Dict[str, List[str]] = {}
+        # 房间ID -> 已分配的最大序号
+        self.seq: Dict[str, int] = {}
+
+    async def _send(self, worker_id: str, message: Dict):
+        writer = self.workers.get(worker_id)
+        if writer is None:
+            return
+        writer.write((json.dumps(message) + "\n").encode())
+        await writer.drain()
+
+    async def _unsubscribe(self, worker_id: str, room_id: str):
+        subscribers = self.subscribers.get(room_id)
+        if not subscribers or worker_id not in subscribers:
+            return
+        was_owner = subscribers[0] == worker_id
+        subscribers.remove(worker_id)
+        if not subscribers:
+            del self.subscribers[room_id]
+        elif was_owner:
+            await self._send(subscribers[0], {"cmd": "owner", "room": room_id})
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                cmd = message["cmd"]
+                room_id = message.get("room")
+
+                if cmd == "hello":
+                    worker_id = message["worker"]
+                    self.workers[worker_id] = writer
+                elif cmd == "subscribe":
+                    subscribers = self.subscribers.setdefault(room_id, [])
+                    if worker_id not in subscribers:
+                        subscribers.append(worker_id)
+                    await self._send(worker_id, {
+                        "cmd": "subscribed",
+                        "req": message["req"],
+                        "owner": subscribers[0] == worker_id,
+                        "seq": self.seq.get(room_id, 0)
+                    })
+                elif cmd == "unsubscribe":
+                    await self._unsubscribe(worker_id, room_id)
+                elif cmd == "publish":
+                    # 为房间消息分配序号，并按相同顺序发给所有订阅者
+                    seq = self.seq[room_id] = self.seq.get(room_id, 0) + 1
+                    outgoing = {"cmd": "message", "room": room_id, "seq": seq, "payload": message["payload"]}
+                    for subscriber in list(self.subscribers.get(room_id, [])):
+                        if subscriber == worker_id and not message.get("echo"):
+                            continue
+                        await self._send(subscriber, outgoing)
+                elif cmd == "sync_request":
+                    subscribers = self.subscribers.get(room_id, [])
+                    owner = next((s for s in subscribers if s != worker_id), None)
+                    if owner is None:
+                        # 其他进程在订阅和同步请求之间离开了房间，请求者自行加载房间
+                        await self._send(worker_id, {
+                            "cmd": "sync_response", "req": message["req"], "load": True, "seq": self.seq.get(room_id, 0)
+                        })
+                    else:
+                        await self._send(owner, {"cmd": "sync_request", "room": room_id, "req": message["req"], "from": worker_id})
+                elif cmd == "sync_response":
+                    response = {key: message[key] for key in ("req", "state", "seq", "error") if key in message}
+                    await self._send(message["to"], {"cmd": "sync_response", **response})
+                elif cmd == "lookup":
+                    live = any(s != worker_id for s in self.subscribers.get(room_id, []))
+                    await self._send(worker_id, {"cmd": "lookup", "req": message["req"], "live": live})
+        finally:
+            # worker 退出时取消它的所有订阅
+            if worker_id:
+                self.workers.pop(worker_id, None)
+                for room_id in list(self.subscribers):
+                    await self._unsubscribe(worker_id, room_id)
+            writer.close()
+
+
+async def serve_broker(socket_path: str):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    broker = Broker()
+    server = await asyncio.start_unix_server(broker.handle_worker, path=socket_path)
+    print(f"broker 已启动: {socket_path}")
+    async with server:
+        await server.serve_forever()
+
+
+def run_broker(socket_path: str):
+    """
+    broker 进程入口
+    """
+    asyncio.run(serve_broker(socket_path))
+
+
+def create_bus() -> RoomBus:
+    """
+    设置了 LEGO_BROKER_SOCKET 时使用多进程总线，否则使用单进程总线
+    """
+    if BROKER_SOCKET:
+        return BrokerBus(BROKER_SOCKET)
+    return RoomBus()
@@ -0,0 +1,189 @@
+"""
+积木碰撞检测（前端 src/utils/helpers.js 中的 collisonXYZ 使用相同的规则）
+
+积木的实际占位与前端 Brick.jsx 的渲染方式一致：
+- 积木组的位置由 intersect.point + face.normal 对齐到网格：x / z 按 BASE 向下取整后加半格
+  （该方向的尺寸为偶数时加一整格，旋转后按对调后的尺寸判断奇偶），y 按 LAYER_HEIGHT 取整得到所在层
+- 积木主体在积木组内平移 translation 格（每个方向最多 floor(尺寸 / 2) 格），再随积木组绕 y 轴旋转 rotation
+- 两块积木位于同一层，且旋转后的矩形底面有面积重叠（正好接触不算）时发生碰撞
+
+单块积木的占位用 Python 数值计算，多块积木的占位按列以 NumPy 数组批量计算，一块积木可以一次与任意多块积木比较
+"""
+import math
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# 单个凸点的底面边长
+BASE = 25
+# 单层积木高度（与前端 getMeasurementsFromDimensions 一致）
+LAYER_HEIGHT = BASE * 2 / 1.5
+# 积木每个方向的最大尺寸（凸点数），限制单块积木在空间索引中占据的网格单元数
+MAX_BRICK_DIMENSION = int(os.getenv("LEGO_MAX_BRICK_DIMENSION", "64"))
+# 判断重叠时的容差，避免浮点误差把正好接触的积木当作碰撞
+EPSILON = 1e-6
+
+# 计算占位所需的列（与 BrickStore 的列名相同）
+FOOTPRINT_COLUMNS = ("px", "py", "pz", "nx", "ny", "nz", "dx", "dz", "rot", "tx", "tz")
+
+# 占位的字段 -> dtype（BrickStore 以列的形式缓存每块积木的占位）
+FOOTPRINT_FIELDS = {
+    "cx": np.float64, "cz": np.float64, "hx": np.float64, "hz": np.float64,
+    "cos": np.float64, "sin": np.float64, "ex": np.float64, "ez": np.float64,
+    "aligned": bool, "layer": np.int64,
+}
+
+# 单块积木的占位（Python 数值）或多块积木的占位（NumPy 数组），字段含义相同
+Footprint = Dict[str, float]
+Footprints = Dict[str, np.ndarray]
+
+
+def _snap_unit(value: float) -> float:
+    # 旋转 90 度的倍数时 cos / sin 取精确值，避免包围盒因浮点误差多占一个网格单元
+    if abs(value) < 1e-9:
+        return 0.0
+    if abs(abs(value) - 1) < 1e-9:
+        return math.copysign(1.0, value)
+    return value
+
+
+def footprint(px: float, py: float, pz: float, nx: float, ny: float, nz: float,
+              dx: float, dz: float, rot: float, tx: float, tz: float) -> Footprint:
+    """
+    计算单块积木的实际占位：旋转后矩形的中心 (cx, cz)、半边长 (hx, hz)、朝向 (cos, sin)、
+    轴对齐包围盒的半边长 (ex, ez)、是否与坐标轴对齐 aligned 和所在层 layer
+    """
+    rotated = rot != 0
+    even_width = (dz if rotated else dx) % 2 == 0
+    even_depth = (dx if rotated else dz) % 2 == 0
+    gx = math.floor((px + nx) / BASE) * BASE + (BASE if even_width else BASE / 2)
+    gz = math.floor((pz + nz) / BASE) * BASE + (BASE if even_depth else BASE / 2)
+    # 前端取积木组中心高度的绝对值，地面以下的点也落在第 0 层
+    gy = math.floor((py + ny) / LAYER_HEIGHT) * LAYER_HEIGHT + LAYER_HEIGHT / 2
+
+    cos, sin = _snap_unit(math.cos(rot)), _snap_unit(math.sin(rot))
+    ox = min(max(tx, -(dx // 2)), dx // 2) * BASE
+    oz = min(max(tz, -(dz // 2)), dz // 2) * BASE
+    hx, hz = dx * BASE / 2, dz * BASE / 2
+    return {
+        "cx": gx + ox * cos + oz * sin,
+        "cz": gz - ox * sin + oz * cos,
+        "hx": hx,
+        "hz": hz,
+        "cos": cos,
+        "sin": sin,
+        "ex": hx * abs(cos) + hz * abs(sin),
+        "ez": hx * abs(sin) + hz * abs(cos),
+        "aligned": cos == 0 or sin == 0,
+        "layer": int(math.floor(abs(gy) / LAYER_HEIGHT)),
+    }
+
+
+def brick_footprint(brick: Dict) -> Footprint:
+    """
+    计算积木字典的实际占位，尺寸超出 [1, MAX_BRICK_DIMENSION] 时抛出 ValueError
+    """
+    dimensions = brick["dimensions"]
+    if not all(1 <= dimensions[key] <= MAX_BRICK_DIMENSION for key in ("x", "z")):
+        raise ValueError(f"积木尺寸必须在 1 到 {MAX_BRICK_DIMENSION} 之间: {dimensions}")
+    point = brick["intersect"]["point"]
+    normal = (brick["intersect"].get("face") or {}).get("normal") or {}
+    translation = brick.get("translation") or {}
+    return footprint(
+        point["x"], point["y"], point["z"],
+        normal.get("x", 0), normal.get("y", 0), normal.get("z", 0),
+        dimensions["x"], dimensions["z"],
+        brick.get("rotation") or 0,
+        translation.get("x", 0), translation.get("z", 0)
+    )
+
+
+def footprints(columns: Dict[str, np.ndarray]) -> Footprints:
+    """
+    按列批量计算多块积木的实际占位，结果与逐个调用 footprint 相同
+    """
+    px, py, pz, nx, ny, nz, dx, dz, rot, tx, tz = (
+        np.asarray(columns[name], dtype=np.float64) for name in FOOTPRINT_COLUMNS
+    )
+    rotated = rot != 0
+    even_width = np.where(rotated, dz, dx) % 2 == 0
+    even_depth = np.where(rotated, dx, dz) % 2 == 0
+    gx = np.floor((px + nx) / BASE) * BASE + np.where(even_width, BASE, BASE / 2)
+    gz = np.floor((pz + nz) / BASE) * BASE + np.where(even_depth, BASE, BASE / 2)
+    gy = np.floor((py + ny) / LAYER_HEIGHT) * LAYER_HEIGHT + LAYER_HEIGHT / 2
+
+    cos, sin = np.cos(rot), np.sin(rot)
+    cos[np.abs(cos) < 1e-9] = 0
+    sin[np.abs(sin) < 1e-9] = 0
+    cos[np.abs(np.abs(cos) - 1) < 1e-9] = np.sign(cos[np.abs(np.abs(cos) - 1) < 1e-9])
+    sin[np.abs(np.abs(sin) - 1) < 1e-9] = np.sign(sin[np.abs(np.abs(sin) - 1) < 1e-9])
+    ox = np.minimum(np.maximum(tx, -(dx // 2)), dx // 2) * BASE
+    oz = np.minimum(np.maximum(tz, -(dz // 2)), dz // 2) * BASE
+    hx, hz = dx * BASE / 2, dz * BASE / 2
+    abs_cos, abs_sin = np.abs(cos), np.abs(sin)
+    return {
+        "cx": gx + ox * cos + oz * sin,
+        "cz": gz - ox * sin + oz * cos,
+        "hx": hx,
+        "hz": hz,
+        "cos": cos,
+        "sin": sin,
+        "ex": hx * abs_cos + hz * abs_sin,
+        "ez": hx * abs_sin + hz * abs_cos,
+        "aligned": (cos == 0) | (sin == 0),
+        "layer": np.floor(np.abs(gy) / LAYER_HEIGHT).astype(np.int64),
+    }
+
+
+def stack(fps: List[Footprint]) -> Footprints:
+    """
+    将多块积木的单独占位合并为按列的占位
+    """
+    return {key: np.array([fp[key] for fp in fps]) for key in fps[0]}
+
+
+def footprint_bounds(fp: Footprint) -> Tuple[float, float, float, float, float, float]:
+    """
+    单块积木占位的轴对齐包围盒 (x0, x1, y0, y1, z0, z1)，用于空间网格索引
+    """
+    y0 = fp["layer"] * LAYER_HEIGHT
+    return (fp["cx"] - fp["ex"], fp["cx"] + fp["ex"], y0, y0 + LAYER_HEIGHT,
+            fp["cz"] - fp["ez"], fp["cz"] + fp["ez"])
+
+
+def _radius(fp, ux, uz):
+    # 矩形在轴 (ux, uz) 上投影的半长，局部 x 轴为 (cos, -sin)，局部 z 轴为 (sin, cos)
+    return (fp["hx"] * np.abs(fp["cos"] * ux - fp["sin"] * uz)
+            + fp["hz"] * np.abs(fp["sin"] * ux + fp["cos"] * uz))
+
+
+def collides(one: Footprint, many: Footprints) -> np.ndarray:
+    """
+    一块积木与多块积木是否碰撞，返回布尔数组
+    先比较所在层和轴对齐包围盒（旋转 90 度的倍数时即为精确结果），
+    只有涉及任意角度旋转的积木才以分离轴定理判断两个旋转矩形是否有面积重叠
+    """
+    dx = many["cx"] - one["cx"]
+    dz = many["cz"] - one["cz"]
+    hit = ((many["layer"] == one["layer"])
+           & (np.abs(dx) < many["ex"] + one["ex"] - EPSILON)
+           & (np.abs(dz) < many["ez"] + one["ez"] - EPSILON))
+    if not hit.any() or (one["aligned"] and many["aligned"][hit].all()):
+        return hit
+    for ux, uz in ((one["cos"], -one["sin"]), (one["sin"], one["cos"]),
+                   (many["cos"], -many["sin"]), (many["sin"], many["cos"])):
+        hit &= np.abs(dx * ux + dz * uz) < _radius(one, ux, uz) + _radius(many, ux, uz) - EPSILON
+    return hit
+
+
+def describe(fp: Footprint) -> Dict:
+    """
+    单块积木占位的可读描述（碰撞检测调试信息）
+    """
+    return {
+        "center": {"x": fp["cx"], "z": fp["cz"]},
+        "layer": fp["layer"],
+        "size": {"width": fp["hx"] * 2, "depth": fp["hz"] * 2},
+        "rotation": math.atan2(fp["sin"], fp["cos"]),
+    }
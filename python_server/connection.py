@@ -0,0 +1,159 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Optional, Union
+
+from fastapi import WebSocket
+
+from wire import ENCODING_JSON
+
+# 每个连接的发送队列长度上限
+SEND_QUEUE_SIZE = int(os.getenv("LEGO_SEND_QUEUE_SIZE", "256"))
+# 发送队列溢出策略：
+#   resync      - 清空队列，改为发送一份最新的房间状态（合并为最新状态）
+#   drop_oldest - 丢弃队列中最旧的可丢弃消息（光标、心跳），积木增量等不可丢弃的消息溢出时改为重新同步
+#   disconnect  - 断开慢速客户端
+OVERFLOW_POLICY = os.getenv("LEGO_SEND_OVERFLOW_POLICY", "resync")
+
+OVERFLOW_RESYNC = "resync"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DISCONNECT = "disconnect"
+
+
+class ClientConnection:
+    """
+    单个 WebSocket 连接的发送端
+    消息先进入有界队列，由独立的写任务依次发送，慢速客户端不会阻塞广播
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, room_id: str,
+                 on_closed: Optional[Callable[["ClientConnection"], Awaitable[None]]] = None,
+                 max_queue: int = SEND_QUEUE_SIZE, overflow_policy: str = OVERFLOW_POLICY,
+                 encoding: str = ENCODING_JSON):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.room_id = room_id
+        # 连接建立时协商的消息编码（json / binary），二进制消息以 bytes 发送
+        self.encoding = encoding
+        self.overflow_policy = overflow_policy
+        # 队列元素为 (消息, 是否可丢弃)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.closed = False
+        # 客户端 JOIN 时携带的持久化用户ID（用于重连时接管旧会话）
+        self.client_id: Optional[str] = None
+        # 最近一次收到任意消息（包括 PONG）/ 非心跳消息的时间
+        self.last_seen = self.last_active = time.monotonic()
+        # 正在进行的分块房间状态传输任务
+        self.transfer: Optional[asyncio.Task] = None
+        # 写任务每发送一条消息后置位，供 wait_drained 等待队列排空
+        self._drained = asyncio.Event()
+        # 写任务发送失败时的回调（通常用于从房间中移除该连接）
+        self._on_closed = on_closed
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def enqueue(self, message: Union[str, bytes], droppable: bool = False) -> bool:
+        """
+        将消息放入发送队列，队列已满时按溢出策略处理
+        droppable 表示消息丢失后不影响客户端状态（光标、心跳等不带版本号的消息），
+        带版本号的积木增量不可丢弃，丢失后客户端只能重新同步
+        返回 False 表示队列溢出且策略要求调用方进一步处理（重新同步或断开连接）
+        """
+        if self.closed:
+            return True
+        try:
+            self.queue.put_nowait((message, droppable))
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+            if self._drop_oldest_droppable():
+                self.queue.put_nowait((message, droppable))
+                return True
+            if droppable:
+                # 队列中都是不可丢弃的消息，丢弃新的可丢弃消息
+                return True
+        return False
+
+    def _drop_oldest_droppable(self) -> bool:
+        """
+        移除队列中最旧的一条可丢弃消息，其余消息保持原有顺序；没有可丢弃的消息时返回 False
+        """
+        entries = []
+        while not self.queue.empty():
+            entries.append(self.queue.get_nowait())
+        index = next((i for i, (_, droppable) in enumerate(entries) if droppable), None)
+        if index is not None:
+            del entries[index]
+        for entry in entries:
+            self.queue.put_nowait(entry)
+        return index is not None
+
+    def touch(self, active: bool = True):
+        """
+        记录收到客户端消息的时间，active 为 False 表示只是心跳回复
+        """
+        self.last_seen = time.monotonic()
+        if active:
+            self.last_active = self.last_seen
+
+    def reset(self, message: Union[str, bytes]):
+        """
+        清空发送队列，只保留给定的消息（用于溢出后重新同步最新状态）
+        """
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait((message, False))
+
+    async def wait_drained(self, depth: int = 0):
+        """
+        等待发送队列中的消息不多于 depth 条（大批量发送时的背压，避免占满队列导致其他消息溢出）
+        """
+        while not self.closed and self.queue.qsize() > depth:
+            self._drained.clear()
+            await self._drained.wait()
+
+    def cancel_transfer(self):
+        """
+        取消正在进行的分块房间状态传输（连接关闭或改为发送完整状态时）
+        """
+        if self.transfer is not None and not self.transfer.done():
+            self.transfer.cancel()
+        self.transfer = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    async def _writer(self):
+        try:
+            while True:
+                message, _ = await self.queue.get()
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(message)
+                self._drained.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"无法发送消息: {e}")
+            self.closed = True
+            self._drained.set()
+            if self._on_closed:
+                await self._on_closed(self)
+
+    async def close(self):
+        """
+        停止写任务，未发送的消息将被丢弃
+        """
+        self.closed = True
+        self._drained.set()
+        self.cancel_transfer()
+        task = self._writer_task
+        if not task.done() and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, Dict
+
+from rate_limit import TokenBucket
+
+# 合并后的光标帧发送频率（每秒次数）
+CURSOR_FLUSH_HZ = float(os.getenv("LEGO_CURSOR_FLUSH_HZ", "25"))
+# 每个用户每秒最多接收的光标消息数，超出的消息直接丢弃
+CURSOR_RATE_LIMIT = float(os.getenv("LEGO_CURSOR_RATE_LIMIT", "30"))
+
+
+class CursorAggregator:
+    """
+    房间内光标位置的合并器
+    每个用户只保留最新的光标位置，按固定频率将所有变化合并为一条 USER_CURSORS 消息广播
+    """
+
+    def __init__(self, room_id: str, flush: Callable[[str, str], Awaitable[None]],
+                 flush_hz: float = CURSOR_FLUSH_HZ, rate_limit: float = CURSOR_RATE_LIMIT):
+        self.room_id = room_id
+        self.interval = 1 / flush_hz
+        self.rate_limit = rate_limit
+        # 用户ID -> 最新的光标数据（自上次发送以来）
+        self.pending: Dict[str, Dict] = {}
+        # 用户ID -> 入站限流令牌桶
+        self.buckets: Dict[str, TokenBucket] = {}
+        self._flush = flush
+        self._task = asyncio.create_task(self._run())
+
+    def update(self, user_id: str, data: Dict) -> bool:
+        """
+        记录用户的最新光标位置，超出限流时返回 False
+        """
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.rate_limit)
+        if not bucket.consume():
+            return False
+        self.pending[user_id] = data
+        return True
+
+    def remove_user(self, user_id: str):
+        self.pending.pop(user_id, None)
+        self.buckets.pop(user_id, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.pending:
+                continue
+            # 整个房间只序列化一次
+            frame = json.dumps({"type": "USER_CURSORS", "data": list(self.pending.values())})
+            self.pending = {}
+            try:
+                await self._flush(self.room_id, frame)
+            except Exception as e:
+                print(f"发送光标消息失败: {str(e)}")
+
+    async def close(self):
+        task = self._task
+        if not task.done() and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
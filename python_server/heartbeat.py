@@ -0,0 +1,67 @@
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict
+
+from connection import ClientConnection
+
+# 心跳间隔（秒），每个间隔向房间内每个连接发送一次 PING
+HEARTBEAT_INTERVAL = float(os.getenv("LEGO_HEARTBEAT_INTERVAL", "15"))
+# 超过该时间（秒）没有收到任何消息（包括 PONG）的连接视为死亡连接
+HEARTBEAT_TIMEOUT = float(os.getenv("LEGO_HEARTBEAT_TIMEOUT", "45"))
+# 超过该时间（秒）只回复 PONG、没有发送其他消息的连接视为空闲连接，0 表示不清理空闲连接
+IDLE_TIMEOUT = float(os.getenv("LEGO_IDLE_TIMEOUT", "0"))
+
+PING_MESSAGE = json.dumps({"type": "PING"})
+
+
+class RoomHeartbeat:
+    """
+    房间的后台心跳任务
+    按固定间隔向每个连接发送 PING（进入发送队列，不阻塞），并清理超时未响应或长时间空闲的连接
+    """
+
+    def __init__(self, room_id: str, connections: Callable[[], Dict[str, ClientConnection]],
+                 evict: Callable[[ClientConnection, str], Awaitable[None]],
+                 interval: float = HEARTBEAT_INTERVAL, timeout: float = HEARTBEAT_TIMEOUT,
+                 idle_timeout: float = IDLE_TIMEOUT):
+        self.room_id = room_id
+        self.interval = interval
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        # 返回房间内当前的连接（用户ID -> 连接）
+        self._connections = connections
+        # 清理连接的回调，第二个参数为原因
+        self._evict = evict
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.beat()
+            except Exception as e:
+                print(f"房间 {self.room_id} 心跳检测失败: {str(e)}")
+
+    async def beat(self):
+        now = time.monotonic()
+        expired = []
+        for connection in list(self._connections().values()):
+            if connection.closed or now - connection.last_seen > self.timeout:
+                expired.append((connection, "心跳超时"))
+            elif self.idle_timeout and now - connection.last_active > self.idle_timeout:
+                expired.append((connection, "长时间空闲"))
+            else:
+                connection.enqueue(PING_MESSAGE, droppable=True)
+        for connection, reason in expired:
+            await self._evict(connection, reason)
+
+    async def close(self):
+        task = self._task
+        if not task.done() and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,64 @@
+"""
+房间最近的增量消息（按版本号连续），用于重连客户端的增量同步
+
+历史记录同时按条数和积木数限制：单条增量最多可以携带数万块积木，只按条数限制时历史记录可能占用大量内存，
+重连客户端补发的增量也可能比完整的房间状态大得多
+"""
+import os
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional
+
+# 每个房间保留的增量消息条数，重连客户端落后更多时改为发送完整的房间状态
+HISTORY_SIZE = int(os.getenv("LEGO_HISTORY_SIZE", "1000"))
+# 每个房间的历史增量中最多保存的积木数（BRICK_REMOVED 按积木ID计），超出时移除最旧的增量
+HISTORY_MAX_BRICKS = int(os.getenv("LEGO_HISTORY_MAX_BRICKS", "100000"))
+
+
+def delta_size(delta: Dict) -> int:
+    """
+    增量消息携带的积木数（BRICK_REMOVED 为积木ID数，BRICKS_CLEARED 为 0）
+    """
+    data = delta["data"]
+    return len(data.get("bricks") or data.get("ids") or ())
+
+
+class DeltaHistory:
+    """
+    按版本号连续保存最近的增量消息，条数不超过 max_entries，积木数不超过 max_bricks
+    """
+
+    def __init__(self, max_entries: int = HISTORY_SIZE, max_bricks: int = HISTORY_MAX_BRICKS):
+        self.max_entries = max_entries
+        self.max_bricks = max_bricks
+        self._deltas: Deque[Dict] = deque()
+        # 所有增量中的积木数
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._deltas)
+
+    def __iter__(self) -> Iterator[Dict]:
+        return iter(self._deltas)
+
+    def append(self, delta: Dict):
+        self._deltas.append(delta)
+        self.size += delta_size(delta)
+        # 超过单条上限的增量也会被移除，之后落后的客户端改为接收完整的房间状态
+        while self._deltas and (len(self._deltas) > self.max_entries or self.size > self.max_bricks):
+            self.size -= delta_size(self._deltas.popleft())
+
+    def extend(self, deltas: List[Dict]):
+        for delta in deltas:
+            self.append(delta)
+
+    def since(self, version: int) -> Optional[List[Dict]]:
+        """
+        返回版本号 version 之后的所有增量，历史记录无法覆盖时返回 None
+        """
+        if not self._deltas:
+            return None
+        # 历史记录中的版本号是连续的，可以直接计算起始位置
+        oldest = self._deltas[0]["data"]["version"]
+        if version < oldest - 1:
+            return None
+        return list(self._deltas)[version - oldest + 1:]
@@ -1,6 +1,16 @@
+import asyncio
 import requests
 import json
-from typing import Dict, List, Optional, Union, Any
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Union, Any
+
+import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 可以安全重试的请求方法；POST 只在请求写入连接之前失败时重试（服务端不可能处理过该请求），避免重复添加积木
+IDEMPOTENT_METHODS = frozenset({"GET", "DELETE"})
+# 服务端暂时不可用时重试的状态码
+RETRY_STATUS_CODES = (502, 503, 504)
 
 
 class LegoBuilder:
@@ -9,19 +19,56 @@ class LegoBuilder:
     封装了对 Lego Builder 服务器 HTTP 接口的请求方法
     """
     
-    def __init__(self, base_url: str = "http://localhost:8000"):
+    def __init__(self, base_url: str = "http://localhost:8000", pool_size: int = 10,
+                 retries: int = 3, backoff_factor: float = 0.2, timeout: float = 30):
         """
         初始化 Lego Builder 客户端
         
         Args:
             base_url: API 服务器的基础 URL，默认为 http://localhost:8000
+            pool_size: 连接池中保持的连接数，默认为 10
+            retries: 失败时的最大重试次数，默认为 3
+            backoff_factor: 重试间隔的退避系数（秒），第 n 次重试前等待 backoff_factor * 2^(n-1)
+            timeout: 单个请求的超时时间（秒），默认为 30
         """
         self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        
+        # 所有请求复用同一个会话，连接保持 keep-alive，避免每次请求重新建立 TCP 连接
+        # urllib3 对连接建立失败（请求尚未发出）的重试不检查请求方法，POST 也会重试；
+        # allowed_methods 只限制读取响应失败和状态码的重试，请求已发出的 POST 不会重试
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+    
+    def close(self):
+        """
+        关闭会话，释放连接池中的连接
+        """
+        self.session.close()
+    
+    def __enter__(self) -> "LegoBuilder":
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
     
     def add_brick(self, room_id: str, x: float, y: float, z: float, 
                  dimensions_x: int, dimensions_z: int, 
                  color: str = "#ff0000", rotation: float = 0, 
-                 translation_x: float = 0, translation_z: float = 0) -> Dict[str, Any]:
+                 translation_x: float = 0, translation_z: float = 0,
+                 debug: bool = False) -> Dict[str, Any]:
         """
         通过坐标添加积木到指定房间
         
@@ -36,6 +83,7 @@ class LegoBuilder:
             rotation: 积木的旋转角度，默认为 0
             translation_x: 积木的 x 平移，默认为 0
             translation_z: 积木的 z 平移，默认为 0
+            debug: 是否在发生碰撞时返回碰撞检测的调试信息，默认为 False
             
         Returns:
             包含添加积木结果的字典
@@ -44,6 +92,8 @@ class LegoBuilder:
         
         # 构建请求参数
         params = {"room_id": room_id}
+        if debug:
+            params["debug"] = "true"
         
         # 构建积木数据，与 app.py 中的 BrickCoordinates 模型保持一致
         data = {
@@ -59,28 +109,227 @@ class LegoBuilder:
         }
         
         # 发送请求
-        response = requests.post(url, params=params, json=data)
+        response = self.session.post(url, params=params, json=data, timeout=self.timeout)
         
         # 检查响应状态
         response.raise_for_status()
         
         # 返回响应数据
         return response.json()
-    
-    def get_all_bricks(self, room_id: str) -> Dict[str, Any]:
+
+    def add_bricks(self, room_id: str, bricks: List[Dict[str, Any]],
+                  atomic: bool = True) -> Dict[str, Any]:
+        """
+        通过一次请求批量添加积木到指定房间
+
+        Args:
+            room_id: 房间 ID
+            bricks: 积木列表，每个元素的字段与 add_brick 的参数一致
+                    (x, y, z, dimensions_x, dimensions_z, color, rotation, translation_x, translation_z)
+            atomic: 为 True 时任意积木碰撞则整批不添加；为 False 时跳过碰撞的积木，添加其余积木
+
+        Returns:
+            包含批量添加结果的字典（added 为成功添加的积木，failed 为碰撞的积木序号）
+        """
+        url = f"{self.base_url}/api/bricks/add_batch"
+
+        # 构建请求参数
+        params = {"room_id": room_id}
+
+        # 构建批量数据，与 app.py 中的 BrickBatch 模型保持一致
+        data = {
+            "bricks": bricks,
+            "atomic": atomic
+        }
+
+        # 发送请求
+        response = self.session.post(url, params=params, json=data, timeout=self.timeout)
+
+        # 检查响应状态
+        response.raise_for_status()
+
+        # 返回响应数据
+        return response.json()
+
+    def add_shape(self, room_id: str, shapes: List[Dict[str, Any]], color: str = "#ff0000",
+                  max_dimensions_x: int = 4, max_dimensions_z: int = 2,
+                  atomic: bool = False) -> Dict[str, Any]:
+        """
+        在服务器端生成形状并添加到指定房间，形状被光栅化为体素后合并为尽可能大的积木
+
+        Args:
+            room_id: 房间 ID
+            shapes: 形状列表，按顺序合成（字段见 app.py 中的 ShapeSpec），例如
+                    {"type": "sphere", "x": 0, "y": 5, "z": 0, "radius": 5, "hollow": True}
+                    {"type": "box", "x": 0, "y": 0, "z": 0, "size_x": 3, "size_y": 2, "size_z": 3, "subtract": True}
+            color: 没有指定颜色的形状使用的颜色
+            max_dimensions_x: 合并后积木在 x 方向的最大尺寸
+            max_dimensions_z: 合并后积木在 z 方向的最大尺寸
+            atomic: 为 True 时任意体素被已有积木占据则整个形状不添加；为 False 时跳过被占据的体素
+
+        Returns:
+            包含生成结果的字典（voxels 为体素数，skipped_voxels 为被占据的体素数，brick_ids 为添加的积木）
+        """
+        url = f"{self.base_url}/api/bricks/shape"
+
+        # 构建请求参数
+        params = {"room_id": room_id}
+
+        # 构建形状数据，与 app.py 中的 ShapeRequest 模型保持一致
+        data = {
+            "shapes": shapes,
+            "color": color,
+            "max_dimensions_x": max_dimensions_x,
+            "max_dimensions_z": max_dimensions_z,
+            "atomic": atomic
+        }
+
+        # 发送请求
+        response = self.session.post(url, params=params, json=data, timeout=self.timeout)
+
+        # 检查响应状态
+        response.raise_for_status()
+
+        # 返回响应数据
+        return response.json()
+
+    def undo(self, room_id: str, user_id: Optional[str] = None, redo: bool = False) -> Dict[str, Any]:
+        """
+        撤销（redo 为 True 时重做）最近的一次积木变更
+        
+        Args:
+            room_id: 房间 ID
+            user_id: WebSocket 客户端的持久化用户 ID，默认撤销通过 REST 接口进行的变更
+            redo: 为 True 时重做最近撤销的变更
+            
+        Returns:
+            包含结果的字典（status、被回退的积木 ID added / removed / updated、被跳过的积木 skipped）
+        """
+        url = f"{self.base_url}/api/bricks/{'redo' if redo else 'undo'}"
+        
+        # 构建请求参数
+        params = {"room_id": room_id}
+        if user_id:
+            params["user_id"] = user_id
+        
+        # 发送请求
+        response = self.session.post(url, params=params, timeout=self.timeout)
+        
+        # 检查响应状态
+        response.raise_for_status()
+        
+        # 返回响应数据
+        return response.json()
+
+    def get_all_bricks(self, room_id: str, cursor: Optional[int] = None, limit: Optional[int] = None,
+                       fields: Optional[List[str]] = None) -> Dict[str, Any]:
         """
         获取指定房间内所有积木的详细信息
         
         Args:
             room_id: 房间 ID
+            cursor: 上一页返回的 next_cursor，默认从第一个积木开始
+            limit: 最多返回的积木数，默认返回全部
+            fields: 需要返回的字段列表，例如 ["id", "position", "color"]，默认返回全部字段
+            
+        Returns:
+            包含积木信息的字典（next_cursor 不为 None 时表示还有下一页）
+        """
+        url = f"{self.base_url}/api/bricks/{room_id}"
+        
+        # 构建请求参数
+        params = {}
+        if cursor is not None:
+            params["cursor"] = cursor
+        if limit is not None:
+            params["limit"] = limit
+        if fields:
+            params["fields"] = ",".join(fields)
+        
+        # 发送请求
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        
+        # 检查响应状态
+        response.raise_for_status()
+        
+        # 返回响应数据
+        return response.json()
+    
+    def iter_bricks(self, room_id: str, fields: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        以 NDJSON 流式逐个获取房间内的积木信息，适合导出积木数量很多的房间
+        
+        Args:
+            room_id: 房间 ID
+            fields: 需要返回的字段列表，默认返回全部字段
             
         Returns:
-            包含所有积木信息的字典
+            逐个产生积木信息字典的迭代器
         """
         url = f"{self.base_url}/api/bricks/{room_id}"
         
+        # 构建请求参数
+        params = {"format": "ndjson"}
+        if fields:
+            params["fields"] = ",".join(fields)
+        
+        # 发送请求并逐行读取响应
+        with self.session.get(url, params=params, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+    
+    def query_bricks(self, room_id: str, cursor: Optional[int] = None, limit: Optional[int] = None,
+                     fields: Optional[List[str]] = None, **filters: Any) -> Dict[str, Any]:
+        """
+        按条件查询房间内的积木，由服务器端的索引筛选，无需获取整个房间
+        
+        Args:
+            room_id: 房间 ID
+            cursor: 上一页返回的 next_cursor，默认从第一个匹配的积木开始
+            limit: 最多返回的积木数，默认返回全部
+            fields: 需要返回的字段列表，默认返回全部字段
+            filters: 查询条件，可选 x_min / x_max / z_min / z_max（场景坐标中的区域）、
+                     layer_min / layer_max、color、dimensions_x / dimensions_z
+            
+        Returns:
+            包含匹配积木的字典（total_matches 为匹配的积木数）
+        """
+        url = f"{self.base_url}/api/bricks/{room_id}/query"
+        
+        # 构建请求参数
+        params = {key: value for key, value in filters.items() if value is not None}
+        if cursor is not None:
+            params["cursor"] = cursor
+        if limit is not None:
+            params["limit"] = limit
+        if fields:
+            params["fields"] = ",".join(fields)
+        
         # 发送请求
-        response = requests.get(url)
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        
+        # 检查响应状态
+        response.raise_for_status()
+        
+        # 返回响应数据
+        return response.json()
+    
+    def get_brick_stats(self, room_id: str) -> Dict[str, Any]:
+        """
+        获取房间内每个层 / 颜色 / 尺寸的积木数
+        
+        Args:
+            room_id: 房间 ID
+            
+        Returns:
+            包含统计信息的字典（layers / colors / dimensions）
+        """
+        url = f"{self.base_url}/api/bricks/{room_id}/stats"
+        
+        # 发送请求
+        response = self.session.get(url, timeout=self.timeout)
         
         # 检查响应状态
         response.raise_for_status()
@@ -102,7 +351,7 @@ class LegoBuilder:
         url = f"{self.base_url}/api/bricks/{room_id}/{brick_id}"
         
         # 发送请求
-        response = requests.get(url)
+        response = self.session.get(url, timeout=self.timeout)
         
         # 检查响应状态
         response.raise_for_status()
@@ -124,7 +373,7 @@ class LegoBuilder:
         url = f"{self.base_url}/api/bricks/{room_id}/{brick_id}"
         
         # 发送请求
-        response = requests.delete(url)
+        response = self.session.delete(url, timeout=self.timeout)
         
         # 检查响应状态
         response.raise_for_status()
@@ -133,6 +382,229 @@ class LegoBuilder:
         return response.json()
 
 
+
+class AsyncLegoBuilder:
+    """
+    异步 Lego Builder API 客户端
+    所有请求复用同一个 aiohttp 会话（keep-alive 连接池），并发请求数受 max_concurrency 限制，
+    连接失败或服务端暂时不可用时按指数退避重试；POST 只在请求写入连接之前失败时重试
+
+    使用示例:
+        async with AsyncLegoBuilder() as client:
+            results = await asyncio.gather(*[
+                client.add_brick("room1", x=i, y=0, z=0, dimensions_x=1, dimensions_z=1)
+                for i in range(1000)
+            ])
+    """
+    
+    def __init__(self, base_url: str = "http://localhost:8000", max_concurrency: int = 16,
+                 retries: int = 3, backoff_factor: float = 0.2, timeout: float = 30):
+        """
+        初始化异步 Lego Builder 客户端
+        
+        Args:
+            base_url: API 服务器的基础 URL，默认为 http://localhost:8000
+            max_concurrency: 同时进行的最大请求数（也是连接池大小），默认为 16
+            retries: 失败时的最大重试次数，默认为 3
+            backoff_factor: 重试间隔的退避系数（秒），第 n 次重试前等待 backoff_factor * 2^(n-1)
+            timeout: 单个请求的超时时间（秒），默认为 30
+        """
+        self.base_url = base_url.rstrip('/')
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        # 会话在第一次请求时创建（需要在事件循环中创建）
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_headers_sent.append(self._on_request_sent)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                                  trace_configs=[trace_config])
+        return self._session
+    
+    @staticmethod
+    async def _on_request_sent(session, context, params):
+        # 请求开始写入连接，之后失败时服务端可能已经处理了该请求
+        context.trace_request_ctx["sent"] = True
+    
+    async def close(self):
+        """
+        关闭会话，释放连接池中的连接
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+    
+    async def __aenter__(self) -> "AsyncLegoBuilder":
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.close()
+    
+    def _should_retry(self, method: str, error: Optional[Exception], status: Optional[int],
+                      sent: bool = True) -> bool:
+        if error is not None:
+            # 请求写入连接之前失败（连接建立失败、复用的连接已被服务端关闭等）时服务端没有收到请求，任何方法都可以重试
+            if not sent:
+                return True
+            return method in IDEMPOTENT_METHODS and isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+        return method in IDEMPOTENT_METHODS and status in RETRY_STATUS_CODES
+    
+    async def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        """
+        发送请求并返回 JSON 响应，失败时按指数退避重试
+        """
+        url = f"{self.base_url}{path}"
+        session = self._get_session()
+        attempt = 0
+        while True:
+            error = None
+            status = None
+            # 由 _on_request_sent 在请求开始写入连接时标记
+            trace_ctx = {"sent": False}
+            async with self._semaphore:
+                try:
+                    async with session.request(method, url, trace_request_ctx=trace_ctx, **kwargs) as response:
+                        status = response.status
+                        if not self._should_retry(method, None, status) or attempt >= self.retries:
+                            # 检查响应状态
+                            response.raise_for_status()
+                            # 返回响应数据
+                            return await response.json()
+                except aiohttp.ClientResponseError:
+                    raise
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if not self._should_retry(method, e, None, trace_ctx["sent"]) or attempt >= self.retries:
+                        raise
+                    error = e
+            # 在信号量之外等待，不占用并发名额
+            attempt += 1
+            delay = self.backoff_factor * (2 ** (attempt - 1))
+            print(f"请求 {method} {path} 失败（{error or status}），{delay:.2f} 秒后第 {attempt} 次重试")
+            await asyncio.sleep(delay)
+    
+    async def add_brick(self, room_id: str, x: float, y: float, z: float,
+                        dimensions_x: int, dimensions_z: int,
+                        color: str = "#ff0000", rotation: float = 0,
+                        translation_x: float = 0, translation_z: float = 0,
+                        debug: bool = False) -> Dict[str, Any]:
+        """
+        通过坐标添加积木到指定房间，参数与 LegoBuilder.add_brick 相同
+        """
+        data = {
+            "x": x,
+            "y": y,
+            "z": z,
+            "dimensions_x": dimensions_x,
+            "dimensions_z": dimensions_z,
+            "color": color,
+            "rotation": rotation,
+            "translation_x": translation_x,
+            "translation_z": translation_z
+        }
+        params = {"room_id": room_id}
+        if debug:
+            params["debug"] = "true"
+        return await self._request("POST", "/api/bricks/add", params=params, json=data)
+    
+    async def add_bricks(self, room_id: str, bricks: List[Dict[str, Any]],
+                         atomic: bool = True) -> Dict[str, Any]:
+        """
+        通过一次请求批量添加积木到指定房间，参数与 LegoBuilder.add_bricks 相同
+        """
+        data = {"bricks": bricks, "atomic": atomic}
+        return await self._request("POST", "/api/bricks/add_batch", params={"room_id": room_id}, json=data)
+    
+    async def add_shape(self, room_id: str, shapes: List[Dict[str, Any]], color: str = "#ff0000",
+                        max_dimensions_x: int = 4, max_dimensions_z: int = 2,
+                        atomic: bool = False) -> Dict[str, Any]:
+        """
+        在服务器端生成形状并添加到指定房间，参数与 LegoBuilder.add_shape 相同
+        """
+        data = {
+            "shapes": shapes,
+            "color": color,
+            "max_dimensions_x": max_dimensions_x,
+            "max_dimensions_z": max_dimensions_z,
+            "atomic": atomic
+        }
+        return await self._request("POST", "/api/bricks/shape", params={"room_id": room_id}, json=data)
+    
+    async def undo(self, room_id: str, user_id: Optional[str] = None, redo: bool = False) -> Dict[str, Any]:
+        """
+        撤销（redo 为 True 时重做）最近的一次积木变更，参数与 LegoBuilder.undo 相同
+        """
+        params = {"room_id": room_id}
+        if user_id:
+            params["user_id"] = user_id
+        return await self._request("POST", f"/api/bricks/{'redo' if redo else 'undo'}", params=params)
+    
+    async def get_all_bricks(self, room_id: str, cursor: Optional[int] = None, limit: Optional[int] = None,
+                             fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """
+        获取指定房间内的积木信息，参数与 LegoBuilder.get_all_bricks 相同
+        """
+        params = {}
+        if cursor is not None:
+            params["cursor"] = cursor
+        if limit is not None:
+            params["limit"] = limit
+        if fields:
+            params["fields"] = ",".join(fields)
+        return await self._request("GET", f"/api/bricks/{room_id}", params=params)
+    
+    async def iter_bricks(self, room_id: str, fields: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        以 NDJSON 流式逐个获取房间内的积木信息
+        """
+        params = {"format": "ndjson"}
+        if fields:
+            params["fields"] = ",".join(fields)
+        session = self._get_session()
+        async with self._semaphore:
+            async with session.get(f"{self.base_url}/api/bricks/{room_id}", params=params) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    if line.strip():
+                        yield json.loads(line)
+    
+    async def query_bricks(self, room_id: str, cursor: Optional[int] = None, limit: Optional[int] = None,
+                           fields: Optional[List[str]] = None, **filters: Any) -> Dict[str, Any]:
+        """
+        按条件查询房间内的积木，参数与 LegoBuilder.query_bricks 相同
+        """
+        params = {key: value for key, value in filters.items() if value is not None}
+        if cursor is not None:
+            params["cursor"] = cursor
+        if limit is not None:
+            params["limit"] = limit
+        if fields:
+            params["fields"] = ",".join(fields)
+        return await self._request("GET", f"/api/bricks/{room_id}/query", params=params)
+    
+    async def get_brick_stats(self, room_id: str) -> Dict[str, Any]:
+        """
+        获取房间内每个层 / 颜色 / 尺寸的积木数
+        """
+        return await self._request("GET", f"/api/bricks/{room_id}/stats")
+    
+    async def get_brick_by_id(self, room_id: str, brick_id: str) -> Dict[str, Any]:
+        """
+        通过积木ID获取特定积木的详细信息
+        """
+        return await self._request("GET", f"/api/bricks/{room_id}/{brick_id}")
+    
+    async def delete_brick(self, room_id: str, brick_id: str) -> Dict[str, Any]:
+        """
+        通过积木ID删除特定积木
+        """
+        return await self._request("DELETE", f"/api/bricks/{room_id}/{brick_id}")
+
 # 使用示例
 if __name__ == "__main__":
     # 创建 Lego Builder 客户端
@@ -0,0 +1,274 @@
+"""
+房间生命周期管理
+
+内存中的房间按最近活动时间排序（LRU）。没有连接的房间空闲超过 ROOM_IDLE_SECONDS，
+或所有房间的估算内存超过 ROOM_MEMORY_BUDGET 时（从最久未活动的房间开始），房间被休眠：
+序列化为紧凑的二进制文件（列式积木表 + zlib 压缩）并从内存中移除。
+用户连接或 REST 请求访问休眠的房间时再从文件中恢复，恢复后删除休眠文件。
+
+休眠文件格式（zlib 压缩前，小端序）:
+    u8   格式版本（HIBERNATE_VERSION）
+    u32  元数据长度
+    ...  元数据：UTF-8 JSON {"version", "epoch", "extras"}，积木表无法编码时为 {"version", "epoch", "bricks": [...]}
+    ...  积木表（格式见 wire.py）
+"""
+import asyncio
+import json
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Set
+from urllib.parse import quote
+
+from brick_store import BrickStore
+from persistence import DATA_DIR
+from wire import decode_brick_store, encode_bricks
+
+# 休眠后端：file（休眠到本地文件）或 none（不休眠，被淘汰的房间直接卸载，只能从持久化存储恢复）
+HIBERNATION_BACKEND = os.getenv("LEGO_HIBERNATION", "file")
+# 休眠文件目录
+HIBERNATE_DIR = os.getenv("LEGO_HIBERNATE_DIR", os.path.join(DATA_DIR, "hibernated"))
+# 没有连接的房间空闲多少秒后休眠，0 表示最后一个用户离开后立即休眠
+ROOM_IDLE_SECONDS = float(os.getenv("LEGO_ROOM_IDLE_SECONDS", "300"))
+# 内存中所有房间的估算内存上限（MB），超过后从最久未活动的空闲房间开始休眠
+ROOM_MEMORY_BUDGET = int(float(os.getenv("LEGO_ROOM_MEMORY_BUDGET_MB", "1024")) * 1024 * 1024)
+# 检查空闲房间和内存预算的间隔（秒）
+SWEEP_INTERVAL = float(os.getenv("LEGO_ROOM_SWEEP_INTERVAL", "5"))
+# 刚被访问过（秒）的房间即使超出内存预算也不休眠，避免正在处理的 REST 请求所用的房间被移除
+MIN_IDLE_SECONDS = 1.0
+
+HIBERNATE_VERSION = 1
+# 休眠文件的 zlib 压缩级别（列式数据本身已经很紧凑，使用较快的级别）
+COMPRESS_LEVEL = 1
+
+
+def dump_room(state: Dict) -> bytes:
+    """
+    将房间状态（{"bricks": BrickStore, "version": ..., "epoch": ...}）序列化为休眠文件内容
+    """
+    store: BrickStore = state["bricks"]
+    meta = {"version": state["version"], "epoch": state["epoch"]}
+    try:
+        body, meta["extras"] = encode_bricks(store)
+    except (ValueError, OverflowError):
+        # uID 过长或颜色过多等无法使用积木表时，积木以 JSON 保存
+        body = b""
+        meta["bricks"] = store.to_list()
+    meta_bytes = json.dumps(meta).encode("utf-8")
+    return zlib.compress(struct.pack("<BI", HIBERNATE_VERSION, len(meta_bytes)) + meta_bytes + body, COMPRESS_LEVEL)
+
+
+def parse_room(raw: bytes) -> Dict:
+    """
+    解析休眠文件内容，返回 {"bricks": BrickStore, "version": ..., "epoch": ...}
+    """
+    buffer = memoryview(zlib.decompress(raw))
+    version, meta_length = struct.unpack_from("<BI", buffer, 0)
+    if version != HIBERNATE_VERSION:
+        raise ValueError(f"不支持的休眠文件版本: {version}")
+    meta = json.loads(bytes(buffer[5:5 + meta_length]).decode("utf-8"))
+    if "bricks" in meta:
+        bricks = BrickStore.from_bricks(meta["bricks"])
+    else:
+        bricks = decode_brick_store(buffer[5 + meta_length:], meta.get("extras"))
+    return {"bricks": bricks, "version": meta["version"], "epoch": meta["epoch"]}
+
+
+class HibernationStore:
+    """
+    休眠存储的基类，默认不休眠（save 不做任何事，load 总是返回 None）
+    """
+
+    async def stop(self):
+        pass
+
+    def exists(self, room_id: str) -> bool:
+        return False
+
+    def save(self, room_id: str, state: Dict):
+        """
+        休眠房间：立即记录状态（随后的 load 可以直接取回），在后台线程中写入文件
+        state 中的 BrickStore 之后不能再被修改（房间随即从内存中移除）
+        """
+
+    async def load(self, room_id: str) -> Optional[Dict]:
+        """
+        取回休眠的房间状态并删除休眠文件，房间未休眠时返回 None
+        """
+        return None
+
+
+class FileHibernation(HibernationStore):
+    """
+    每个休眠的房间保存为一个文件
+    """
+
+    def __init__(self, directory: str = HIBERNATE_DIR):
+        self.directory = directory
+        # 正在写入的房间状态，写入完成前被恢复的房间直接从这里取回
+        self._pending: Dict[str, Dict] = {}
+        self._writes: Set[asyncio.Task] = set()
+
+    def _path(self, room_id: str) -> str:
+        # 房间ID经过转义并加上前缀后作为文件名，避免路径穿越
+        return os.path.join(self.directory, "room-" + quote(room_id, safe="") + ".bin")
+
+    async def stop(self):
+        # 等待所有休眠文件写完
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def exists(self, room_id: str) -> bool:
+        return room_id in self._pending or os.path.exists(self._path(room_id))
+
+    def save(self, room_id: str, state: Dict):
+        self._pending[room_id] = state
+        task = asyncio.create_task(self._write(room_id, state))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _write(self, room_id: str, state: Dict):
+        try:
+            await asyncio.to_thread(self._write_file, room_id, state)
+        except Exception as e:
+            print(f"房间 {room_id} 休眠文件写入失败: {str(e)}")
+        if self._pending.get(room_id) is state:
+            del self._pending[room_id]
+        else:
+            # 写入过程中房间已被恢复，文件中的状态已经过期
+            await asyncio.to_thread(self._remove_file, room_id)
+
+    def _write_file(self, room_id: str, state: Dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(room_id)
+        # 先写临时文件再替换，保证休眠文件总是完整的
+        with open(path + ".tmp", "wb") as f:
+            f.write(dump_room(state))
+        os.replace(path + ".tmp", path)
+
+    def _remove_file(self, room_id: str):
+        try:
+            os.remove(self._path(room_id))
+        except FileNotFoundError:
+            pass
+
+    async def load(self, room_id: str) -> Optional[Dict]:
+        state = self._pending.pop(room_id, None)
+        if state is not None:
+            return state
+        return await asyncio.to_thread(self._read_file, room_id)
+
+    def _read_file(self, room_id: str) -> Optional[Dict]:
+        path = self._path(room_id)
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            state = parse_room(raw)
+        except Exception as e:
+            # 文件损坏时改为从持久化存储恢复（保留文件以便排查，房间再次休眠时会被覆盖）
+            print(f"房间 {room_id} 休眠文件解析失败: {str(e)}")
+            return None
+        # 房间恢复到内存后休眠文件即过期
+        os.remove(path)
+        return state
+
+
+def create_hibernation() -> HibernationStore:
+    """
+    根据 LEGO_HIBERNATION 环境变量创建休眠存储
+    """
+    if HIBERNATION_BACKEND == "file":
+        return FileHibernation()
+    return HibernationStore()
+
+
+class RoomLifecycle:
+    """
+    按最近活动时间（LRU）管理内存中的房间，后台定期休眠空闲过久或超出内存预算的房间
+
+    需要通过 bind 提供以下回调：
+        pinned(room_id)   -> 房间是否不能休眠（例如仍有连接）
+        memory(room_id)   -> 房间的估算内存（字节）
+        evict(room_id)    -> 休眠并从内存中移除房间
+    """
+
+    def __init__(self, memory_budget: int = ROOM_MEMORY_BUDGET, idle_seconds: float = ROOM_IDLE_SECONDS,
+                 sweep_interval: float = SWEEP_INTERVAL):
+        self.memory_budget = memory_budget
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        # 房间ID -> 最近活动时间，按活动时间从旧到新排列
+        self._last_active: "OrderedDict[str, float]" = OrderedDict()
+        self.pinned: Optional[Callable[[str], bool]] = None
+        self.memory: Optional[Callable[[str], int]] = None
+        self.evict: Optional[Callable[[str], Awaitable[None]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def bind(self, pinned, memory, evict):
+        self.pinned = pinned
+        self.memory = memory
+        self.evict = evict
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def touch(self, room_id: str):
+        """
+        记录房间的一次活动
+        """
+        self._last_active[room_id] = time.monotonic()
+        self._last_active.move_to_end(room_id)
+
+    def forget(self, room_id: str):
+        """
+        房间已从内存中移除
+        """
+        self._last_active.pop(room_id, None)
+
+    def idle_for(self, room_id: str) -> float:
+        last_active = self._last_active.get(room_id)
+        return 0.0 if last_active is None else time.monotonic() - last_active
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"房间休眠检查失败: {str(e)}")
+
+    async def sweep(self) -> int:
+        """
+        从最久未活动的房间开始，休眠空闲超时的房间，以及超出内存预算时的空闲房间，返回休眠的房间数
+        """
+        now = time.monotonic()
+        total = sum(self.memory(room_id) for room_id in self._last_active)
+        hibernated = 0
+        for room_id, last_active in list(self._last_active.items()):
+            idle = now - last_active
+            if total <= self.memory_budget and idle < self.idle_seconds:
+                # 之后的房间活动时间更近，既未超时也无需为预算腾出内存
+                break
+            expired = idle >= self.idle_seconds
+            if self.pinned(room_id) or (not expired and idle < MIN_IDLE_SECONDS):
+                continue
+            size = self.memory(room_id)
+            await self.evict(room_id)
+            total -= size
+            hibernated += 1
+        return hibernated
@@ -0,0 +1,175 @@
+"""
+轻量级指标采集，以 Prometheus 文本格式（0.0.4）导出，不依赖 prometheus_client
+
+热路径上只做计数和分桶（一次二分查找），房间数、连接数等状态类指标在抓取时才计算
+多进程模式下每个 worker 进程分别统计
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 默认的耗时分桶（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    单调递增的计数器
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Metric):
+    """
+    在抓取时由回调计算的瞬时值
+    无标签时回调返回数值，有标签时返回 {标签值元组: 数值}
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 collect: Optional[Callable[[], object]] = None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        if self.collect is None:
+            return []
+        result = self.collect()
+        if not self.labels:
+            return [f"{self.name} {_format_value(result)}"]
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in result.items()
+        ]
+
+
+class Histogram(Metric):
+    """
+    固定分桶的直方图，observe 只需一次二分查找
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # 标签值 -> [各分桶计数（非累计，最后一个为 +Inf）, 总和, 总数]
+        self.values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+
+def render() -> str:
+    """
+    以 Prometheus 文本格式导出所有指标
+    """
+    lines = []
+    for metric in REGISTRY:
+        try:
+            samples = metric.render()
+        except Exception as e:
+            print(f"采集指标 {metric.name} 失败: {str(e)}")
+            continue
+        lines.extend(metric.header())
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+# WebSocket 消息处理
+ws_messages = Counter("lego_ws_messages_total", "收到的 WebSocket 消息数", ("type",))
+ws_message_seconds = Histogram("lego_ws_message_seconds", "handle_message 处理单条消息的耗时", ("type",))
+ws_message_errors = Counter("lego_ws_message_errors_total", "处理失败的 WebSocket 消息数", ("reason",))
+ws_limited_messages = Counter("lego_ws_limited_messages_total", "超出入站限制被丢弃的 WebSocket 消息数", ("reason",))
+ws_limit_disconnects = Counter("lego_ws_limit_disconnects_total", "违规次数过多被断开的 WebSocket 连接数")
+
+# 广播
+broadcast_seconds = Histogram("lego_broadcast_seconds", "一条消息投递到房间内所有连接发送队列的耗时")
+broadcast_recipients = Counter("lego_broadcast_recipients_total", "广播投递的连接数（按消息累计）")
+queue_overflows = Counter("lego_send_queue_overflows_total", "发送队列溢出次数", ("policy",))
+
+# 房间生命周期
+room_hibernations = Counter("lego_room_hibernations_total", "休眠（从内存中移除）的房间数")
+room_rehydrations = Counter("lego_room_rehydrations_total", "从磁盘恢复到内存的房间数", ("source",))
+
+# 碰撞检测
+collision_check_seconds = Histogram("lego_collision_check_seconds", "碰撞检测的耗时（endpoint 为 REST 接口，apply 为变更应用时的校验）", ("endpoint",))
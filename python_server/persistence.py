@@ -0,0 +1,249 @@
+import asyncio
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+# 持久化后端：file（本地文件）或 none（不持久化）
+PERSISTENCE_BACKEND = os.getenv("LEGO_PERSISTENCE", "file")
+# 本地数据目录
+DATA_DIR = os.getenv("LEGO_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+# 批量写入操作日志的间隔（秒）
+FLUSH_INTERVAL = float(os.getenv("LEGO_PERSIST_FLUSH_INTERVAL", "0.5"))
+# 每个房间累计多少条操作后写一次压缩快照
+SNAPSHOT_EVERY = int(os.getenv("LEGO_SNAPSHOT_EVERY", "500"))
+
+
+def replay_delta(bricks: Dict[str, Dict], delta: Dict):
+    """
+    将一条增量消息（BRICK_ADDED / BRICK_REMOVED / BRICK_UPDATED / BRICKS_CLEARED）应用到按 uID 索引的积木字典
+    """
+    message_type = delta["type"]
+    data = delta["data"]
+    if message_type == "BRICK_ADDED":
+        for brick in data["bricks"]:
+            bricks.setdefault(brick["uID"], brick)
+    elif message_type == "BRICK_REMOVED":
+        for brick_id in data["ids"]:
+            bricks.pop(brick_id, None)
+    elif message_type == "BRICK_UPDATED":
+        for brick in data["bricks"]:
+            if brick["uID"] in bricks:
+                bricks[brick["uID"]] = brick
+    elif message_type == "BRICKS_CLEARED":
+        bricks.clear()
+
+
+class PersistenceBackend:
+    """
+    房间持久化后端的基类，默认不做任何持久化
+    record/snapshot 只把数据放入内存，实际写入由子类在事件循环之外完成
+    """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    def record(self, room_id: str, delta: Dict):
+        """
+        记录一条已应用的增量消息
+        """
+
+    def should_snapshot(self, room_id: str, force: bool = False) -> bool:
+        """
+        是否需要写入压缩快照；force 为 True 时只要有未压缩的操作就需要（例如房间卸载时）
+        """
+        return False
+
+    def snapshot(self, room_id: str, state: Dict):
+        """
+        记录房间的完整状态（{"bricks": ..., "version": ...}）作为压缩快照
+        bricks 为积木列表或 BrickStore 的独立副本（在写入线程中才渲染为 JSON）
+        """
+
+    def has_room(self, room_id: str) -> bool:
+        """
+        持久化存储中是否保存了该房间
+        """
+        return False
+
+    async def load_room(self, room_id: str) -> Optional[Dict]:
+        """
+        加载房间状态，不存在时返回 None
+        """
+        return None
+
+
+class FilePersistence(PersistenceBackend):
+    """
+    基于本地文件的持久化后端
+    每个房间一个目录：snapshot.json 保存最近的压缩快照，oplog.jsonl 追加保存快照之后的增量操作
+    """
+
+    def __init__(self, data_dir: str = DATA_DIR, flush_interval: float = FLUSH_INTERVAL,
+                 snapshot_every: int = SNAPSHOT_EVERY):
+        self.data_dir = data_dir
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        # 待写入的条目：("op", room_id, delta) 或 ("snapshot", room_id, state)
+        self._pending: List[Tuple[str, str, Dict]] = []
+        # 房间ID -> 上次快照以来的操作数
+        self._ops_since_snapshot: Dict[str, int] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _room_dir(self, room_id: str) -> str:
+        # 房间ID经过转义并加上前缀后作为目录名，避免 "." / ".." 等路径穿越
+        return os.path.join(self.data_dir, "room-" + quote(room_id, safe=""))
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def record(self, room_id: str, delta: Dict):
+        self._pending.append(("op", room_id, delta))
+        self._ops_since_snapshot[room_id] = self._ops_since_snapshot.get(room_id, 0) + 1
+
+    def should_snapshot(self, room_id: str, force: bool = False) -> bool:
+        ops = self._ops_since_snapshot.get(room_id, 0)
+        return ops > 0 if force else ops >= self.snapshot_every
+
+    def snapshot(self, room_id: str, state: Dict):
+        # 只复制容器本身，积木数据在写入前不会被原地修改
+        self._pending.append(("snapshot", room_id, {"bricks": state["bricks"].copy(), "version": state["version"]}))
+        self._ops_since_snapshot[room_id] = 0
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"持久化写入失败: {str(e)}")
+
+    async def flush(self):
+        """
+        将待写入的条目批量写入磁盘（在线程池中执行，不阻塞事件循环）
+        """
+        async with self._lock:
+            if not self._pending:
+                return
+            items, self._pending = self._pending, []
+            await asyncio.to_thread(self._write_items, items)
+
+    def _write_items(self, items: List[Tuple[str, str, Dict]]):
+        # 按顺序处理：连续的操作合并为一次追加写入，遇到快照时先写出之前的操作
+        pending_ops: Dict[str, List[str]] = {}
+        for kind, room_id, payload in items:
+            if kind == "op":
+                pending_ops.setdefault(room_id, []).append(json.dumps(payload))
+            else:
+                self._append_ops(room_id, pending_ops.pop(room_id, []))
+                self._write_snapshot(room_id, payload)
+        for room_id, lines in pending_ops.items():
+            self._append_ops(room_id, lines)
+
+    def _append_ops(self, room_id: str, lines: List[str]):
+        if not lines:
+            return
+        room_dir = self._room_dir(room_id)
+        os.makedirs(room_dir, exist_ok=True)
+        with open(os.path.join(room_dir, "oplog.jsonl"), "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def _write_snapshot(self, room_id: str, state: Dict):
+        room_dir = self._room_dir(room_id)
+        os.makedirs(room_dir, exist_ok=True)
+
+        # 先写临时文件再替换，保证快照文件总是完整的
+        bricks = state["bricks"]
+        if not isinstance(bricks, list):
+            bricks = bricks.to_list()
+        snapshot_path = os.path.join(room_dir, "snapshot.json")
+        with open(snapshot_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"bricks": bricks, "version": state["version"]}, f)
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+
+        # 快照已包含的操作可以从日志中丢弃（压缩）
+        log_path = os.path.join(room_dir, "oplog.jsonl")
+        if os.path.exists(log_path):
+            tail = [line for line in self._read_log(log_path) if line[1]["data"]["version"] > state["version"]]
+            with open(log_path + ".tmp", "w", encoding="utf-8") as f:
+                f.writelines(raw + "\n" for raw, _ in tail)
+            os.replace(log_path + ".tmp", log_path)
+
+    @staticmethod
+    def _read_log(log_path: str):
+        with open(log_path, encoding="utf-8") as f:
+            for raw in f:
+                raw = raw.strip()
+                if not raw:
+                    continue
+                try:
+                    yield raw, json.loads(raw)
+                except json.JSONDecodeError:
+                    # 进程崩溃时最后一行可能不完整，直接忽略
+                    continue
+
+    def has_room(self, room_id: str) -> bool:
+        room_dir = self._room_dir(room_id)
+        return (any(pending_room == room_id for _, pending_room, _ in self._pending)
+                or os.path.exists(os.path.join(room_dir, "snapshot.json"))
+                or os.path.exists(os.path.join(room_dir, "oplog.jsonl")))
+
+    async def load_room(self, room_id: str) -> Optional[Dict]:
+        # 先写出尚未落盘的操作，保证读到的是最新状态
+        await self.flush()
+        return await asyncio.to_thread(self._read_room, room_id)
+
+    def _read_room(self, room_id: str) -> Optional[Dict]:
+        room_dir = self._room_dir(room_id)
+        snapshot_path = os.path.join(room_dir, "snapshot.json")
+        log_path = os.path.join(room_dir, "oplog.jsonl")
+        if not os.path.exists(snapshot_path) and not os.path.exists(log_path):
+            return None
+
+        bricks: Dict[str, Dict] = {}
+        version = 0
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, encoding="utf-8") as f:
+                state = json.load(f)
+            bricks = {brick["uID"]: brick for brick in state["bricks"]}
+            version = state["version"]
+
+        # 回放快照之后的日志尾部
+        replayed = 0
+        if os.path.exists(log_path):
+            for _, delta in self._read_log(log_path):
+                if delta["data"]["version"] <= version:
+                    continue
+                replay_delta(bricks, delta)
+                version = delta["data"]["version"]
+                replayed += 1
+        self._ops_since_snapshot[room_id] = replayed
+
+        return {"bricks": list(bricks.values()), "version": version}
+
+
+def create_persistence() -> PersistenceBackend:
+    """
+    根据 LEGO_PERSISTENCE 环境变量创建持久化后端
+    """
+    if PERSISTENCE_BACKEND == "file":
+        return FilePersistence()
+    return PersistenceBackend()
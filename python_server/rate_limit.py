@@ -0,0 +1,105 @@
+import os
+import time
+from typing import Dict, Optional
+
+# 每个 WebSocket 连接入站消息的限制（超出的消息被丢弃并回复 ERROR）
+# 单条消息的最大字节数（文本消息按 UTF-8 编码后的字节数计）
+WS_MAX_MESSAGE_BYTES = int(os.getenv("LEGO_WS_MAX_MESSAGE_BYTES", str(8 * 1024 * 1024)))
+# 每秒消息数及允许的突发消息数
+WS_MESSAGE_RATE = float(os.getenv("LEGO_WS_MESSAGE_RATE", "100"))
+WS_MESSAGE_BURST = float(os.getenv("LEGO_WS_MESSAGE_BURST", "200"))
+# 每秒字节数（突发上限取该值与单条消息上限中较大者，保证最大的消息也能通过）
+WS_BYTE_RATE = float(os.getenv("LEGO_WS_BYTE_RATE", str(2 * 1024 * 1024)))
+# 最多累计的违规次数（每秒恢复 WS_VIOLATION_DECAY 次），超过后断开连接
+WS_MAX_VIOLATIONS = float(os.getenv("LEGO_WS_MAX_VIOLATIONS", "50"))
+WS_VIOLATION_DECAY = 1.0
+
+# 违规原因（ERROR 消息的 code 和指标标签）
+LIMIT_MESSAGE_SIZE = "message_too_large"
+LIMIT_MESSAGE_RATE = "message_rate"
+LIMIT_BYTE_RATE = "byte_rate"
+
+
+class TokenBucket:
+    """
+    令牌桶限流器
+    以固定速率 rate（每秒）补充令牌，最多积累 capacity 个，每次请求消耗若干令牌
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, tokens: float = 1) -> bool:
+        """
+        尝试消耗令牌，令牌不足时返回 False（不扣除）
+        """
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """
+        令牌足够消耗 tokens 个之前还需等待的秒数
+        """
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+class InboundLimiter:
+    """
+    单个 WebSocket 连接的入站限制：单条消息大小、每秒消息数和每秒字节数（令牌桶）
+    超出限制的消息被丢弃；违规次数也用令牌桶计数，短时间内违规过多的连接应被断开
+    """
+
+    def __init__(self, max_message_bytes: int = WS_MAX_MESSAGE_BYTES, message_rate: float = WS_MESSAGE_RATE,
+                 message_burst: float = WS_MESSAGE_BURST, byte_rate: float = WS_BYTE_RATE,
+                 max_violations: float = WS_MAX_VIOLATIONS):
+        self.max_message_bytes = max_message_bytes
+        self.messages = TokenBucket(message_rate, message_burst)
+        self.bytes = TokenBucket(byte_rate, max(byte_rate, max_message_bytes))
+        self.violations = TokenBucket(WS_VIOLATION_DECAY, max_violations)
+        # 本轮连续违规是否已经通知过客户端（每轮只回复一次 ERROR，避免回复本身造成拥塞）
+        self.notified = False
+
+    def check(self, size: int) -> Optional[str]:
+        """
+        检查一条 size 字节的消息，可以处理时返回 None，否则返回违规原因
+        两个令牌桶都足够时才同时扣除，被拒绝的消息不消耗任何一个桶的令牌
+        """
+        if size > self.max_message_bytes:
+            return LIMIT_MESSAGE_SIZE
+        if self.messages.wait_time() > 0:
+            return LIMIT_MESSAGE_RATE
+        if self.bytes.wait_time(size) > 0:
+            return LIMIT_BYTE_RATE
+        self.messages.consume()
+        self.bytes.consume(size)
+        self.notified = False
+        return None
+
+    def violate(self) -> bool:
+        """
+        记录一次违规，累计违规次数超出上限时返回 False（应断开连接）
+        """
+        return self.violations.consume()
+
+    def describe(self, reason: str, size: int) -> Dict:
+        """
+        回复给客户端的 ERROR 消息内容
+        """
+        if reason == LIMIT_MESSAGE_SIZE:
+            return {"code": reason, "message": f"消息大小 {size} 超出上限 {self.max_message_bytes}",
+                    "limit": self.max_message_bytes}
+        bucket = self.messages if reason == LIMIT_MESSAGE_RATE else self.bytes
+        return {"code": reason, "message": "发送速率超出限制，消息已被丢弃",
+                "limit": bucket.rate, "retry_after": round(bucket.wait_time(1 if reason == LIMIT_MESSAGE_RATE else size), 3)}
@@ -0,0 +1,355 @@
+"""
+形状生成：将参数化的基本形状光栅化为体素占用网格，再把体素贪心合并为较大的积木
+
+网格坐标与 REST 接口（/api/bricks/add）的坐标相同：体素 (x, y, z) 即 1x1 积木 BrickCoordinates(x, y, z) 的实际占位，
+在场景中 x 方向占 [BASE * x, BASE * (x + 1)]，z 方向占 [-BASE * z, -BASE * (z - 1)]（REST 的 z 轴与场景相反），y 为层号
+
+所有形状先按顺序写入同一个网格（后面的形状覆盖前面的形状，subtract 为 True 时挖空），
+网格中的值为颜色序号加 1（0 表示空），合并时只合并颜色相同的相邻体素
+"""
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from collision import BASE, EPSILON, LAYER_HEIGHT, collides, stack
+
+# 一次请求光栅化的网格（所有形状的包围盒）最多包含的单元数
+SHAPE_MAX_CELLS = int(os.getenv("LEGO_SHAPE_MAX_CELLS", "8000000"))
+# 一次请求最多生成的积木数
+SHAPE_MAX_BRICKS = int(os.getenv("LEGO_SHAPE_MAX_BRICKS", "50000"))
+
+SHAPE_TYPES = ("box", "sphere", "polygon", "heart", "extrude", "voxels")
+# 心形曲线 (u² + v² - 1)³ - u²v³ <= 0 在 u 方向的宽度
+HEART_WIDTH = 2.28
+
+# 光栅化结果：(包围盒最小角 (x, y, z), 布尔数组 [x, y, z])
+Raster = Tuple[Tuple[int, int, int], np.ndarray]
+# 形状的包围盒：(最小角 (x, y, z), 尺寸 (x, y, z))
+Box = Tuple[Tuple[int, int, int], Tuple[int, int, int]]
+
+
+def _check_cells(size: Sequence[int]):
+    """
+    包围盒超过 SHAPE_MAX_CELLS 个单元时抛出 ValueError，在分配数组之前调用
+    """
+    if int(np.prod([max(0, int(n)) for n in size], dtype=np.int64)) > SHAPE_MAX_CELLS:
+        raise ValueError(f"形状的包围盒过大（{' x '.join(map(str, size))}），最多 {SHAPE_MAX_CELLS} 个单元")
+
+
+def _hollow(mask: np.ndarray) -> np.ndarray:
+    """
+    只保留形状的外壳：6 个相邻单元中至少有一个为空的单元
+    """
+    padded = np.pad(mask, 1)
+    interior = mask.copy()
+    for axis in range(3):
+        for shift in (-1, 1):
+            interior &= np.roll(padded, shift, axis=axis)[1:-1, 1:-1, 1:-1]
+    return mask & ~interior
+
+
+def _check_height(height: int):
+    if height < 1:
+        raise ValueError("height 必须为正整数")
+
+
+def _extrude(mask_xz: np.ndarray, height: int) -> np.ndarray:
+    _check_height(height)
+    _check_cells((mask_xz.shape[0], height, mask_xz.shape[1]))
+    return np.repeat(mask_xz[:, None, :], height, axis=1)
+
+
+def raster_box(x: int, y: int, z: int, size_x: int, size_y: int, size_z: int) -> Raster:
+    if min(size_x, size_y, size_z) < 1:
+        raise ValueError("box 的尺寸必须为正整数")
+    _check_cells((size_x, size_y, size_z))
+    return (x, y, z), np.ones((size_x, size_y, size_z), dtype=bool)
+
+
+def _sphere_radius_y(radius: float, radius_y: Optional[float]) -> float:
+    if radius <= 0:
+        raise ValueError("radius 必须为正数")
+    radius_y = radius * BASE / LAYER_HEIGHT if radius_y is None else radius_y
+    if radius_y <= 0:
+        raise ValueError("radius_y 必须为正数")
+    return radius_y
+
+
+def _sphere_range(x: float, y: float, z: float, radius: float, radius_y: float):
+    lo = (int(np.ceil(x - radius)), int(np.ceil(y - radius_y)), int(np.ceil(z - radius)))
+    hi = (int(np.floor(x + radius)), int(np.floor(y + radius_y)), int(np.floor(z + radius)))
+    return lo, hi
+
+
+def raster_sphere(x: float, y: float, z: float, radius: float, radius_y: Optional[float] = None) -> Raster:
+    """
+    球（椭球）：体素中心到球心的归一化距离不超过 1
+    radius_y 默认按层高换算，使球在场景中看起来是圆的
+    """
+    radius_y = _sphere_radius_y(radius, radius_y)
+    lo, hi = _sphere_range(x, y, z, radius, radius_y)
+    _check_cells(np.subtract(hi, lo) + 1)
+    gx, gy, gz = np.ogrid[lo[0]:hi[0] + 1, lo[1]:hi[1] + 1, lo[2]:hi[2] + 1]
+    mask = ((gx - x) / radius) ** 2 + ((gy - y) / radius_y) ** 2 + ((gz - z) / radius) ** 2 <= 1
+    return lo, mask
+
+
+def _points_in_polygon(px: np.ndarray, pz: np.ndarray, points: np.ndarray) -> np.ndarray:
+    # 射线法（奇偶规则），对所有点和每条边批量计算
+    inside = np.zeros(np.broadcast(px, pz).shape, dtype=bool)
+    for (x1, z1), (x2, z2) in zip(points, np.roll(points, -1, axis=0)):
+        if z1 == z2:
+            continue
+        crosses = (z1 > pz) != (z2 > pz)
+        inside ^= crosses & (px < (x2 - x1) * (pz - z1) / (z2 - z1) + x1)
+    return inside
+
+
+def _polygon_range(points: np.ndarray):
+    if points.ndim != 2 or points.shape[0] < 3 or points.shape[1] != 2:
+        raise ValueError("polygon 至少需要 3 个 [x, z] 顶点")
+    lo_x, lo_z = np.ceil(points.min(axis=0)).astype(int)
+    hi_x, hi_z = np.floor(points.max(axis=0)).astype(int)
+    return int(lo_x), int(hi_x), int(lo_z), int(hi_z)
+
+
+def raster_polygon(points: Sequence[Sequence[float]], y: int, height: int) -> Raster:
+    """
+    多边形（x, z 顶点，网格坐标）拉伸 height 层：体素中心在多边形内的单元
+    """
+    points = np.asarray(points, dtype=np.float64)
+    lo_x, hi_x, lo_z, hi_z = _polygon_range(points)
+    _check_height(height)
+    _check_cells((hi_x - lo_x + 1, height, hi_z - lo_z + 1))
+    gx, gz = np.ogrid[lo_x:hi_x + 1, lo_z:hi_z + 1]
+    return (lo_x, y, lo_z), _extrude(_points_in_polygon(gx, gz, points), height)
+
+
+def _heart_range(x: float, z: float, size: float):
+    if size <= 0:
+        raise ValueError("size 必须为正数")
+    scale = size / HEART_WIDTH
+    lo_x, hi_x = int(np.ceil(x - size / 2)), int(np.floor(x + size / 2))
+    lo_z, hi_z = int(np.ceil(z - 1.3 * scale)), int(np.floor(z + 1.1 * scale))
+    return lo_x, hi_x, lo_z, hi_z
+
+
+def raster_heart(x: float, y: int, z: float, size: float, height: int) -> Raster:
+    """
+    心形曲线（宽度为 size 个单元，中心在 (x, z)，尖端朝 +z）拉伸 height 层
+    """
+    lo_x, hi_x, lo_z, hi_z = _heart_range(x, z, size)
+    _check_height(height)
+    _check_cells((hi_x - lo_x + 1, height, hi_z - lo_z + 1))
+    scale = size / HEART_WIDTH
+    gx, gz = np.ogrid[lo_x:hi_x + 1, lo_z:hi_z + 1]
+    u = (gx - x) / scale
+    # REST 的 z 轴朝向场景的 -z，心形的圆弧朝 -z
+    v = (z - gz) / scale
+    mask = (u ** 2 + v ** 2 - 1) ** 3 - u ** 2 * v ** 3 <= 0
+    return (lo_x, y, lo_z), _extrude(mask, height)
+
+
+def raster_extrude(x: int, y: int, z: int, mask: Sequence[Sequence[int]], height: int) -> Raster:
+    """
+    二维位图（mask[z][x]，非 0 为实心）拉伸 height 层
+    """
+    mask_zx = np.asarray(mask)
+    if mask_zx.ndim != 2:
+        raise ValueError("mask 必须为二维数组 [z][x]")
+    _check_height(height)
+    _check_cells((mask_zx.shape[1], height, mask_zx.shape[0]))
+    return (x, y, z), _extrude(mask_zx.T != 0, height)
+
+
+def raster_voxels(x: int, y: int, z: int, voxels: Sequence) -> Raster:
+    """
+    上传的体素数组（voxels[y][z][x]，非 0 为实心）
+    """
+    voxels_yzx = np.asarray(voxels)
+    if voxels_yzx.ndim != 3:
+        raise ValueError("voxels 必须为三维数组 [y][z][x]")
+    _check_cells(voxels_yzx.shape)
+    return (x, y, z), np.transpose(voxels_yzx != 0, (2, 0, 1))
+
+
+def shape_box(spec) -> Box:
+    """
+    由形状描述的参数计算其包围盒（不分配数组），与 rasterize 的结果范围相同
+    """
+    if spec.type == "box":
+        if min(spec.size_x, spec.size_y, spec.size_z) < 1:
+            raise ValueError("box 的尺寸必须为正整数")
+        return (int(spec.x), spec.y, int(spec.z)), (spec.size_x, spec.size_y, spec.size_z)
+    if spec.type == "sphere":
+        lo, hi = _sphere_range(spec.x, spec.y, spec.z, spec.radius, _sphere_radius_y(spec.radius, spec.radius_y))
+        return lo, tuple(int(n) for n in np.subtract(hi, lo) + 1)
+    if spec.type in ("polygon", "heart"):
+        _check_height(spec.height)
+        if spec.type == "polygon":
+            lo_x, hi_x, lo_z, hi_z = _polygon_range(np.asarray(spec.points, dtype=np.float64))
+        else:
+            lo_x, hi_x, lo_z, hi_z = _heart_range(spec.x, spec.z, spec.size)
+        return (lo_x, spec.y, lo_z), (hi_x - lo_x + 1, spec.height, hi_z - lo_z + 1)
+    if spec.type == "extrude":
+        _check_height(spec.height)
+        rows = len(spec.mask)
+        return (int(spec.x), spec.y, int(spec.z)), (max((len(row) for row in spec.mask), default=0), spec.height, rows)
+    if spec.type == "voxels":
+        layers = spec.voxels
+        rows = max((len(layer) for layer in layers), default=0)
+        columns = max((len(row) for layer in layers for row in layer), default=0)
+        return (int(spec.x), spec.y, int(spec.z)), (columns, len(layers), rows)
+    raise ValueError(f"未知的形状类型: {spec.type}（可选 {', '.join(SHAPE_TYPES)}）")
+
+
+def check_boxes(boxes: List[Box]):
+    """
+    在光栅化之前检查所有形状的包围盒及其合并后的网格都不超过 SHAPE_MAX_CELLS 个单元
+    """
+    if not boxes:
+        raise ValueError("至少需要一个形状")
+    for _, size in boxes:
+        _check_cells(size)
+    lo = np.min([origin for origin, _ in boxes], axis=0)
+    hi = np.max([np.add(origin, size) for origin, size in boxes], axis=0)
+    _check_cells(hi - lo)
+
+
+def rasterize(spec) -> Raster:
+    """
+    光栅化一个形状描述（字段见 app.py 中的 ShapeSpec）
+    """
+    if spec.type == "box":
+        raster = raster_box(int(spec.x), spec.y, int(spec.z), spec.size_x, spec.size_y, spec.size_z)
+    elif spec.type == "sphere":
+        raster = raster_sphere(spec.x, spec.y, spec.z, spec.radius, spec.radius_y)
+    elif spec.type == "polygon":
+        raster = raster_polygon(spec.points, spec.y, spec.height)
+    elif spec.type == "heart":
+        raster = raster_heart(spec.x, spec.y, spec.z, spec.size, spec.height)
+    elif spec.type == "extrude":
+        raster = raster_extrude(int(spec.x), spec.y, int(spec.z), spec.mask, spec.height)
+    elif spec.type == "voxels":
+        raster = raster_voxels(int(spec.x), spec.y, int(spec.z), spec.voxels)
+    else:
+        raise ValueError(f"未知的形状类型: {spec.type}（可选 {', '.join(SHAPE_TYPES)}）")
+    origin, mask = raster
+    return origin, _hollow(mask) if spec.hollow else mask
+
+
+def compose(rasters: List[Tuple[Raster, int]]) -> Tuple[Tuple[int, int, int], np.ndarray]:
+    """
+    按顺序将光栅化的形状写入同一个网格，返回 (网格最小角, 网格)
+    rasters 中的颜色值为颜色序号加 1，0 表示挖空（subtract）
+    """
+    if not rasters:
+        raise ValueError("至少需要一个形状")
+    lo = np.min([origin for (origin, _), _ in rasters], axis=0)
+    hi = np.max([np.add(origin, mask.shape) for (origin, mask), _ in rasters], axis=0)
+    shape = tuple(int(n) for n in hi - lo)
+    _check_cells(shape)
+    grid = np.zeros(shape, dtype=np.int16)
+    for (origin, mask), value in rasters:
+        start = np.subtract(origin, lo)
+        region = grid[start[0]:start[0] + mask.shape[0],
+                      start[1]:start[1] + mask.shape[1],
+                      start[2]:start[2] + mask.shape[2]]
+        region[mask] = value
+    return tuple(int(v) for v in lo), grid
+
+
+def merge_runs(grid: np.ndarray, max_x: int, max_z: int) -> Dict[str, np.ndarray]:
+    """
+    贪心合并：先把每一行（固定 y、z）中颜色相同的连续体素切分为长度不超过 max_x 的段，
+    再把 z 方向相邻、起点和长度都相同的段合并为深度不超过 max_z 的积木
+    返回按列的积木：网格中的最小角 (x, y, z)、尺寸 (w, d) 和颜色值
+    """
+    size_x, size_y, size_z = grid.shape
+    # 每一行为 (y, z) 固定的一条 x 方向的线，两端补 0 作为哨兵
+    rows = np.transpose(grid, (1, 2, 0)).reshape(-1, size_x)
+    padded = np.zeros((rows.shape[0], size_x + 2), dtype=grid.dtype)
+    padded[:, 1:-1] = rows
+    changes = padded[:, 1:] != padded[:, :-1]
+    row_ids, starts = np.nonzero(changes[:, :-1] & (padded[:, 1:-1] != 0))
+    # 每段的终点为起点之后的第一个变化位置
+    change_rows, change_cols = np.nonzero(changes[:, 1:])
+    ends = change_cols[np.searchsorted(change_rows * (size_x + 1) + change_cols,
+                                       row_ids * (size_x + 1) + starts)] + 1
+    lengths = ends - starts
+
+    # 超过 max_x 的段切分为多个长度为 max_x 的段和一个余段
+    pieces = -(-lengths // max_x)
+    run = np.repeat(np.arange(len(starts)), pieces)
+    piece = np.arange(len(run)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    x0 = starts[run] + piece * max_x
+    w = np.minimum(max_x, lengths[run] - piece * max_x)
+    y, z = np.divmod(row_ids[run], size_z)
+    color = rows[row_ids[run], x0]
+
+    # z 方向合并：按 (y, x0, w, color, z) 排序后，连续的 z 组成链，每条链按 max_z 分组
+    order = np.lexsort((z, color, w, x0, y))
+    y, z, x0, w, color = y[order], z[order], x0[order], w[order], color[order]
+    chain_start = np.ones(len(order), dtype=bool)
+    chain_start[1:] = ((y[1:] != y[:-1]) | (x0[1:] != x0[:-1]) | (w[1:] != w[:-1])
+                       | (color[1:] != color[:-1]) | (z[1:] != z[:-1] + 1))
+    chain_index = np.arange(len(order)) - np.maximum.accumulate(np.where(chain_start, np.arange(len(order)), 0))
+    group_start = chain_start | (chain_index % max_z == 0)
+    groups = np.cumsum(group_start) - 1
+    first = np.flatnonzero(group_start)
+    return {
+        "x": x0[first], "y": y[first], "z": z[first],
+        "w": w[first], "d": np.bincount(groups).astype(np.int64),
+        "color": color[first],
+    }
+
+
+def blocked_cells(origin: Tuple[int, int, int], shape: Tuple[int, int, int], layers: np.ndarray,
+                  room: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    返回网格中被房间内已有积木占据的单元（布尔数组，与网格形状相同）
+    layers[j] 为网格第 j 层（y = origin[1] + j）对应的碰撞层，room 为房间内积木的占位列（见 collision.py）
+    先按包围盒批量筛选出与网格相交的积木，轴对齐的积木直接标记包围盒覆盖的单元，
+    任意角度旋转的积木再逐个单元用分离轴定理精确判断
+    """
+    blocked = np.zeros(shape, dtype=bool)
+    if not len(room["cx"]):
+        return blocked
+    ox, oy, oz = origin
+    # 网格在场景中的范围：x 为 [BASE * ox, BASE * (ox + nx)]，z 为 [-BASE * (oz + nz - 1), -BASE * (oz - 1)]
+    world_x0, world_x1 = BASE * ox, BASE * (ox + shape[0])
+    world_z0, world_z1 = -BASE * (oz + shape[2] - 1), -BASE * (oz - 1)
+    near = (np.isin(room["layer"], layers)
+            & (room["cx"] + room["ex"] > world_x0 + EPSILON) & (room["cx"] - room["ex"] < world_x1 - EPSILON)
+            & (room["cz"] + room["ez"] > world_z0 + EPSILON) & (room["cz"] - room["ez"] < world_z1 - EPSILON))
+
+    # 包围盒覆盖的场景单元，再换算为网格下标（z 方向反向），裁剪到网格范围内
+    x0 = np.maximum(np.floor((room["cx"] - room["ex"] + EPSILON) / BASE).astype(np.int64), world_x0 // BASE) - ox
+    x1 = np.minimum(np.ceil((room["cx"] + room["ex"] - EPSILON) / BASE).astype(np.int64), world_x1 // BASE) - ox
+    z0 = 1 - oz - np.minimum(np.ceil((room["cz"] + room["ez"] - EPSILON) / BASE).astype(np.int64), world_z1 // BASE)
+    z1 = 1 - oz - np.maximum(np.floor((room["cz"] - room["ez"] + EPSILON) / BASE).astype(np.int64), world_z0 // BASE)
+
+    for j, layer in enumerate(layers.tolist()):
+        on_layer = near & (room["layer"] == layer)
+        # 轴对齐的积木：用二维差分数组一次标记所有包围盒
+        aligned = np.flatnonzero(on_layer & room["aligned"])
+        if len(aligned):
+            diff = np.zeros((shape[0] + 1, shape[2] + 1), dtype=np.int32)
+            np.add.at(diff, (x0[aligned], z0[aligned]), 1)
+            np.add.at(diff, (x1[aligned], z0[aligned]), -1)
+            np.add.at(diff, (x0[aligned], z1[aligned]), -1)
+            np.add.at(diff, (x1[aligned], z1[aligned]), 1)
+            blocked[:, j, :] |= diff.cumsum(axis=0).cumsum(axis=1)[:-1, :-1] > 0
+        # 任意角度旋转的积木：逐个单元精确判断
+        for i in np.flatnonzero(on_layer & ~room["aligned"]).tolist():
+            fp = {name: values[i].item() for name, values in room.items()}
+            gx, gz = np.meshgrid(np.arange(x0[i], x1[i]), np.arange(z0[i], z1[i]), indexing="ij")
+            cells = stack([{
+                "cx": 0.0, "cz": 0.0, "hx": BASE / 2, "hz": BASE / 2, "cos": 1.0, "sin": 0.0,
+                "ex": BASE / 2, "ez": BASE / 2, "aligned": True, "layer": layer,
+            }] * gx.size)
+            cells["cx"] = BASE * (gx.ravel() + ox) + BASE / 2
+            cells["cz"] = -BASE * (gz.ravel() + oz) + BASE / 2
+            blocked[gx.ravel(), j, gz.ravel()] |= collides(fp, cells)
+    return blocked
@@ -0,0 +1,102 @@
+import math
+from typing import Dict, List, Set, Tuple
+
+from collision import BASE, LAYER_HEIGHT, MAX_BRICK_DIMENSION, brick_footprint, footprint_bounds
+
+Cell = Tuple[int, int, int]
+# 包围盒 (x0, x1, y0, y1, z0, z1)
+Bounds = Tuple[float, float, float, float, float, float]
+# 单个包围盒最多占据的网格单元数：足够容纳最大尺寸的积木旋转任意角度后的包围盒，
+# 更大的包围盒直接拒绝，避免在事件循环中逐个生成数百万个网格单元
+MAX_CELLS = (math.ceil(MAX_BRICK_DIMENSION * math.sqrt(2)) + 2) ** 2
+
+
+def brick_bounds(brick: Dict) -> Bounds:
+    """
+    计算积木实际占位（考虑旋转和平移，见 collision.py）的轴对齐包围盒
+    """
+    return footprint_bounds(brick_footprint(brick))
+
+
+def bounds_cells(bounds: Bounds, cell_size: float = BASE, layer_height: float = LAYER_HEIGHT) -> List[Cell]:
+    """
+    计算包围盒占据的所有网格单元，超过 MAX_CELLS 个时抛出 ValueError
+    """
+    bx0, bx1, by0, by1, bz0, bz1 = bounds
+    x0 = math.floor(bx0 / cell_size)
+    x1 = math.ceil(bx1 / cell_size) - 1
+    z0 = math.floor(bz0 / cell_size)
+    z1 = math.ceil(bz1 / cell_size) - 1
+    y0 = math.floor(by0 / layer_height)
+    y1 = math.ceil(by1 / layer_height) - 1
+    count = (max(x0, x1) - x0 + 1) * (max(y0, y1) - y0 + 1) * (max(z0, z1) - z0 + 1)
+    if count > MAX_CELLS:
+        raise ValueError(f"包围盒占据的网格单元过多: {count}")
+
+    return [
+        (cx, cy, cz)
+        for cx in range(x0, max(x0, x1) + 1)
+        for cy in range(y0, max(y0, y1) + 1)
+        for cz in range(z0, max(z0, z1) + 1)
+    ]
+
+
+class SpatialGrid:
+    """
+    房间内积木的空间哈希网格索引
+    以网格单元为键记录占据该单元的积木ID，碰撞检测时只需检查新积木覆盖的单元
+    索引只保存积木ID，积木数据由房间的 BrickStore 保存
+    """
+
+    def __init__(self, cell_size: float = BASE, layer_height: float = LAYER_HEIGHT):
+        self.cell_size = cell_size
+        self.layer_height = layer_height
+        # 网格单元 -> 积木ID集合
+        self.cells: Dict[Cell, Set[str]] = {}
+
+    def cells_for(self, bounds: Bounds) -> List[Cell]:
+        return bounds_cells(bounds, self.cell_size, self.layer_height)
+
+    def insert(self, brick_id: str, bounds: Bounds):
+        """
+        将积木加入索引（替换积木时需先用旧的包围盒调用 remove）
+        """
+        for cell in self.cells_for(bounds):
+            self.cells.setdefault(cell, set()).add(brick_id)
+
+    def remove(self, brick_id: str, bounds: Bounds):
+        """
+        从索引中移除积木，bounds 为积木加入索引时的包围盒
+        """
+        for cell in self.cells_for(bounds):
+            occupants = self.cells.get(cell)
+            if occupants is None:
+                continue
+            occupants.discard(brick_id)
+            if not occupants:
+                del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+
+    def rebuild(self, store):
+        """
+        根据房间的 BrickStore 重建索引
+        """
+        self.clear()
+        for brick_id in store.ids:
+            self.insert(brick_id, store.bounds(brick_id))
+
+    def query(self, bounds: Bounds) -> List[str]:
+        """
+        返回与给定包围盒占据相同网格单元的候选积木ID（已去重）
+        """
+        seen: Set[str] = set()
+        candidates: List[str] = []
+        for cell in self.cells_for(bounds):
+            for brick_id in self.cells.get(cell, ()):
+                if brick_id in seen:
+                    continue
+                seen.add(brick_id)
+                candidates.append(brick_id)
+        return candidates
@@ -0,0 +1,24 @@
+import os
+
+os.environ.setdefault("LEGO_PERSISTENCE", "none")
+os.environ.setdefault("LEGO_HIBERNATION", "none")
+
+from app import BrickCoordinates, build_brick_data
+from brick_store import BrickStore
+from collision import brick_footprint, collides, stack
+
+
+def test_rest_y_is_collision_layer():
+    # REST 接口的 y 即积木所在的碰撞层（与前端渲染的层相同）
+    bricks = [build_brick_data(BrickCoordinates(x=0, y=y, z=0)) for y in range(2000)]
+    assert [brick_footprint(brick)["layer"] for brick in bricks] == list(range(2000))
+    # 按列批量计算的占位（BrickStore 中缓存的 layer 列）与逐个计算相同
+    assert BrickStore.from_bricks(bricks).column("layer").tolist() == list(range(2000))
+
+
+def test_stacked_rest_bricks_do_not_collide():
+    lower = brick_footprint(build_brick_data(BrickCoordinates(x=0, y=20, z=0)))
+    same = brick_footprint(build_brick_data(BrickCoordinates(x=0, y=20, z=0)))
+    upper = brick_footprint(build_brick_data(BrickCoordinates(x=0, y=21, z=0)))
+    assert collides(same, stack([lower])).tolist() == [True]
+    assert collides(upper, stack([lower])).tolist() == [False]
@@ -0,0 +1,22 @@
+from history import DeltaHistory
+
+
+def added(version, count):
+    return {"type": "BRICK_ADDED", "data": {"version": version, "bricks": [{}] * count}}
+
+
+def test_history_bounded_by_bricks():
+    history = DeltaHistory(max_entries=100, max_bricks=10)
+    history.extend([added(1, 4), added(2, 4), added(3, 4)])
+    # 超出积木数上限时移除最旧的增量
+    assert [delta["data"]["version"] for delta in history] == [2, 3]
+    assert history.size == 8
+    assert history.since(0) is None
+    assert [delta["data"]["version"] for delta in history.since(1)] == [2, 3]
+
+
+def test_oversized_delta_is_not_kept():
+    history = DeltaHistory(max_entries=100, max_bricks=10)
+    history.append(added(1, 50))
+    assert len(history) == 0 and history.size == 0
+    assert history.since(0) is None
@@ -0,0 +1,125 @@
+import asyncio
+import socket
+import socketserver
+import threading
+
+import aiohttp
+import pytest
+import requests
+
+from lego_builder import AsyncLegoBuilder, LegoBuilder
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        length = 0
+        while True:
+            line = self.rfile.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        self.rfile.read(length)
+        self.server.requests += 1
+        # drop=True 时读取请求后直接断开连接（请求已经发到服务端）
+        if not self.server.drop:
+            body = b'{"ok": true}'
+            self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                             b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, drop=False):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.drop = drop
+        self.requests = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_later(port, servers, delay=0.1):
+    # 模拟服务端重启：第一次连接被拒绝，稍后服务端恢复
+    timer = threading.Timer(delay, lambda: servers.append(Server(port)))
+    timer.start()
+    return timer
+
+
+def test_sync_post_retried_when_connection_refused():
+    port, servers = free_port(), []
+    timer = start_later(port, servers)
+    client = LegoBuilder(f"http://127.0.0.1:{port}", retries=3, backoff_factor=0.2)
+    try:
+        assert client.add_brick("room", 0, 0, 0, 1, 1) == {"ok": True}
+        assert servers[0].requests == 1
+    finally:
+        timer.join()
+        client.close()
+        for server in servers:
+            server.shutdown()
+
+
+def test_sync_post_not_retried_after_request_sent():
+    server = Server(free_port(), drop=True)
+    client = LegoBuilder(f"http://127.0.0.1:{server.server_address[1]}", retries=3, backoff_factor=0)
+    try:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.add_brick("room", 0, 0, 0, 1, 1)
+        # 服务端可能已经添加了积木，重试会重复添加
+        assert server.requests == 1
+    finally:
+        client.close()
+        server.shutdown()
+
+
+def test_async_post_retried_when_connection_refused():
+    port, servers = free_port(), []
+    timer = start_later(port, servers)
+
+    async def run():
+        async with AsyncLegoBuilder(f"http://127.0.0.1:{port}", retries=3, backoff_factor=0.2) as client:
+            return await client.add_brick("room", 0, 0, 0, 1, 1)
+
+    try:
+        assert asyncio.run(run()) == {"ok": True}
+        assert servers[0].requests == 1
+    finally:
+        timer.join()
+        for server in servers:
+            server.shutdown()
+
+
+def test_async_retry_after_request_sent_only_for_idempotent_methods():
+    server = Server(free_port(), drop=True)
+
+    async def run():
+        async with AsyncLegoBuilder(f"http://127.0.0.1:{server.server_address[1]}",
+                                    retries=3, backoff_factor=0) as client:
+            with pytest.raises(aiohttp.ServerDisconnectedError):
+                await client.add_brick("room", 0, 0, 0, 1, 1)
+            assert server.requests == 1
+            with pytest.raises(aiohttp.ServerDisconnectedError):
+                await client.get_brick_stats("room")
+            # GET 会重试（aiohttp 自身也会对幂等请求在连接断开时重发一次）
+            assert server.requests > 1 + 1
+
+    try:
+        asyncio.run(run())
+    finally:
+        server.shutdown()
+
+
+def test_async_should_retry_before_request_sent():
+    client = AsyncLegoBuilder()
+    error = aiohttp.ServerDisconnectedError()
+    assert client._should_retry("POST", error, None, sent=False)
+    assert not client._should_retry("POST", error, None, sent=True)
+    assert client._should_retry("GET", error, None, sent=True)
@@ -0,0 +1,21 @@
+import os
+
+os.environ.setdefault("LEGO_PERSISTENCE", "none")
+os.environ.setdefault("LEGO_HIBERNATION", "none")
+
+from fastapi.testclient import TestClient
+
+from app import app
+
+
+def test_layer_query_uses_rest_y():
+    # 按添加积木时的 y 查询所在层，统计中的层也使用相同的 y
+    with TestClient(app) as client, client.websocket_connect("/ws/layer-query"):
+        for y in range(18, 22):
+            response = client.post("/api/bricks/add", params={"room_id": "layer-query"}, json={"x": 0, "y": y, "z": 0})
+            assert response.json()["status"] == "success"
+        for y in range(18, 22):
+            response = client.get("/api/bricks/layer-query/query", params={"layer_min": y, "layer_max": y})
+            assert len(response.json()["bricks"]) == 1
+        stats = client.get("/api/bricks/layer-query/stats").json()
+        assert stats["layers"] == {str(y): 1 for y in range(18, 22)}
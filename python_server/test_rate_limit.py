@@ -0,0 +1,11 @@
+from rate_limit import LIMIT_BYTE_RATE, LIMIT_MESSAGE_SIZE, InboundLimiter
+
+
+def test_rejected_messages_consume_no_tokens():
+    limiter = InboundLimiter(max_message_bytes=100, message_rate=1, message_burst=10, byte_rate=100)
+    assert limiter.check(101) == LIMIT_MESSAGE_SIZE
+    assert limiter.check(60) is None
+    # 字节数超出剩余令牌的消息被拒绝，不消耗消息令牌
+    assert limiter.check(60) == LIMIT_BYTE_RATE
+    assert limiter.messages.tokens > 8.5
+    assert limiter.bytes.tokens >= 40
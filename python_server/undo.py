@@ -0,0 +1,134 @@
+"""
+房间的撤销历史：记录每个用户最近的积木变更及其逆操作所需的数据，用于服务器端的撤销 / 重做
+
+每条记录（Change）描述一次已应用的变更：
+    added    新增的积木（应用后的数据）
+    updated  修改的积木 [(修改前, 修改后), ...]
+    removed  删除的积木（删除前的数据），清空房间时为清空前的 BrickStore 副本
+    version  变更应用后的房间版本号，用于标识记录
+撤销时只回退仍保持该次变更结果的积木（之后被其他用户修改过的积木跳过），回退实际产生的变更作为重做记录
+
+每个进程按房间总线的顺序应用变更并各自维护撤销历史，撤销 / 重做同样作为变更提交，
+应用时各进程移除同一条记录（按版本号匹配），因此各进程的撤销历史保持一致
+
+撤销历史只保存在内存中，房间休眠或服务重启后清空
+"""
+import os
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+from brick_store import BrickStore
+
+# 每个用户最多可以撤销的操作数
+UNDO_DEPTH = int(os.getenv("LEGO_UNDO_DEPTH", "100"))
+# 每个房间最多保留多少个用户的撤销历史（超出时移除最久没有操作的用户）
+UNDO_MAX_AUTHORS = 256
+
+Change = Dict
+
+
+def change_size(change: Change) -> int:
+    """
+    记录中保存的积木数（估算内存用量）
+    """
+    return len(change["added"]) + len(change["updated"]) * 2 + len(change["removed"])
+
+
+def is_empty(change: Change) -> bool:
+    return not (change["added"] or change["updated"] or len(change["removed"]))
+
+
+class UndoHistory:
+    """
+    按用户分别保存撤销栈和重做栈（每个用户最多 depth 条记录）
+    用户进行新的变更时清空其重做栈
+    """
+
+    def __init__(self, depth: int = UNDO_DEPTH, max_authors: int = UNDO_MAX_AUTHORS):
+        self.depth = depth
+        self.max_authors = max_authors
+        # 用户 -> {"undo": 撤销栈, "redo": 重做栈}，按最近操作时间从旧到新排列
+        self._stacks: "OrderedDict[str, Dict[str, Deque[Change]]]" = OrderedDict()
+        # 所有记录中保存的积木数
+        self.size = 0
+
+    def _stacks_of(self, author: str) -> Dict[str, Deque[Change]]:
+        stacks = self._stacks.get(author)
+        if stacks is None:
+            stacks = self._stacks[author] = {"undo": deque(), "redo": deque()}
+            if len(self._stacks) > self.max_authors:
+                _, evicted = self._stacks.popitem(last=False)
+                self.size -= sum(change_size(change) for stack in evicted.values() for change in stack)
+        self._stacks.move_to_end(author)
+        return stacks
+
+    def _push(self, stack: Deque[Change], change: Change):
+        stack.append(change)
+        self.size += change_size(change)
+        if len(stack) > self.depth:
+            self.size -= change_size(stack.popleft())
+
+    def peek(self, author: str, redo: bool = False) -> Optional[Change]:
+        """
+        返回用户下一次撤销（redo 为 True 时为重做）的记录，不移除
+        """
+        stacks = self._stacks.get(author)
+        stack = stacks and stacks["redo" if redo else "undo"]
+        return stack[-1] if stack else None
+
+    def record(self, author: str, change: Change):
+        """
+        记录用户的一次新变更，并清空该用户的重做栈
+        """
+        if is_empty(change):
+            return
+        stacks = self._stacks_of(author)
+        self.size -= sum(change_size(redo) for redo in stacks["redo"])
+        stacks["redo"].clear()
+        self._push(stacks["undo"], change)
+
+    def settle(self, author: str, version: int, applied: Change, redo: bool = False):
+        """
+        撤销（或重做）已应用：栈顶是版本号为 version 的记录时将其移除（同一记录被重复撤销时只移除一次），
+        实际回退的变更放入重做栈（重做时放回撤销栈，不清空重做栈）
+        """
+        stacks = self._stacks_of(author)
+        source, target = (stacks["redo"], stacks["undo"]) if redo else (stacks["undo"], stacks["redo"])
+        if source and source[-1]["version"] == version:
+            self.size -= change_size(source.pop())
+        if not is_empty(applied):
+            self._push(target, applied)
+
+
+def inverse_changes(change: Change, store: BrickStore) -> Dict[str, List]:
+    """
+    计算撤销一条记录需要的变更：{"added": [...], "updated": [...], "removed": [...], "skipped": [...]}
+    只回退当前状态仍与该次变更结果相同的积木，其余积木（之后被修改、删除或重新添加）列入 skipped
+    """
+    removed_bricks = change["removed"]
+    if isinstance(removed_bricks, BrickStore):
+        removed_bricks = removed_bricks.to_list()
+    # 变更后的积木经过 BrickStore 渲染，与房间中积木的表示方式一致后再比较
+    results = BrickStore.from_bricks(change["added"] + [after for _, after in change["updated"]])
+
+    inverse = {"added": [], "updated": [], "removed": [], "skipped": []}
+    for brick in change["added"]:
+        brick_id = brick["uID"]
+        if store.get(brick_id) == results.get(brick_id):
+            inverse["removed"].append(brick_id)
+        else:
+            inverse["skipped"].append(brick_id)
+    for before, _ in change["updated"]:
+        brick_id = before["uID"]
+        if brick_id in store and store.get(brick_id) == results.get(brick_id):
+            inverse["updated"].append(before)
+        else:
+            inverse["skipped"].append(brick_id)
+    # 同一次变更中先删除后又添加的积木，撤销时先删除再恢复
+    reverted = set(inverse["removed"])
+    for brick in removed_bricks:
+        if brick["uID"] not in store or brick["uID"] in reverted:
+            inverse["added"].append(brick)
+        else:
+            inverse["skipped"].append(brick["uID"])
+    return inverse
@@ -0,0 +1,256 @@
+"""
+WebSocket 消息的二进制编码（每个连接可选，默认仍使用 JSON 文本）
+
+帧格式（小端序）:
+    u8   格式版本（BINARY_VERSION）
+    u32  元数据长度
+    ...  元数据：UTF-8 JSON，即原消息中的积木 / 光标数组被替换为占位符 {"$table": 序号} 后的结果
+    之后依次为各个数据表：
+        u8   表类型（TABLE_BRICKS / TABLE_CURSORS）
+        u32  表长度（字节）
+        ...  表内容
+
+积木表:
+    u32  积木数
+    u16  调色板颜色数，之后每个颜色为 u8 长度 + UTF-8 字符串
+    每个积木的 uID：u8 长度 + UTF-8 字符串
+    每个积木一条定长记录（BRICK_RECORD，无对齐填充）
+    无法用定长记录表示的字段（未知的顶层字段等）放在占位符的 "extras" 中：{"$table": 0, "extras": {uID: {...}}}
+
+光标表:
+    u32  光标数
+    每个光标的 id：u8 长度 + UTF-8 字符串
+    每个光标的位置：3 个 f8（x, y, z）
+"""
+import json
+import struct
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+
+from brick_store import BrickStore, COLUMNS
+
+ENCODING_JSON = "json"
+ENCODING_BINARY = "binary"
+ENCODINGS = (ENCODING_JSON, ENCODING_BINARY)
+
+BINARY_VERSION = 1
+TABLE_BRICKS = 1
+TABLE_CURSORS = 2
+
+# 积木的定长记录，字段顺序即二进制布局
+BRICK_RECORD = np.dtype([
+    ("px", "<f8"), ("py", "<f8"), ("pz", "<f8"),
+    ("nx", "<f8"), ("ny", "<f8"), ("nz", "<f8"),
+    ("fa", "<i4"), ("fb", "<i4"), ("fc", "<i4"), ("mat", "<i4"),
+    ("dx", "<i4"), ("dz", "<i4"),
+    ("rot", "<f8"),
+    ("tx", "<f8"), ("tz", "<f8"),
+    ("color", "<u2"),
+])
+assert set(BRICK_RECORD.names) == set(COLUMNS)
+
+# data.bricks 为积木数组的消息类型
+BRICK_MESSAGES = ("ROOM_STATE", "ROOM_STATE_CHUNK", "BRICK_ADDED", "BRICK_UPDATED")
+
+
+def _pack_strings(strings: List[str]) -> bytes:
+    parts = []
+    for value in strings:
+        raw = value.encode("utf-8")
+        if len(raw) > 255:
+            raise ValueError("字符串过长，无法使用二进制编码")
+        parts.append(bytes((len(raw),)) + raw)
+    return b"".join(parts)
+
+
+def _unpack_strings(buffer: memoryview, offset: int, count: int):
+    strings = []
+    for _ in range(count):
+        length = buffer[offset]
+        strings.append(bytes(buffer[offset + 1:offset + 1 + length]).decode("utf-8"))
+        offset += 1 + length
+    return strings, offset
+
+
+def encode_bricks(bricks: Union[BrickStore, List[Dict]]) -> (bytes, Dict[str, Dict]):
+    """
+    将积木编码为积木表，返回 (表内容, 无法用定长记录表示的字段)
+    BrickStore 直接从列数组编码，无需逐个积木渲染
+    """
+    store = bricks if isinstance(bricks, BrickStore) else BrickStore.from_bricks(bricks)
+    count = len(store)
+    if len(store.palette) > 0xFFFF:
+        raise ValueError("颜色过多，无法使用二进制编码")
+    if store.absent:
+        # 缺少部分字段的积木无法由定长记录还原，改用 JSON
+        raise ValueError("积木缺少字段，无法使用二进制编码")
+    if not all(isinstance(color, str) for color in store.palette):
+        raise ValueError("颜色不是字符串，无法使用二进制编码")
+    records = np.empty(count, dtype=BRICK_RECORD)
+    for name in BRICK_RECORD.names:
+        records[name] = store.column(name)
+    body = b"".join((
+        struct.pack("<IH", count, len(store.palette)),
+        _pack_strings(store.palette),
+        _pack_strings(store.ids),
+        records.tobytes()
+    ))
+    return body, store.extras
+
+
+def decode_brick_store(buffer: memoryview, extras: Optional[Dict[str, Dict]] = None) -> BrickStore:
+    """
+    将积木表直接解码为 BrickStore（不经过积木字典）
+    """
+    count, palette_count = struct.unpack_from("<IH", buffer, 0)
+    palette, offset = _unpack_strings(buffer, 6, palette_count)
+    ids, offset = _unpack_strings(buffer, offset, count)
+    records = np.frombuffer(buffer, dtype=BRICK_RECORD, count=count, offset=offset)
+    columns = {name: records[name] for name in BRICK_RECORD.names}
+    return BrickStore.from_columns(ids, columns, palette, extras)
+
+
+def decode_bricks(buffer: memoryview, extras: Optional[Dict[str, Dict]] = None) -> List[Dict]:
+    return decode_brick_store(buffer, extras).to_list()
+
+
+def _is_plain_cursor(cursor: Any) -> bool:
+    if not isinstance(cursor, dict) or set(cursor) != {"id", "position"}:
+        return False
+    position = cursor["position"]
+    return (isinstance(cursor["id"], str) and isinstance(position, dict) and set(position) == {"x", "y", "z"}
+            and all(isinstance(value, (int, float)) for value in position.values()))
+
+
+def encode_cursors(cursors: List[Dict]) -> bytes:
+    positions = np.array(
+        [(c["position"]["x"], c["position"]["y"], c["position"]["z"]) for c in cursors], dtype="<f8"
+    ).reshape(len(cursors), 3)
+    return struct.pack("<I", len(cursors)) + _pack_strings([c["id"] for c in cursors]) + positions.tobytes()
+
+
+def decode_cursors(buffer: memoryview) -> List[Dict]:
+    (count,) = struct.unpack_from("<I", buffer, 0)
+    ids, offset = _unpack_strings(buffer, 4, count)
+    positions = np.frombuffer(buffer, dtype="<f8", count=count * 3, offset=offset).reshape(count, 3).tolist()
+    return [{"id": cursor_id, "position": {"x": x, "y": y, "z": z}} for cursor_id, (x, y, z) in zip(ids, positions)]
+
+
+def encode_message(message: Dict) -> Optional[bytes]:
+    """
+    将消息编码为二进制帧；消息中没有积木或光标数组（或光标格式不标准）时返回 None，调用方应改用 JSON
+    """
+    message_type = message.get("type")
+    data = message.get("data")
+    tables: List[bytes] = []
+
+    def brick_table(bricks):
+        body, extras = encode_bricks(bricks)
+        placeholder = {"$table": len(tables)}
+        if extras:
+            placeholder["extras"] = extras
+        tables.append(struct.pack("<BI", TABLE_BRICKS, len(body)) + body)
+        return placeholder
+
+    try:
+        if message_type in BRICK_MESSAGES and isinstance(data, dict) and "bricks" in data:
+            meta = {**message, "data": {**data, "bricks": brick_table(data["bricks"])}}
+        elif message_type == "UPDATE_BRICKS" and isinstance(data, list):
+            meta = {**message, "data": brick_table(data)}
+        elif message_type == "ROOM_DELTAS" and isinstance(data, dict):
+            deltas = [
+                {**delta, "data": {**delta["data"], "bricks": brick_table(delta["data"]["bricks"])}}
+                if "bricks" in delta["data"] else delta
+                for delta in data["deltas"]
+            ]
+            meta = {**message, "data": {**data, "deltas": deltas}}
+        elif message_type == "USER_CURSORS" and isinstance(data, list) and all(map(_is_plain_cursor, data)):
+            body = encode_cursors(data)
+            tables.append(struct.pack("<BI", TABLE_CURSORS, len(body)) + body)
+            meta = {**message, "data": {"$table": 0}}
+        else:
+            return None
+    except (KeyError, TypeError, ValueError, OverflowError):
+        # 积木数据不完整或超出定长记录的范围，改用 JSON
+        return None
+
+    meta_bytes = json.dumps(meta).encode("utf-8")
+    return b"".join([struct.pack("<BI", BINARY_VERSION, len(meta_bytes)), meta_bytes] + tables)
+
+
+def decode_message(frame: bytes) -> Dict:
+    """
+    将二进制帧解码为与 JSON 消息相同结构的字典
+    """
+    buffer = memoryview(frame)
+    version, meta_length = struct.unpack_from("<BI", buffer, 0)
+    if version != BINARY_VERSION:
+        raise ValueError(f"不支持的二进制消息版本: {version}")
+    offset = 5
+    meta = json.loads(bytes(buffer[offset:offset + meta_length]).decode("utf-8"))
+    offset += meta_length
+
+    tables = []
+    while offset < len(buffer):
+        kind, length = struct.unpack_from("<BI", buffer, offset)
+        tables.append((kind, buffer[offset + 5:offset + 5 + length]))
+        offset += 5 + length
+
+    def resolve(value):
+        if isinstance(value, dict):
+            if "$table" in value:
+                kind, body = tables[value["$table"]]
+                if kind == TABLE_BRICKS:
+                    return decode_bricks(body, value.get("extras"))
+                return decode_cursors(body)
+            return {key: resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [resolve(item) for item in value]
+        return value
+
+    return resolve(meta)
+
+
+def _json_default(value):
+    # 消息中可以直接放入 BrickStore，JSON 编码时才渲染为积木列表
+    if isinstance(value, BrickStore):
+        return value.to_list()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class Frame:
+    """
+    一条待发送的消息，按接收连接的编码格式编码，每种编码最多只编码一次
+    可以由消息字典或已经序列化的 JSON 文本创建
+    """
+
+    def __init__(self, message: Optional[Dict] = None, text: Optional[str] = None):
+        self._message = message
+        self._text = text
+        self._binary: Optional[bytes] = None
+        self._binary_encoded = False
+
+    @property
+    def message(self) -> Dict:
+        if self._message is None:
+            self._message = json.loads(self._text)
+        return self._message
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self._message, default=_json_default)
+        return self._text
+
+    def payload(self, encoding: str) -> Union[str, bytes]:
+        """
+        返回给定编码的消息内容；二进制编码不适用于该消息时返回 JSON 文本
+        """
+        if encoding == ENCODING_BINARY:
+            if not self._binary_encoded:
+                self._binary = encode_message(self.message)
+                self._binary_encoded = True
+            if self._binary is not None:
+                return self._binary
+        return self.text
@@ -11,6 +11,7 @@ import { DialogBox } from "../UI";
 import { ModeToggleBar } from "../UI/ModeToggleBar";
 import { Panel } from "../UI/Panel";
 import { BottomBar } from "../UI/BottomBar";
+import { defaultCameraPosition } from "../../utils";
 
 const UI = () => {
   return (
@@ -33,7 +34,7 @@ const ThreeD = () => {
         // toneMapping: LinearToneMapping,
       }}
       camera={{
-        position: [17.43, 657.76, 943.51],
+        position: defaultCameraPosition,
         near: 0.1,
         far: 20000,
       }}
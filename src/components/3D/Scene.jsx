@@ -10,7 +10,7 @@ import {
   DeleteBrick,
   Select,
 } from ".";
-import { Vector3, Box3 } from "three";
+import { Vector3 } from "three";
 import {
   uID,
   getMeasurementsFromDimensions,
@@ -18,6 +18,7 @@ import {
   useAnchorShorcuts,
   minWorkSpaceSize,
   EDIT_MODE,
+  collisonXYZ,
 } from "../../utils";
 import { ChangeColor } from "./ChangeColor";
 import { useStore } from "../../store";
@@ -63,51 +64,19 @@ export const Scene = () => {
     if (!brickCursorRef.current) return;
 
     if (!isDrag.current) {
-      const dimensions = getMeasurementsFromDimensions({
-        x: width,
-        z: depth,
-      });
-      const boundingBoxOfBrickToBeAdded = new Box3().setFromObject(
-        brickCursorRef.current
-      );
-
-      let canCreate = true;
-
-      for (let index = 0; index < bricksBoundBox.current.length; index++) {
-        const brickBoundingBox = bricksBoundBox.current[index].brickBoundingBox;
-        const collision =
-          boundingBoxOfBrickToBeAdded.intersectsBox(brickBoundingBox);
-
-        if (collision) {
-          const dx = Math.abs(
-            brickBoundingBox.max.x - boundingBoxOfBrickToBeAdded.max.x
-          );
-          const dz = Math.abs(
-            brickBoundingBox.max.z - boundingBoxOfBrickToBeAdded.max.z
-          );
-          const yIntsersect =
-            brickBoundingBox.max.y - 9 > boundingBoxOfBrickToBeAdded.min.y;
-          if (
-            yIntsersect &&
-            dx !== dimensions.width &&
-            dz !== dimensions.depth
-          ) {
-            canCreate = false;
-            break;
-          }
-        }
-      }
+      const brickData = {
+        intersect: { point: e.point, face: e.face },
+        uID: uID(),
+        dimensions: { x: width, z: depth },
+        rotation: rotate ? Math.PI / 2 : 0,
+        color: color,
+        translation: { x: anchorX, z: anchorZ },
+      };
+
+      // 与服务器使用相同的碰撞规则（考虑旋转和平移后的实际占位）
+      const canCreate = !bricks.some((brick) => collisonXYZ(brickData, brick));
 
       if (canCreate) {
-        const brickData = {
-          intersect: { point: e.point, face: e.face },
-          uID: uID(),
-          dimensions: { x: width, z: depth },
-          rotation: rotate ? Math.PI / 2 : 0,
-          color: color,
-          translation: { x: anchorX, z: anchorZ },
-        };
-
         setBricks((prevBricks) => {
           // console.log("prevBricks", prevBricks)
           // if (prevBricks && prevBricks.length != 0)
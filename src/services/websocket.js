@@ -1,11 +1,21 @@
+import { decodeMessage, encodeMessage } from './wire';
+
 // 存储全局连接实例
 let globalConnection = null;
 let reconnectAttempts = 0;
 const MAX_RECONNECT_ATTEMPTS = 3;
 const RECONNECT_DELAY = 1000;
+// 服务器关闭码：同一用户在其他地方重新加入，会话已被接管
+const SESSION_REPLACED_CODE = 4000;
+// 消息编码：json（默认）或 binary（积木和光标使用紧凑的二进制格式，见 wire.js）
+const WS_ENCODING = import.meta.env.VITE_WS_ENCODING || "json";
+// 房间状态分块发送时每块的积木数，0 表示一次性接收完整状态
+const STATE_CHUNK_SIZE = Number(import.meta.env.VITE_WS_STATE_CHUNK_SIZE || 1000);
 
 export const setupWebSocket = ({
     roomId,
+    getResumeState,
+    viewpoint,
     onOpen,
     onClose,
     onError,
@@ -35,11 +45,30 @@ export const setupWebSocket = ({
     reconnectAttempts = 0;
     // 确定 WebSocket URL
     const wsHost = import.meta.env.VITE_WS_HOST || "localhost:8000";
-    const wsUrl = `ws://${wsHost}/ws/${roomId}`;
+    // 已有同步状态时携带版本号，服务器只发送错过的增量
+    const resume = getResumeState ? getResumeState() : null;
+    const params = new URLSearchParams();
+    if (resume) {
+        params.set("since", resume.version);
+        params.set("epoch", resume.epoch);
+    }
+    if (WS_ENCODING === "binary") {
+        params.set("encoding", "binary");
+    }
+    // 大房间分块接收状态，离视点近的积木先到达
+    if (STATE_CHUNK_SIZE > 0) {
+        params.set("chunk_size", STATE_CHUNK_SIZE);
+        if (viewpoint) {
+            params.set("view", viewpoint.join(","));
+        }
+    }
+    const query = params.toString();
+    const wsUrl = `ws://${wsHost}/ws/${roomId}${query ? `?${query}` : ""}`;
     console.log(`创建新的 WebSocket 连接: ${wsUrl}`);
 
     // 创建 WebSocket 连接
     const ws = new WebSocket(wsUrl);
+    ws.binaryType = "arraybuffer";
 
     // 标记连接状态
     let isManualClose = false;
@@ -73,6 +102,11 @@ export const setupWebSocket = ({
         // 通知关闭事件
         if (onClose) onClose();
 
+        // 会话已被同一用户的新连接接管时不再重连，避免两个连接互相替换
+        if (event.code === SESSION_REPLACED_CODE) {
+            isManualClose = true;
+        }
+
         // 如果不是手动关闭且需要重连
         if (!isManualClose && reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
             reconnectAttempts++;
@@ -83,6 +117,8 @@ export const setupWebSocket = ({
                 console.log('正在重连...');
                 setupWebSocket({
                     roomId,
+                    getResumeState,
+                    viewpoint,
                     onOpen,
                     onClose,
                     onError,
@@ -101,8 +137,19 @@ export const setupWebSocket = ({
     };
 
     ws.onmessage = (event) => {
-        console.log('收到消息:', event.data);
-        if (onMessage) onMessage(event.data);
+        // 二进制消息解码为对象，文本消息原样交给 onMessage 解析
+        const message = event.data instanceof ArrayBuffer ? decodeMessage(event.data) : event.data;
+        console.log('收到消息:', message);
+        if (onMessage) onMessage(message);
+    };
+
+    // 使用二进制编码时，积木消息尽量以二进制发送，其余消息仍为 JSON
+    const serialize = (data) => {
+        if (WS_ENCODING === "binary") {
+            const frame = encodeMessage(data);
+            if (frame) return frame;
+        }
+        return JSON.stringify(data);
     };
 
     // 创建一个控制对象
@@ -112,11 +159,11 @@ export const setupWebSocket = ({
         isManualClose,
         sendUpdate: (data) => {
             if (ws.readyState === WebSocket.OPEN) {
-                ws.send(JSON.stringify(data));
+                ws.send(serialize(data));
             } else if (ws.readyState === WebSocket.CONNECTING) {
                 // 如果连接中，等待连接完成再发送
                 ws.addEventListener('open', () => {
-                    ws.send(JSON.stringify(data));
+                    ws.send(serialize(data));
                 }, { once: true });
             } else {
                 console.warn('WebSocket 不在打开状态，无法发送消息');
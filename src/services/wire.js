@@ -0,0 +1,197 @@
+// WebSocket 二进制消息编码（与服务器 python_server/wire.py 的格式一致，均为小端序）
+//   u8 格式版本 | u32 元数据长度 | 元数据 JSON | 数据表...
+// 元数据中的积木 / 光标数组被替换为占位符 {"$table": 序号}，每个数据表为 u8 类型 | u32 长度 | 内容
+
+const BINARY_VERSION = 1;
+const TABLE_BRICKS = 1;
+const TABLE_CURSORS = 2;
+// 积木定长记录：6 个 f64（位置、法线）、6 个 i32（面顶点、材质、尺寸）、3 个 f64（旋转、平移）、u16 颜色序号
+const BRICK_RECORD_SIZE = 98;
+const BRICK_KEYS = ["intersect", "uID", "dimensions", "rotation", "color", "translation"];
+const BRICK_MESSAGES = ["ROOM_STATE", "BRICK_ADDED", "BRICK_UPDATED"];
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+const readStrings = (bytes, offset, count) => {
+  const strings = [];
+  for (let i = 0; i < count; i++) {
+    const length = bytes[offset];
+    strings.push(textDecoder.decode(bytes.subarray(offset + 1, offset + 1 + length)));
+    offset += 1 + length;
+  }
+  return [strings, offset];
+};
+
+const decodeBricks = (view, start, extras) => {
+  const bytes = new Uint8Array(view.buffer, view.byteOffset);
+  const count = view.getUint32(start, true);
+  const paletteCount = view.getUint16(start + 4, true);
+  let [palette, offset] = readStrings(bytes, start + 6, paletteCount);
+  let ids;
+  [ids, offset] = readStrings(bytes, offset, count);
+
+  const bricks = new Array(count);
+  for (let i = 0; i < count; i++, offset += BRICK_RECORD_SIZE) {
+    const f64 = (at) => view.getFloat64(offset + at, true);
+    const i32 = (at) => view.getInt32(offset + at, true);
+    const brick = {
+      intersect: {
+        point: { x: f64(0), y: f64(8), z: f64(16) },
+        face: {
+          a: i32(48),
+          b: i32(52),
+          c: i32(56),
+          normal: { x: f64(24), y: f64(32), z: f64(40) },
+          materialIndex: i32(60)
+        }
+      },
+      uID: ids[i],
+      dimensions: { x: i32(64), z: i32(68) },
+      rotation: f64(72),
+      color: palette[view.getUint16(offset + 96, true)],
+      translation: { x: f64(80), z: f64(88) }
+    };
+    bricks[i] = extras && extras[ids[i]] ? { ...brick, ...extras[ids[i]] } : brick;
+  }
+  return bricks;
+};
+
+const decodeCursors = (view, start) => {
+  const bytes = new Uint8Array(view.buffer, view.byteOffset);
+  const count = view.getUint32(start, true);
+  let [ids, offset] = readStrings(bytes, start + 4, count);
+  return ids.map((id, i) => {
+    const at = offset + i * 24;
+    return {
+      id,
+      position: {
+        x: view.getFloat64(at, true),
+        y: view.getFloat64(at + 8, true),
+        z: view.getFloat64(at + 16, true)
+      }
+    };
+  });
+};
+
+// 将服务器发送的二进制帧（ArrayBuffer）解码为与 JSON 消息相同结构的对象
+export const decodeMessage = (buffer) => {
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+  if (view.getUint8(0) !== BINARY_VERSION) {
+    throw new Error(`不支持的二进制消息版本: ${view.getUint8(0)}`);
+  }
+  const metaLength = view.getUint32(1, true);
+  const meta = JSON.parse(textDecoder.decode(bytes.subarray(5, 5 + metaLength)));
+
+  const tables = [];
+  let offset = 5 + metaLength;
+  while (offset < buffer.byteLength) {
+    tables.push({ kind: view.getUint8(offset), start: offset + 5 });
+    offset += 5 + view.getUint32(offset + 1, true);
+  }
+
+  const resolve = (value) => {
+    if (Array.isArray(value)) {
+      return value.map(resolve);
+    }
+    if (value && typeof value === "object") {
+      if ("$table" in value) {
+        const table = tables[value.$table];
+        return table.kind === TABLE_BRICKS
+          ? decodeBricks(view, table.start, value.extras)
+          : decodeCursors(view, table.start);
+      }
+      return Object.fromEntries(Object.entries(value).map(([key, item]) => [key, resolve(item)]));
+    }
+    return value;
+  };
+  return resolve(meta);
+};
+
+// 值是否恰好为 { x, z } 且两个值都通过 check（尺寸、平移）
+const isPair = (value, check) =>
+  value && typeof value === "object" && Object.keys(value).length === 2
+    && check(value.x) && check(value.z);
+
+const isStandardBrick = (brick) => {
+  const face = brick?.intersect?.face;
+  return face && BRICK_KEYS.every(key => key in brick) && Object.keys(brick).every(key => BRICK_KEYS.includes(key))
+    && brick.intersect.point && face.normal
+    && [face.a, face.b, face.c, face.materialIndex].every(Number.isInteger)
+    && isPair(brick.dimensions, Number.isInteger)
+    && isPair(brick.translation, Number.isFinite)
+    && Number.isFinite(brick.rotation)
+    && typeof brick.color === "string" && typeof brick.uID === "string";
+};
+
+const encodeBricks = (bricks) => {
+  if (!bricks.every(isStandardBrick)) {
+    return null;
+  }
+  const palette = [...new Set(bricks.map(brick => brick.color || "#ff0000"))];
+  const paletteIndex = new Map(palette.map((color, i) => [color, i]));
+  const strings = [...palette, ...bricks.map(brick => brick.uID)].map(value => textEncoder.encode(value));
+  if (palette.length > 0xffff || strings.some(raw => raw.length > 255)) {
+    return null;
+  }
+
+  const stringsLength = strings.reduce((total, raw) => total + 1 + raw.length, 0);
+  const buffer = new ArrayBuffer(6 + stringsLength + bricks.length * BRICK_RECORD_SIZE);
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+  view.setUint32(0, bricks.length, true);
+  view.setUint16(4, palette.length, true);
+  let offset = 6;
+  strings.forEach(raw => {
+    bytes[offset] = raw.length;
+    bytes.set(raw, offset + 1);
+    offset += 1 + raw.length;
+  });
+
+  bricks.forEach(brick => {
+    const { point, face } = brick.intersect;
+    const translation = brick.translation || { x: 0, z: 0 };
+    [point.x, point.y, point.z, face.normal.x, face.normal.y, face.normal.z]
+      .forEach((value, i) => view.setFloat64(offset + i * 8, value, true));
+    [face.a, face.b, face.c, face.materialIndex, brick.dimensions.x, brick.dimensions.z]
+      .forEach((value, i) => view.setInt32(offset + 48 + i * 4, value, true));
+    [brick.rotation || 0, translation.x, translation.z]
+      .forEach((value, i) => view.setFloat64(offset + 72 + i * 8, value, true));
+    view.setUint16(offset + 96, paletteIndex.get(brick.color || "#ff0000"), true);
+    offset += BRICK_RECORD_SIZE;
+  });
+  return bytes;
+};
+
+// 将发送给服务器的消息编码为二进制帧；消息不包含积木数组或积木结构不标准时返回 null，调用方应改用 JSON
+export const encodeMessage = (message) => {
+  const { type, data } = message;
+  let bricks;
+  let meta;
+  if (type === "UPDATE_BRICKS" && Array.isArray(data)) {
+    bricks = data;
+    meta = { ...message, data: { $table: 0 } };
+  } else if (BRICK_MESSAGES.includes(type) && data && Array.isArray(data.bricks)) {
+    bricks = data.bricks;
+    meta = { ...message, data: { ...data, bricks: { $table: 0 } } };
+  } else {
+    return null;
+  }
+
+  const table = encodeBricks(bricks);
+  if (!table) {
+    return null;
+  }
+  const metaBytes = textEncoder.encode(JSON.stringify(meta));
+  const frame = new Uint8Array(5 + metaBytes.length + 5 + table.length);
+  const view = new DataView(frame.buffer);
+  view.setUint8(0, BINARY_VERSION);
+  view.setUint32(1, metaBytes.length, true);
+  frame.set(metaBytes, 5);
+  const offset = 5 + metaBytes.length;
+  view.setUint8(offset, TABLE_BRICKS);
+  view.setUint32(offset + 1, table.length, true);
+  frame.set(table, offset + 5);
+  return frame.buffer;
+};
@@ -5,12 +5,71 @@ import {
   defaultWidth,
   generateSoftColors,
   uID,
+  defaultCameraPosition,
 } from "../utils";
 import { setupWebSocket } from "../services/websocket";
 
 const id = uID();
 const color = generateSoftColors();
 
+// 比较新旧砖块数组，得到需要发送给服务器的增量变更
+const diffBricks = (prevBricks, nextBricks) => {
+  const prevById = new Map(prevBricks.map((brick) => [brick.uID, brick]));
+  const nextIds = new Set(nextBricks.map((brick) => brick.uID));
+
+  const added = nextBricks.filter((brick) => !prevById.has(brick.uID));
+  const removed = prevBricks
+    .filter((brick) => !nextIds.has(brick.uID))
+    .map((brick) => brick.uID);
+  const updated = nextBricks.filter(
+    (brick) => prevById.has(brick.uID) && prevById.get(brick.uID) !== brick
+  );
+
+  return { added, removed, updated };
+};
+
+// 将服务器发送的一条增量消息应用到砖块数组（重复收到同一条增量时结果不变）
+const applyBrickDelta = (bricks, type, data) => {
+  switch (type) {
+    case "BRICK_ADDED": {
+      const addedById = new Map(data.bricks.map((brick) => [brick.uID, brick]));
+      return [
+        ...bricks.filter((brick) => !addedById.has(brick.uID)),
+        ...addedById.values(),
+      ];
+    }
+    case "BRICK_REMOVED": {
+      const removedIds = new Set(data.ids);
+      return bricks.filter((brick) => !removedIds.has(brick.uID));
+    }
+    case "BRICK_UPDATED": {
+      const updatedById = new Map(data.bricks.map((brick) => [brick.uID, brick]));
+      return bricks.map((brick) => updatedById.get(brick.uID) || brick);
+    }
+    case "BRICKS_CLEARED":
+      return [];
+    default:
+      return bricks;
+  }
+};
+
+// 分块接收房间状态期间需要缓存的积木消息类型
+const BRICK_DELTA_TYPES = ["BRICK_ADDED", "BRICK_REMOVED", "BRICK_UPDATED", "BRICKS_CLEARED", "UPDATE_BRICKS"];
+
+// 按顺序应用缓存的积木消息（自己发送的增量的确认只携带版本号，不改变积木）
+const replayBrickDeltas = (bricks, deltas) => deltas.reduce((result, { type, data }) => {
+  if (type === "UPDATE_BRICKS") {
+    return data;
+  }
+  if (type === "BRICKS_CLEARED" || data.bricks || data.ids) {
+    return applyBrickDelta(result, type, data);
+  }
+  return result;
+}, bricks);
+
+// 正在分块接收的房间状态：{ version, epoch, deltas }
+let stateTransfer = null;
+
 // 创建基础 store
 const createBaseStore = (set, get) => ({
   mode: CREATE_MODE,
@@ -53,9 +112,15 @@ const createBaseStore = (set, get) => ({
   bricks: [],
   setBricks: (getBricks) => {
     console.log("store/setBricks", getBricks);
-    const newBricks = getBricks(get().bricks);
-    // 发送更新到服务器
-    get().wsConnection?.sendUpdate({ type: "UPDATE_BRICKS", data: newBricks });
+    const prevBricks = get().bricks;
+    const newBricks = getBricks(prevBricks);
+    // 只向服务器发送增量变更，base_version 为做出变更时所见的房间版本（服务器据此检测与其他用户的修改冲突）
+    const { added, removed, updated } = diffBricks(prevBricks, newBricks);
+    const ws = get().wsConnection;
+    const base_version = get().version;
+    if (removed.length) ws?.sendUpdate({ type: "BRICK_REMOVED", data: { ids: removed }, base_version });
+    if (updated.length) ws?.sendUpdate({ type: "BRICK_UPDATED", data: { bricks: updated }, base_version });
+    if (added.length) ws?.sendUpdate({ type: "BRICK_ADDED", data: { bricks: added }, base_version });
     return set({ bricks: newBricks });
   },
   clearBricks: () => {
@@ -84,6 +149,11 @@ const createBaseStore = (set, get) => ({
     set({ cursorColors: updatedColors });
   },
 
+  // 已同步的房间版本号
+  version: 0,
+  // 服务器上房间实例的标识，重连时与版本号一起发送以便只同步错过的增量
+  epoch: null,
+
   // WebSocket 连接和状态
   wsConnection: null,
   roomId: null, // 房间ID
@@ -98,6 +168,11 @@ const createBaseStore = (set, get) => ({
       return;
     }
 
+    // 切换到其他房间时不能沿用之前房间的版本号
+    if (get().roomId !== roomId) {
+      set({ epoch: null, version: 0 });
+    }
+
     set({ connecting: true, roomId });
 
     // 保存用户信息到本地存储
@@ -105,6 +180,12 @@ const createBaseStore = (set, get) => ({
 
     const wsConnection = setupWebSocket({
       roomId,
+      // 每次（重新）连接时携带已同步的版本号
+      getResumeState: () => {
+        const { epoch, version } = get();
+        return epoch ? { epoch, version } : null;
+      },
+      viewpoint: defaultCameraPosition,
       onOpen: () => {
         set({ connected: true, connecting: false, error: null });
       },
@@ -116,31 +197,114 @@ const createBaseStore = (set, get) => ({
       },
       onMessage: (message) => {
         try {
-          const { type, data } = JSON.parse(message);
+          // 二进制编码的消息已由 websocket.js 解码为对象
+          const { type, data } = typeof message === "string" ? JSON.parse(message) : message;
           console.log('收到消息', type, data);
 
+          // 分块接收房间状态期间，积木增量先缓存，收到 ROOM_STATE_END 后再按顺序应用
+          if (stateTransfer && BRICK_DELTA_TYPES.includes(type)) {
+            stateTransfer.deltas.push({ type, data });
+            return;
+          }
+
           switch (type) {
             case "ROOM_STATE":
               // 收到房间的完整状态
+              stateTransfer = null;
               set({
                 bricks: data.bricks || [],
                 cursorColors: data.cursorColors || {},
+                version: data.version || 0,
+                epoch: data.epoch || null,
                 connected: true,   // 确保设置为已连接
                 connecting: false,
                 error: null
               });
               break;
+            case "ROOM_STATE_BEGIN":
+              // 开始分块接收房间状态；接收完成前不记录版本号，中途断线重连时重新获取完整状态
+              stateTransfer = { version: data.version, epoch: data.epoch, deltas: [] };
+              set({
+                bricks: [],
+                cursorColors: data.cursorColors || {},
+                epoch: null,
+                connected: true,
+                connecting: false,
+                error: null
+              });
+              break;
+            case "ROOM_STATE_CHUNK":
+              // 边接收边渲染
+              if (stateTransfer) {
+                set(state => ({ bricks: state.bricks.concat(data.bricks) }));
+              }
+              break;
+            case "ROOM_STATE_END": {
+              const transfer = stateTransfer;
+              stateTransfer = null;
+              if (transfer) {
+                set(state => ({
+                  bricks: replayBrickDeltas(state.bricks, transfer.deltas),
+                  version: Math.max(data.version, ...transfer.deltas.map(delta => delta.data?.version || 0)),
+                  epoch: transfer.epoch
+                }));
+              }
+              break;
+            }
+            case "ROOM_DELTAS":
+              // 重连后只收到断线期间错过的增量
+              set(state => ({
+                bricks: data.deltas.reduce(
+                  (bricks, delta) => applyBrickDelta(bricks, delta.type, delta.data),
+                  state.bricks
+                ),
+                cursorColors: data.cursorColors || {},
+                version: data.version,
+                epoch: data.epoch,
+                connected: true,
+                connecting: false,
+                error: null
+              }));
+              break;
             case "UPDATE_BRICKS":
               // 收到砖块更新
               set({ bricks: data });
               break;
             case "BRICK_ADDED":
-              // 收到添加砖块确认
-              console.log('砖块添加成功');
+            case "BRICK_REMOVED":
+            case "BRICK_UPDATED":
+              if (data.bricks || data.ids) {
+                // 其他用户的增量变更
+                set(state => ({
+                  bricks: applyBrickDelta(state.bricks, type, data),
+                  version: data.version
+                }));
+              } else {
+                // 收到自己发送的增量的确认，被拒绝的积木随后由服务器发送的增量恢复
+                if (data.status !== "success") {
+                  console.warn(`${type} ${data.status}`, data.rejected, data.conflicts);
+                }
+                set({ version: data.version });
+              }
               break;
             case "BRICKS_CLEARED":
-              // 收到清空砖块确认
-              console.log('砖块清空成功');
+              // 砖块已被清空（自己或其他用户发起）
+              set({ bricks: [], version: data.version });
+              break;
+            case "UNDO":
+            case "REDO":
+              // 撤销 / 重做的结果，积木变更已通过增量消息收到
+              if (data.status !== "success") {
+                console.warn(`${type} ${data.status}`, data.skipped);
+              }
+              break;
+            case "ERROR":
+              // 消息超出服务器的入站限制（大小或速率）被丢弃
+              console.warn(`服务器拒绝了消息: ${data.code}`, data.message, data.retry_after);
+              break;
+            case "PING":
+              // 回复服务器的心跳检测
+              get().wsConnection?.sendUpdate({ type: "PONG" });
               break;
             case "USER_JOINED":
               // 新用户加入
@@ -162,6 +326,16 @@ const createBaseStore = (set, get) => ({
                 get().room.events.emit(data.id, data.position);
               }
               break;
+            case "USER_CURSORS":
+              // 服务器按固定频率合并发送的光标位置（忽略自己的光标）
+              if (get().room) {
+                data.forEach(cursor => {
+                  if (cursor.id !== get().self.id) {
+                    get().room.events.emit(cursor.id, cursor.position);
+                  }
+                });
+              }
+              break;
           }
         } catch (e) {
           console.error("Failed to parse message", e);
@@ -207,6 +381,11 @@ const createBaseStore = (set, get) => ({
         callbacks.forEach(callback => callback(data));
       }
     },
+    // 撤销 / 重做由服务器根据操作日志完成，只会收到回退产生的增量
+    history: {
+      undo: () => get().wsConnection?.sendUpdate({ type: "UNDO" }),
+      redo: () => get().wsConnection?.sendUpdate({ type: "REDO" }),
+    },
     // 添加 subscribe 方法来兼容 Others.jsx
     subscribe: function (callback) {
       // 监听数据变化
@@ -8,6 +8,8 @@ export const EDIT_MODE = "Edit Mode";
 
 export const defaultWidth = 1;
 export const defaultAnchor = 0;
+// 相机初始位置（分块接收房间状态时，服务器按到该位置的距离由近到远发送积木）
+export const defaultCameraPosition = [17.43, 657.76, 943.51];
 
 export const bricks = [
   { x: 1, z: 1 },
@@ -45,24 +45,65 @@ export function createGeometry({
   return brickGeometry;
 }
 
-export function collisonXYZ(o1, o2) {
-  if (
-    Math.abs(o1.position.x - o2.position.x) >
-    (o1.geometry.parameters.width + o2.geometry.parameters.width) / 2
-  )
-    return false;
-  if (
-    Math.abs(o1.position.y - o2.position.y) >
-    (o1.geometry.parameters.height + o2.geometry.parameters.height) / 2
-  )
-    return false;
-  if (
-    Math.abs(o1.position.z - o2.position.z) >
-    (o1.geometry.parameters.depth + o2.geometry.parameters.depth) / 2
-  ) {
-    return false;
-  }
-  return true;
+// 单层积木高度，与 getMeasurementsFromDimensions 的默认高度一致
+const layerHeight = (base * 2) / 1.5;
+const collisionEpsilon = 1e-6;
+
+// 旋转 90 度的倍数时 cos / sin 取精确值
+const snapUnit = (value) => {
+  if (Math.abs(value) < 1e-9) return 0;
+  if (Math.abs(Math.abs(value) - 1) < 1e-9) return Math.sign(value);
+  return value;
+};
+
+const clamp = (value, limit) => Math.min(Math.max(value, -limit), limit);
+
+// 积木的实际占位（与 Brick.jsx 的渲染及服务器 python_server/collision.py 的规则一致）：
+// 旋转后矩形底面的中心、半边长、朝向和所在层
+export function brickFootprint({ intersect, dimensions, rotation = 0, translation }) {
+  const normal = intersect.face?.normal || { x: 0, y: 0, z: 0 };
+  const offset = translation || { x: 0, z: 0 };
+  const evenWidth = rotation === 0 ? dimensions.x % 2 === 0 : dimensions.z % 2 === 0;
+  const evenDepth = rotation === 0 ? dimensions.z % 2 === 0 : dimensions.x % 2 === 0;
+
+  const gx = Math.floor((intersect.point.x + normal.x) / base) * base + (evenWidth ? base : base / 2);
+  const gz = Math.floor((intersect.point.z + normal.z) / base) * base + (evenDepth ? base : base / 2);
+  const gy = Math.floor((intersect.point.y + normal.y) / layerHeight) * layerHeight + layerHeight / 2;
+
+  const cos = snapUnit(Math.cos(rotation));
+  const sin = snapUnit(Math.sin(rotation));
+  const ox = clamp(offset.x, Math.floor(dimensions.x / 2)) * base;
+  const oz = clamp(offset.z, Math.floor(dimensions.z / 2)) * base;
+  return {
+    cx: gx + ox * cos + oz * sin,
+    cz: gz - ox * sin + oz * cos,
+    hx: (dimensions.x * base) / 2,
+    hz: (dimensions.z * base) / 2,
+    cos,
+    sin,
+    layer: Math.floor(Math.abs(gy) / layerHeight),
+  };
+}
+
+// 两块积木（积木数据）是否碰撞：位于同一层且旋转后的底面有面积重叠（分离轴定理，正好接触不算）
+export function collisonXYZ(brick1, brick2) {
+  const a = brickFootprint(brick1);
+  const b = brickFootprint(brick2);
+  if (a.layer !== b.layer) return false;
+
+  const dx = b.cx - a.cx;
+  const dz = b.cz - a.cz;
+  const radius = (fp, ux, uz) =>
+    fp.hx * Math.abs(fp.cos * ux - fp.sin * uz) + fp.hz * Math.abs(fp.sin * ux + fp.cos * uz);
+  return [
+    [a.cos, -a.sin],
+    [a.sin, a.cos],
+    [b.cos, -b.sin],
+    [b.sin, b.cos],
+  ].every(
+    ([ux, uz]) =>
+      Math.abs(dx * ux + dz * uz) < radius(a, ux, uz) + radius(b, ux, uz) - collisionEpsilon
+  );
 }
 
 export function degToRad(angle) {